@@ -0,0 +1,50 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+from ironic_lib import metrics_utils
+import pecan
+from pecan import rest
+from webob import static
+
+from ironic_python_agent import image_cache
+
+
+class ImageController(rest.RestController):
+    """Controller serving cached images to other agents."""
+
+    @pecan.expose()
+    def get_one(self, key):
+        """Get an image from the image cache.
+
+        Byte ranges are supported, so peers can resume downloads and
+        download in parallel.
+
+        The cache is only used once a deployment has set it up, a request
+        never mounts or creates it.
+
+        :param key: The cache key of the image, e.g. "sha256-<hex digest>".
+        """
+        with metrics_utils.get_metrics_logger(__name__).timer('get_one'):
+            cache = image_cache.find_cache()
+            if (cache is None or not image_cache.is_valid_key(key)
+                    or not cache.contains(key)):
+                pecan.abort(404)
+
+            f = open(cache.entry_path(key), 'rb')
+            return pecan.Response(
+                app_iter=static.FileIter(f),
+                content_length=os.fstat(f.fileno()).st_size,
+                content_type='application/octet-stream',
+                accept_ranges='bytes',
+                conditional_response=True)
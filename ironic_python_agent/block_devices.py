@@ -0,0 +1,258 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Enumeration of block devices from sysfs and the udev database.
+
+This is an alternative to running ``lsblk`` and looking up every device
+with pyudev. All block devices and partitions are read in a single pass
+over ``/sys/block``, with the properties and symbolic links udev has
+recorded for them in ``/run/udev/data``. The device types are derived the
+same way ``lsblk`` derives them.
+
+A BlockDeviceMonitor follows the udev events of block devices, it tells
+when a listing of them has become stale and who is waiting for a device
+to appear.
+"""
+
+import collections
+import os
+import re
+import threading
+
+from oslo_log import log
+import pyudev
+
+LOG = log.getLogger(__name__)
+
+SYS_BLOCK = '/sys/block'
+UDEV_DATA = '/run/udev/data'
+UDEV_QUEUE = '/run/udev/queue'
+
+# SCSI peripheral device types, named like lsblk names them.
+_SCSI_TYPES = {0x00: 'disk', 0x01: 'tape', 0x02: 'printer',
+               0x03: 'processor', 0x04: 'worm', 0x05: 'rom',
+               0x06: 'scanner', 0x07: 'mo-disk', 0x08: 'changer',
+               0x09: 'comm', 0x0c: 'raid', 0x0d: 'enclosure', 0x0e: 'rbc',
+               0x11: 'osd', 0x7f: 'no-lun'}
+
+_HCTL_RE = re.compile(r'^\d+:\d+:\d+:\d+$')
+_DM_PART_RE = re.compile(r'^part\d+-')
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r'(\d+)', name)]
+
+
+def udev_queue_empty():
+    """Check whether udev has processed all events."""
+    return not os.path.exists(UDEV_QUEUE)
+
+
+def _read_udev_data(dev):
+    """Read the udev database entry of a device.
+
+    :param dev: The major and minor number of the device, e.g. ``8:0``.
+    :returns: A tuple of a dictionary of the udev properties and a list of
+              the symbolic links below /dev, both empty if udev has no
+              entry for the device.
+    """
+    properties = {}
+    links = []
+    try:
+        with open(os.path.join(UDEV_DATA, 'b{}'.format(dev)), 'r') as f:
+            for line in f:
+                kind, _sep, value = line.rstrip('\n').partition(':')
+                if kind == 'E':
+                    key, _sep, value = value.partition('=')
+                    properties[key] = value
+                elif kind == 'S':
+                    links.append(value)
+    except (IOError, OSError) as e:
+        LOG.debug('No udev data for block device %(dev)s: %(error)s',
+                  {'dev': dev, 'error': e})
+    return properties, links
+
+
+def _device_type(kname, path, partition, parent_path):
+    # The same order of checks as lsblk, which reports partitions as such
+    # even on md devices.
+    if partition:
+        return 'part'
+    if kname.startswith('dm-'):
+        uuid = _read(os.path.join(path, 'dm', 'uuid'))
+        if not uuid:
+            return 'dm'
+        if _DM_PART_RE.match(uuid):
+            return 'part'
+        return uuid.split('-', 1)[0].lower()
+    if kname.startswith('loop'):
+        return 'loop'
+    if kname.startswith('md'):
+        return _read(os.path.join(path, 'md', 'level')) or 'md'
+    scsi_type = _read(os.path.join(parent_path, 'device', 'type'))
+    try:
+        return _SCSI_TYPES.get(int(scsi_type), 'disk')
+    except (TypeError, ValueError):
+        return 'disk'
+
+
+def _read_device(kname, path, partition=False, parent_path=None):
+    parent_path = parent_path or path
+    dev = _read(os.path.join(path, 'dev'))
+    properties, links = _read_udev_data(dev) if dev else ({}, [])
+    by_path = sorted(link for link in links
+                     if link.startswith('disk/by-path/'))
+
+    hctl = None
+    if not partition:
+        try:
+            target = os.path.basename(
+                os.readlink(os.path.join(path, 'device')))
+        except OSError:
+            target = None
+        if target and _HCTL_RE.match(target):
+            hctl = target
+
+    size = _read(os.path.join(path, 'size'))
+    return {'KNAME': kname,
+            'MODEL': ('' if partition
+                      else _read(os.path.join(path, 'device', 'model'))
+                      or ''),
+            'SIZE': str(int(size) * 512) if size else '0',
+            'ROTA': _read(os.path.join(parent_path, 'queue',
+                                       'rotational')) or '0',
+            'TYPE': _device_type(kname, path, partition, parent_path),
+            'dev': dev,
+            'udev': properties,
+            'by_path': os.path.join('/dev', by_path[0]) if by_path else None,
+            'hctl': hctl,
+            'vendor': (None if partition
+                       else _read(os.path.join(path, 'device', 'vendor')))}
+
+
+def read_block_device(kname, path):
+    """Read a single whole block device, e.g. one reported by udev.
+
+    :param kname: The kernel name of the device, e.g. ``sdb``.
+    :param path: The sysfs directory of the device.
+    :returns: A dictionary like those of enumerate_block_devices.
+    """
+    return _read_device(kname, path)
+
+
+def enumerate_block_devices():
+    """Enumerate all block devices and their partitions.
+
+    :returns: An ordered dictionary mapping kernel names to dictionaries
+              with the ``KNAME``, ``MODEL``, ``SIZE``, ``ROTA`` and
+              ``TYPE`` fields as reported by ``lsblk -Pbia``, the udev
+              properties as ``udev``, and the ``by_path`` link, the
+              ``hctl`` and the ``vendor`` of the device, if any. Every
+              device is followed by its partitions.
+    """
+    devices = collections.OrderedDict()
+    try:
+        knames = sorted(os.listdir(SYS_BLOCK), key=_natural_key)
+    except OSError as e:
+        LOG.warning('Unable to list block devices in %(path)s: %(error)s',
+                    {'path': SYS_BLOCK, 'error': e})
+        return devices
+
+    for kname in knames:
+        path = os.path.join(SYS_BLOCK, kname)
+        devices[kname] = _read_device(kname, path)
+        try:
+            entries = os.listdir(path)
+        except OSError:
+            continue
+        for part in sorted(entries, key=_natural_key):
+            part_path = os.path.join(path, part)
+            if (part.startswith(kname)
+                    and os.path.exists(os.path.join(part_path, 'partition'))):
+                devices[part] = _read_device(part, part_path, partition=True,
+                                             parent_path=path)
+    return devices
+
+
+class BlockDeviceMonitor(object):
+    """Follows the udev events of block devices on a background thread.
+
+    Every event, whether a device was added, removed or changed, bumps
+    ``generation``. A listing of block devices made at one generation is
+    still accurate as long as the generation has not changed.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._observer = None
+
+    def start(self):
+        """Start following udev events.
+
+        :raises: OSError if the udev netlink socket cannot be opened.
+        """
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('block')
+        self._observer = pyudev.MonitorObserver(
+            monitor, callback=self._handle_event,
+            name='block-device-monitor')
+        self._observer.daemon = True
+        self._observer.start()
+
+    def stop(self):
+        """Stop following udev events."""
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer = None
+
+    def invalidate(self):
+        """Make listings of block devices stale without an event."""
+        with self._lock:
+            self.generation += 1
+
+    def add_listener(self, callback):
+        """Call a function with every following udev event.
+
+        :param callback: A function accepting the pyudev Device of the
+                         event. It is called on the thread of the monitor
+                         and must not block.
+        """
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            self._listeners.remove(callback)
+
+    def _handle_event(self, device):
+        LOG.debug('udev event for block device %(dev)s: %(action)s',
+                  {'dev': device.sys_name, 'action': device.action})
+        with self._lock:
+            self.generation += 1
+            listeners = list(self._listeners)
+        for callback in listeners:
+            try:
+                callback(device)
+            except Exception:
+                LOG.exception('Failed to handle the udev event of block '
+                              'device %s', device.sys_name)
@@ -182,6 +182,58 @@ cli_opts = [
                     'Can be supplied as "ipa-hardware-initialization-delay" '
                     'kernel parameter.'),
 
+    cfg.IntOpt('inventory_workers',
+               min=1,
+               default=APARAMS.get('ipa-inventory-workers', 4),
+               help='The number of sections of the hardware inventory, e.g. '
+                    'network interfaces, disks or the BMC address, that are '
+                    'collected concurrently. Set to 1 to collect them one '
+                    'after another. Can be supplied as '
+                    '"ipa-inventory-workers" kernel parameter.'),
+
+    cfg.IntOpt('inventory_section_timeout',
+               min=0,
+               default=APARAMS.get('ipa-inventory-section-timeout', 300),
+               help='How much time (in seconds) collecting a single section '
+                    'of the hardware inventory may take. A section that '
+                    'times out or fails is left empty, the rest of the '
+                    'inventory is still reported. Set to zero to disable. '
+                    'Can be supplied as "ipa-inventory-section-timeout" '
+                    'kernel parameter.'),
+
+    cfg.IntOpt('lshw_cache_ttl',
+               min=0,
+               default=APARAMS.get('ipa-lshw-cache-ttl', 0),
+               help='How long (in seconds) the output of lshw is reused by '
+                    'the hardware managers before running it again. The '
+                    'cached output is dropped when block devices are '
+                    'refreshed, other hardware changes are only seen once '
+                    'it expires. Set to zero (the default) to run lshw '
+                    'every time. '
+                    'Can be supplied as "ipa-lshw-cache-ttl" '
+                    'kernel parameter.'),
+
+    cfg.StrOpt('block_device_enumerator',
+               default=APARAMS.get('ipa-block-device-enumerator', 'lsblk'),
+               choices=['lsblk', 'sysfs'],
+               help='How to list block devices. "lsblk" runs lsblk and '
+                    'looks up every device in udev. "sysfs" reads sysfs '
+                    'and the udev database directly, without running any '
+                    'command once udev has settled, which is considerably '
+                    'faster with many disks. '
+                    'Can be supplied as "ipa-block-device-enumerator" '
+                    'kernel parameter.'),
+
+    cfg.BoolOpt('block_device_cache',
+                default=APARAMS.get('ipa-block-device-cache', False),
+                help='Whether to keep the listed block devices in memory '
+                     'and follow the udev events of block devices to tell '
+                     'when they have changed. Listing block devices then '
+                     'only enumerates them again after a device has been '
+                     'added, removed or changed. '
+                     'Can be supplied as "ipa-block-device-cache" '
+                     'kernel parameter.'),
+
     cfg.IntOpt('disk_wait_attempts',
                min=0,
                default=APARAMS.get('ipa-disk-wait-attempts', 10),
@@ -243,6 +295,205 @@ cli_opts = [
                    'ipa-image-download-connection-retry-interval', 10),
                help='Interval (in seconds) between two attempts to establish '
                     'connection when downloading an image.'),
+    cfg.IntOpt('image_download_pool_connections', min=1,
+               default=APARAMS.get('ipa-image-download-pool-connections', 10),
+               help='The number of hosts to keep pools of HTTP connections '
+                    'for when downloading images, checksums and '
+                    'configdrives. Can be supplied as '
+                    '"ipa-image-download-pool-connections" kernel '
+                    'parameter.'),
+    cfg.IntOpt('image_download_pool_maxsize', min=1,
+               default=APARAMS.get('ipa-image-download-pool-maxsize', 10),
+               help='The maximum number of HTTP connections kept alive per '
+                    'host when downloading images, checksums and '
+                    'configdrives. Should be at least the number of '
+                    'concurrent connections per image. Can be supplied as '
+                    '"ipa-image-download-pool-maxsize" kernel parameter.'),
+    cfg.BoolOpt('image_download_mirror_racing',
+                default=APARAMS.get('ipa-image-download-mirror-racing',
+                                    False),
+                help='Whether to probe all image URLs concurrently and '
+                     'download from the fastest one, instead of using the '
+                     'first one that works. Can be overridden per image via '
+                     '"mirror_racing" in image_info. Can be supplied as '
+                     '"ipa-image-download-mirror-racing" kernel parameter.'),
+    cfg.IntOpt('image_download_probe_size', min=1,
+               default=APARAMS.get('ipa-image-download-probe-size',
+                                   1024 * 1024),
+               help='The number of bytes downloaded from each URL to '
+                    'measure its throughput when mirror racing is enabled. '
+                    'Can be supplied as "ipa-image-download-probe-size" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_download_min_throughput', min=0,
+               default=APARAMS.get('ipa-image-download-min-throughput', 0),
+               help='The throughput (in KiB/s) below which the agent looks '
+                    'for a faster URL and continues the download from it, '
+                    'if mirror racing is enabled and the server supports '
+                    'byte ranges. Set to 0 (the default) to never switch '
+                    'URLs during a download. Can be supplied as '
+                    '"ipa-image-download-min-throughput" kernel parameter.'),
+    cfg.IntOpt('image_download_rate_limit', min=0,
+               default=APARAMS.get('ipa-image-download-rate-limit', 0),
+               help='The maximum rate (in KiB/s) at which the agent downloads '
+                    'images, shared by all downloads of the agent. It leaves '
+                    'bandwidth for the heartbeats and API traffic when many '
+                    'nodes share an uplink, they are not otherwise '
+                    'prioritised over downloads. Set to 0 (the default) for '
+                    'no limit. The download of a single image can be '
+                    'limited further via "download_rate_limit" in '
+                    'image_info. A limit set with the '
+                    '"standby.set_download_rate_limit" command takes '
+                    'precedence over both. Can be supplied as '
+                    '"ipa-image-download-rate-limit" kernel parameter.'),
+    cfg.IntOpt('image_download_pipeline_buffers', min=0,
+               default=APARAMS.get(
+                   'ipa-image-download-pipeline-buffers', 0),
+               help='The number of 1 MiB buffers used to overlap receiving, '
+                    'writing and hashing of images in separate threads. '
+                    'This caps the memory used by the pipeline. Set to 0 '
+                    '(the default) to process images in a single thread. '
+                    'Can be supplied as "ipa-image-download-pipeline-buffers" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_verify_workers', min=0,
+               default=APARAMS.get('ipa-image-verify-workers', 0),
+               help='The number of threads verifying an image against the '
+                    'segment manifest in its checksums file. As many '
+                    'segments are kept in memory while being verified, and '
+                    'a segment failing to verify is downloaded again. Set '
+                    'to 0 (the default) to verify images against their '
+                    'checksum in a single thread. Can be overridden per '
+                    'image via "verify_workers" in image_info. Can be '
+                    'supplied as "ipa-image-verify-workers" kernel '
+                    'parameter.'),
+    cfg.IntOpt('image_read_back_readers', min=0,
+               default=APARAMS.get('ipa-image-read-back-readers', 0),
+               help='The number of concurrent O_DIRECT readers verifying a '
+                    'raw image by reading it back from the device after it '
+                    'has been written. The segment manifest is used if the '
+                    'checksums file of the image has one. Set to 0 (the '
+                    'default) to trust the written data. Can be overridden '
+                    'per image via "read_back_readers" in image_info. Can '
+                    'be supplied as "ipa-image-read-back-readers" kernel '
+                    'parameter.'),
+    cfg.BoolOpt('image_compressed_checksum',
+                default=APARAMS.get('ipa-image-compressed-checksum', True),
+                help='Whether the checksum (and the segment manifest) of a '
+                     'compressed image covers the compressed image as '
+                     'downloaded. If False, it covers the decompressed '
+                     'image. Only used for images with "compression" set in '
+                     'image_info. Can be overridden per image via '
+                     '"compressed_checksum" in image_info. Can be supplied '
+                     'as "ipa-image-compressed-checksum" kernel parameter.'),
+    cfg.BoolOpt('image_direct_io',
+                default=APARAMS.get('ipa-image-direct-io', False),
+                help='Whether to bypass the page cache (O_DIRECT) when '
+                     'streaming raw images onto block devices. Can be '
+                     'overridden per image via "direct_io" in image_info. '
+                     'Can be supplied as "ipa-image-direct-io" '
+                     'kernel parameter.'),
+    cfg.IntOpt('image_direct_io_size', min=4096,
+               default=APARAMS.get('ipa-image-direct-io-size',
+                                   4 * 1024 * 1024),
+               help='The size (in bytes) of a single write request when '
+                    'writing images with direct I/O. It is rounded up to a '
+                    'multiple of 4 KiB. '
+                    'Can be supplied as "ipa-image-direct-io-size" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_direct_io_queue_depth', min=1,
+               default=APARAMS.get('ipa-image-direct-io-queue-depth', 4),
+               help='The maximum number of concurrent write requests when '
+                    'writing images with direct I/O. '
+                    'Can be supplied as "ipa-image-direct-io-queue-depth" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_sparse_policy',
+               default=APARAMS.get('ipa-image-sparse-policy', 'none'),
+               choices=['none', 'skip', 'zeroout'],
+               help='How to handle blocks consisting of zeros when streaming '
+                    'raw images onto block devices. "none" writes them, '
+                    '"skip" seeks over them and must only be used if the '
+                    'device is known to contain zeros and "zeroout" zeroes '
+                    'them with BLKZEROOUT, which the kernel offloads to '
+                    'devices supporting WRITE ZEROES, unmapping the blocks '
+                    'where possible. Can be overridden per image via '
+                    '"sparse_policy" in image_info. Can be supplied as '
+                    '"ipa-image-sparse-policy" kernel parameter.'),
+    cfg.IntOpt('image_sparse_block_size', min=4096,
+               default=APARAMS.get('ipa-image-sparse-block-size',
+                                   1024 * 1024),
+               help='The size (in bytes) of the blocks checked for zeros '
+                    'when a sparse policy is used. It is rounded up to a '
+                    'multiple of 4 KiB. '
+                    'Can be supplied as "ipa-image-sparse-block-size" '
+                    'kernel parameter.'),
+    cfg.BoolOpt('image_stream_qcow2',
+                default=APARAMS.get('ipa-image-stream-qcow2', False),
+                help='Whether to convert whole disk qcow2 images onto the '
+                     'device while they are downloaded instead of '
+                     'downloading them to a temporary file first. Images '
+                     'using features the agent cannot convert are handled '
+                     'the old way. Can be overridden per image via '
+                     '"stream_qcow2" in image_info. Can be supplied as '
+                     '"ipa-image-stream-qcow2" kernel parameter.'),
+    cfg.BoolOpt('image_preflight',
+                default=APARAMS.get('ipa-image-preflight', False),
+                help='Whether to check an image before accepting a command '
+                     'to deploy or cache it: the image URLs are probed, the '
+                     'format and the virtual size of the image are checked '
+                     'against image_info and the checksum is fetched, all '
+                     'concurrently. Can be overridden per image via '
+                     '"preflight" in image_info. Can be supplied as '
+                     '"ipa-image-preflight" kernel parameter.'),
+    cfg.BoolOpt('image_stream_partition',
+                default=APARAMS.get('ipa-image-stream-partition', False),
+                help='Whether to stream raw and qcow2 partition images onto '
+                     'the root partition while they are downloaded, instead '
+                     'of downloading them to a temporary file first. The '
+                     'image must declare its "virtual_size" in image_info, '
+                     'the filesystem on it is grown to fill the root '
+                     'partition afterwards. Can be overridden per image via '
+                     '"stream_partition" in image_info. Can be supplied as '
+                     '"ipa-image-stream-partition" kernel parameter.'),
+    cfg.BoolOpt('image_write_in_agent',
+                default=APARAMS.get('ipa-image-write-in-agent', False),
+                help='Whether to write raw and qcow2 whole disk images '
+                     'downloaded to a temporary file by the agent itself, '
+                     'instead of running write_image.sh. The image is '
+                     'written with the direct I/O and sparse options used '
+                     'for streaming, without the memory limit of qemu-img, '
+                     'and only the target device is synced. Can be '
+                     'overridden per image via "write_in_agent" in '
+                     'image_info. Can be supplied as '
+                     '"ipa-image-write-in-agent" kernel parameter.'),
+    cfg.StrOpt('image_spill_dir',
+               default=APARAMS.get('ipa-image-spill-dir'),
+               help='The directory used to temporarily store parts of qcow2 '
+                    'images that are streamed onto a device, but arrive '
+                    'before the tables describing them. Defaults to the '
+                    'system temporary directory. '
+                    'Can be supplied as "ipa-image-spill-dir" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_cache_dir',
+               default=APARAMS.get('ipa-image-cache-dir'),
+               help='The directory to keep downloaded images in, named '
+                    'after their checksum, so that an image with the same '
+                    'checksum is not downloaded again. Images are '
+                    'downloaded to this directory instead of the system '
+                    'temporary directory. Disabled by default. '
+                    'Can be supplied as "ipa-image-cache-dir" '
+                    'kernel parameter.'),
+    cfg.StrOpt('image_cache_device',
+               default=APARAMS.get('ipa-image-cache-device'),
+               help='A device (e.g. a scratch partition) to mount on '
+                    'image_cache_dir if it is not a mount point yet. '
+                    'Can be supplied as "ipa-image-cache-device" '
+                    'kernel parameter.'),
+    cfg.IntOpt('image_cache_max_size', min=0,
+               default=APARAMS.get('ipa-image-cache-max-size', 0),
+               help='The maximum size (in MiB) of the image cache. The least '
+                    'recently used images are removed when it is exceeded. '
+                    'Set to 0 (the default) for no limit. '
+                    'Can be supplied as "ipa-image-cache-max-size" '
+                    'kernel parameter.'),
 
 ]
 
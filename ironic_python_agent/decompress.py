@@ -0,0 +1,226 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming decompression of downloaded images.
+
+Images can be stored compressed with gzip, xz or zstd. The compressed
+stream is decompressed on a thread of its own, so that decompression
+overlaps with receiving and writing the image. The output is produced in
+bounded pieces, a highly compressed run of zeros does not end up in memory
+at once.
+"""
+
+import threading
+import zlib
+
+from oslo_log import log
+import six
+
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = log.getLogger(__name__)
+
+FORMATS = ('gzip', 'xz', 'zstd')
+
+_MAGICS = [('gzip', b'\x1f\x8b'),
+           ('xz', b'\xfd7zXZ\x00'),
+           ('zstd', b'\x28\xb5\x2f\xfd')]
+
+_STOP = object()
+
+
+class DecompressionError(Exception):
+    """The compressed stream is invalid or truncated."""
+
+
+def detect(header):
+    """Detect the compression format of a stream from its first bytes.
+
+    :param header: The beginning of the stream.
+    :returns: One of FORMATS, or None if the stream is not compressed with
+              a known format.
+    """
+    header = bytes(header)
+    for fmt, magic in _MAGICS:
+        if header.startswith(magic):
+            return fmt
+    return None
+
+
+def is_supported(fmt):
+    """Check whether a compression format can be decompressed here."""
+    if fmt == 'gzip':
+        return True
+    elif fmt == 'xz':
+        return lzma is not None
+    elif fmt == 'zstd':
+        return zstandard is not None
+    return False
+
+
+def _gunzip(chunks, size):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = bytes(chunk)
+        while data:
+            output = decompressor.decompress(data, size)
+            if output:
+                yield output
+            if decompressor.unused_data:
+                # The next member of a multi-member file.
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif decompressor.unconsumed_tail:
+                data = decompressor.unconsumed_tail
+            else:
+                data = b''
+    output = decompressor.flush()
+    if output:
+        yield output
+    # NOTE: Python 2 cannot tell whether the stream is complete.
+    if not getattr(decompressor, 'eof', True):
+        raise DecompressionError('The gzip stream is truncated')
+
+
+def _unxz(chunks, size):
+    decompressor = lzma.LZMADecompressor()
+    for chunk in chunks:
+        data = bytes(chunk)
+        while True:
+            if decompressor.eof:
+                # The next stream of a multi-stream file.
+                data = decompressor.unused_data + data
+                if not data:
+                    break
+                decompressor = lzma.LZMADecompressor()
+            output = decompressor.decompress(data, size)
+            data = b''
+            if output:
+                yield output
+            if decompressor.needs_input:
+                break
+    if not decompressor.eof:
+        raise DecompressionError('The xz stream is truncated')
+
+
+class _ChunkReader(object):
+    """File-like object reading from an iterable of chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._data = b''
+
+    def read(self, size=-1):
+        while not self._data:
+            try:
+                self._data = bytes(next(self._chunks))
+            except StopIteration:
+                return b''
+        if size < 0:
+            size = len(self._data)
+        result, self._data = self._data[:size], self._data[size:]
+        return result
+
+
+def _unzstd(chunks, size):
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        _ChunkReader(chunks), read_size=size)
+    while True:
+        output = reader.read(size)
+        if not output:
+            return
+        yield output
+
+
+_DECOMPRESSORS = {'gzip': _gunzip, 'xz': _unxz, 'zstd': _unzstd}
+_ERRORS = tuple([zlib.error]
+                + ([lzma.LZMAError] if lzma is not None else [])
+                + ([zstandard.ZstdError] if zstandard is not None else []))
+
+
+class DecompressionStage(object):
+    """Decompresses a stream of chunks on a separate thread.
+
+    The thread consumes the compressed chunks, so any work done while
+    producing them, e.g. receiving from the network or hashing, also runs
+    on it. At most ``queue_size`` decompressed pieces of up to ``size``
+    bytes are buffered.
+    """
+
+    def __init__(self, chunks, fmt, size, queue_size=4):
+        """Create the stage.
+
+        :param chunks: An iterable of compressed chunks.
+        :param fmt: The compression format, one of FORMATS.
+        :param size: The maximum size of a decompressed piece in bytes.
+        :param queue_size: The maximum number of pieces buffered.
+        """
+        self._chunks = chunks
+        self._decompress = _DECOMPRESSORS[fmt]
+        self._fmt = fmt
+        self._size = size
+        self._queue = six.moves.queue.Queue(queue_size)
+        self._stopped = threading.Event()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except six.moves.queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for output in self._decompress(self._chunks, self._size):
+                if not self._put(output):
+                    return
+        except _ERRORS as e:
+            self._put(DecompressionError('Invalid {} stream: {}'.format(
+                self._fmt, e)))
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(_STOP)
+
+    def __iter__(self):
+        """Run the stage.
+
+        :raises: DecompressionError if the compressed stream is invalid.
+        :raises: Any exception raised while producing the compressed chunks.
+        :returns: A generator of decompressed pieces.
+        """
+        thread = threading.Thread(target=self._run,
+                                  name='image-decompress')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._stopped.set()
+            thread.join()
@@ -12,9 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import contextlib
+import errno
+import functools
 import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
+import random
 import tempfile
+import threading
 import time
 
 from ironic_lib import disk_utils
@@ -22,19 +30,42 @@ from ironic_lib import exception
 from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log
+from oslo_utils import excutils
+from oslo_utils import units
 import requests
 import six
 from six.moves.urllib import parse as urlparse
 
+from ironic_python_agent import decompress
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import base
 from ironic_python_agent import hardware
+from ironic_python_agent import image_cache
+from ironic_python_agent import image_writer
+from ironic_python_agent import qcow2
+from ironic_python_agent import segment_hash
 from ironic_python_agent import utils
 
 CONF = cfg.CONF
 LOG = log.getLogger(__name__)
 
 IMAGE_CHUNK_SIZE = 1024 * 1024  # 1MB
+RANGE_SIZE = 16 * 1024 * 1024  # 16MB
+# Period over which the throughput is measured to decide on switching URLs.
+THROUGHPUT_WINDOW = 10  # seconds
+# Period over which the peak throughput of a download is measured.
+PEAK_WINDOW = 1  # seconds
+# Timeout of the requests of the pre-flight checks of an image.
+PREFLIGHT_TIMEOUT = 10  # seconds
+# Timeout of the requests probing a mirror, which are not retried.
+PROBE_TIMEOUT = 10  # seconds
+
+WRITE_PROGRESS_INTERVAL = 30  # seconds
+
+# The GPT partition entries, in addition to the MBR and the GPT header of
+# one logical block each at the start of a device and the backup GPT header
+# at its end, see https://bugs.launchpad.net/ironic-python-agent/+bug/1737556
+_GPT_ENTRIES_SIZE = 16 * 1024
 
 
 def _image_location(image_info):
@@ -56,23 +87,83 @@ def _path_to_script(script):
     return os.path.join(cwd, '..', script)
 
 
-def _download_with_proxy(image_info, url, image_id):
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_session():
+    """Get the HTTP session shared by all downloads.
+
+    Connections are kept alive in a pool per host, so that checksum, image
+    and configdrive requests to the same server, as well as retries and
+    byte ranges, avoid repeating the DNS lookup and the TCP and TLS
+    handshakes.
+
+    :returns: A requests.Session object.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=CONF.image_download_pool_connections,
+                pool_maxsize=CONF.image_download_pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSION = session
+    return _SESSION
+
+
+def _get_proxies(image_info, url):
+    """Get the proxies to use for a URL.
+
+    :param image_info: Image information dictionary.
+    :param url: The URL string to request.
+    :returns: A dictionary of proxies for requests. The ``no_proxy`` value
+              of the image is passed on for requests to apply it to the
+              proxies from the environment.
+    """
+    proxies = dict(image_info.get('proxies', {}))
+    no_proxy = image_info.get('no_proxy')
+    if no_proxy:
+        if requests.utils.should_bypass_proxies(url, no_proxy=no_proxy):
+            proxies = {}
+        proxies['no_proxy'] = no_proxy
+    return proxies
+
+
+def _download_with_proxy(image_info, url, image_id, headers=None,
+                         retries=None, timeout=None):
     """Opens a download stream for the given URL.
 
     :param image_info: Image information dictionary.
     :param url: The URL string to request the image from.
     :param image_id: Image ID or URL for logging.
+    :param headers: Optional dictionary of additional HTTP headers. If it
+                    contains a ``Range`` header, a 206 response is expected.
+    :param retries: The number of retries, defaults to
+                    CONF.image_download_connection_retries.
+    :param timeout: The timeout of the request, defaults to
+                    CONF.image_download_connection_timeout.
 
     :raises: ImageDownloadError if the download stream was not started
              properly.
     """
-    no_proxy = image_info.get('no_proxy')
-    if no_proxy:
-        os.environ['no_proxy'] = no_proxy
-    proxies = image_info.get('proxies', {})
+    proxies = _get_proxies(image_info, url)
     verify, cert = utils.get_ssl_client_options(CONF)
+    kwargs = {}
+    expected_status = 200
+    if headers:
+        kwargs['headers'] = headers
+        if 'Range' in headers:
+            expected_status = 206
+    if retries is None:
+        retries = CONF.image_download_connection_retries
+    if timeout is None:
+        timeout = CONF.image_download_connection_timeout
+    session = _get_session()
     resp = None
-    for attempt in range(CONF.image_download_connection_retries + 1):
+    for attempt in range(retries + 1):
         try:
             # NOTE(TheJulia) The get request below does the following:
             # * Performs dns lookups, if necessary
@@ -87,16 +178,16 @@ def _download_with_proxy(image_info, url, image_id):
             # exactly just as the timeout value exists. The risk in transitory
             # failure is more so once we've started the download and we are
             # processing the incoming data.
-            resp = requests.get(url, stream=True, proxies=proxies,
-                                verify=verify, cert=cert,
-                                timeout=CONF.image_download_connection_timeout)
-            if resp.status_code != 200:
-                msg = ('Received status code {} from {}, expected 200. '
+            resp = session.get(url, stream=True, proxies=proxies,
+                               verify=verify, cert=cert, timeout=timeout,
+                               **kwargs)
+            if resp.status_code != expected_status:
+                msg = ('Received status code {} from {}, expected {}. '
                        'Response body: {}').format(resp.status_code, url,
-                                                   resp.text)
+                                                   expected_status, resp.text)
                 raise errors.ImageDownloadError(image_id, msg)
         except (errors.ImageDownloadError, requests.RequestException) as e:
-            if (attempt == CONF.image_download_connection_retries
+            if (attempt == retries
                     # NOTE(dtantsur): do not retry 4xx status codes
                     or (resp and resp.status_code < 500)):
                 raise
@@ -109,15 +200,102 @@ def _download_with_proxy(image_info, url, image_id):
     return resp
 
 
+def _fetch_configdrive(configdrive):
+    """Fetch the configdrive from a remote location, if needed.
+
+    :param configdrive: Base64 encoded gzipped configdrive content, its HTTP
+                        URL or None.
+    :returns: The configdrive content for ironic-lib, or None.
+    """
+    if not configdrive or not (configdrive.startswith('http://')
+                               or configdrive.startswith('https://')):
+        return configdrive
+
+    LOG.debug('Downloading configdrive from %s', configdrive)
+    # The image proxies do not apply, like with ironic-lib fetching it.
+    content = _download_with_proxy({}, configdrive, configdrive).content
+    try:
+        # ironic-lib expects the base64 encoded content as a string.
+        return content.decode('ascii')
+    except UnicodeDecodeError:
+        LOG.debug('Configdrive %s is not base64 encoded, leaving it to '
+                  'ironic-lib to download it', configdrive)
+        return configdrive
+
+
+class _ConfigdriveFetch(object):
+    """Fetches a configdrive on a separate thread.
+
+    This way a remote configdrive is downloaded while the image is being
+    written, and only writing it to the device remains afterwards.
+    """
+
+    def __init__(self, configdrive):
+        """Start fetching the configdrive.
+
+        :param configdrive: Base64 encoded gzipped configdrive content, its
+                            HTTP URL or None.
+        """
+        self.seconds = None
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._fetch,
+                                        args=(configdrive,),
+                                        name='configdrive-fetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fetch(self, configdrive):
+        started = time.time()
+        try:
+            self._result = _fetch_configdrive(configdrive)
+        except Exception as e:
+            self._error = e
+        self.seconds = time.time() - started
+
+    def get(self):
+        """Wait for the configdrive.
+
+        :raises: ImageDownloadError if downloading the configdrive failed.
+        :returns: The configdrive content for ironic-lib, or None.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def join(self):
+        """Wait for the fetch to finish, discarding its result.
+
+        A download in progress cannot be interrupted, this way it at least
+        does not outlive the command that started it.
+        """
+        self._thread.join()
+
+
+def _is_remote_checksum(checksum):
+    return checksum.startswith('http://') or checksum.startswith('https://')
+
+
+def _download_checksums(checksum, image_info):
+    """Download a checksums file and return its non-empty lines."""
+    LOG.debug('Downloading checksums file from %s', checksum)
+    resp = _download_with_proxy(image_info, checksum, checksum).text
+    return [line.strip() for line in resp.split('\n') if line.strip()]
+
+
+def _image_file_name(image_info):
+    # FIXME(dtantsur): can we assume the same name for all images?
+    return os.path.basename(urlparse.urlparse(image_info['urls'][0]).path)
+
+
 def _fetch_checksum(checksum, image_info):
     """Fetch checksum from remote location, if needed."""
-    if not (checksum.startswith('http://') or checksum.startswith('https://')):
+    if not _is_remote_checksum(checksum):
         # Not a remote checksum, return as it is.
         return checksum
 
-    LOG.debug('Downloading checksums file from %s', checksum)
-    resp = _download_with_proxy(image_info, checksum, checksum).text
-    lines = [line.strip() for line in resp.split('\n') if line.strip()]
+    lines = _download_checksums(checksum, image_info)
     if not lines:
         raise errors.ImageDownloadError(checksum, "Empty checksum file")
     elif len(lines) == 1:
@@ -125,9 +303,7 @@ def _fetch_checksum(checksum, image_info):
         if ' ' not in lines[0]:
             return lines[0]
 
-    # FIXME(dtantsur): can we assume the same name for all images?
-    expected_fname = os.path.basename(
-        urlparse.urlparse(image_info['urls'][0]).path)
+    expected_fname = _image_file_name(image_info)
     for line in lines:
         checksum, fname = line.strip().split(None, 1)
         # The star symbol designates binary mode, which is the same as text
@@ -139,7 +315,173 @@ def _fetch_checksum(checksum, image_info):
         checksum, "Checksum file does not contain name %s" % expected_fname)
 
 
-def _write_partition_image(image, image_info, device):
+def _get_hash_source(image_info):
+    """Determine the hash algorithm and checksum used to verify an image.
+
+    Falls back to md5 if the algorithm is not set or not supported.
+
+    :param image_info: Image information dictionary.
+    :raises: RESTError if the image cannot be verified.
+    :returns: A tuple (hash factory, checksum or URL of a checksums file).
+    """
+    algo = image_info.get('os_hash_algo')
+    if algo and algo in hashlib.algorithms_available:
+        hash_factory = functools.partial(hashlib.new, algo)
+        expected = image_info.get('os_hash_value')
+    elif image_info.get('checksum'):
+        hash_factory = hashlib.md5
+        expected = image_info['checksum']
+    else:
+        message = ('Unable to verify image {} with available checksums. '
+                   'Please make sure the specified \'os_hash_algo\' '
+                   '(currently {}) is supported by this ramdisk, or '
+                   'provide a md5 checksum via the \'checksum\' '
+                   'field'.format(image_info['id'],
+                                  image_info.get('os_hash_algo')))
+        LOG.error(message)
+        raise errors.RESTError(details=message)
+
+    return hash_factory, expected
+
+
+def _get_expected_hash(image_info):
+    """Determine the hash algorithm and value used to verify an image.
+
+    :param image_info: Image information dictionary.
+    :raises: RESTError if the image cannot be verified.
+    :raises: ImageDownloadError if fetching a remote checksum fails.
+    :returns: A tuple (hash factory, expected hex digest).
+    """
+    hash_factory, checksum = _get_hash_source(image_info)
+    return hash_factory, _fetch_checksum(checksum, image_info)
+
+
+def _fetch_segment_manifest(image_info):
+    """Fetch the segment manifest of an image from its checksums file.
+
+    :param image_info: Image information dictionary.
+    :raises: ImageDownloadError if fetching the checksums file fails.
+    :returns: A list of segment_hash.Segment tuples, or None if the image
+              has no valid manifest.
+    """
+    checksum = _get_hash_source(image_info)[1]
+    if not _is_remote_checksum(checksum):
+        LOG.warning('Image %s has no checksums file with a segment manifest, '
+                    'verifying it in a single thread', image_info['id'])
+        return None
+
+    try:
+        segments = segment_hash.parse_manifest(
+            _download_checksums(checksum, image_info),
+            _image_file_name(image_info))
+    except ValueError as e:
+        LOG.warning('Invalid segment manifest in %(url)s, verifying image '
+                    '%(image)s in a single thread: %(error)s',
+                    {'url': checksum, 'image': image_info['id'], 'error': e})
+        return None
+    if not segments:
+        LOG.warning('Checksums file %(url)s has no segments for image '
+                    '%(image)s, verifying it in a single thread',
+                    {'url': checksum, 'image': image_info['id']})
+        return None
+    LOG.info('Verifying image %(image)s in %(count)d segments',
+             {'image': image_info['id'], 'count': len(segments)})
+    return segments
+
+
+def _checksums_compressed(image_info):
+    """Check whether the checksum of an image covers its compressed form."""
+    return bool(image_info.get('compression')) and image_info.get(
+        'compressed_checksum', CONF.image_compressed_checksum)
+
+
+def _get_image_cache(image_info, expected_hash=None):
+    """Get the image cache and the key of an image in it.
+
+    :param image_info: Image information dictionary.
+    :param expected_hash: Optional result of _get_expected_hash, to avoid
+                          fetching a remote checksum again.
+    :returns: A tuple (cache, key, expected hash), the cache is None if
+              caching is disabled or the image cannot be cached.
+    """
+    cache = image_cache.get_cache()
+    if cache is None:
+        return None, None, expected_hash
+    if expected_hash is None:
+        expected_hash = _get_expected_hash(image_info)
+    if _checksums_compressed(image_info):
+        # The cache holds decompressed images, which cannot be verified
+        # against the checksum of the compressed stream.
+        LOG.warning('Not caching image %s, its checksum covers the '
+                    'compressed image', image_info['id'])
+        return None, None, expected_hash
+    key = image_cache.cache_key(expected_hash[0]().name, expected_hash[1])
+    if key is None:
+        LOG.warning('Not caching image %s, its checksum cannot be used as '
+                    'a cache key', image_info['id'])
+        return None, None, expected_hash
+    return cache, key, expected_hash
+
+
+def _is_image_cached(image_info, expected_hash=None):
+    """Check whether an image is in the image cache.
+
+    :param image_info: Image information dictionary.
+    :param expected_hash: Optional result of _get_expected_hash, to avoid
+                          fetching a remote checksum again.
+    :returns: True if the cache is enabled and has an entry for the image.
+    """
+    cache, key, _expected_hash = _get_image_cache(image_info, expected_hash)
+    return cache is not None and cache.contains(key)
+
+
+def _peer_urls(image_info, expected_hash):
+    """Get the URLs of an image on the peers listed in image_info.
+
+    Peers are other agents serving their image cache. They are returned in
+    random order to spread the load between them.
+
+    :param image_info: Image information dictionary.
+    :param expected_hash: The result of _get_expected_hash.
+    :returns: A list of URLs.
+    """
+    peers = list(image_info.get('peers') or ())
+    if not peers:
+        return []
+    key = image_cache.cache_key(expected_hash[0]().name, expected_hash[1])
+    if key is None:
+        return []
+    random.shuffle(peers)
+    return ['{}/v1/images/{}'.format(peer.rstrip('/'), key)
+            for peer in peers]
+
+
+def _link_image(path, image_location):
+    """Make the image location point to a cached image.
+
+    :param path: The path of the cache entry.
+    :param image_location: The location of the image, see _image_location.
+    """
+    if os.path.lexists(image_location):
+        os.unlink(image_location)
+    os.symlink(path, image_location)
+
+
+def _check_root_size(image_mb, root_mb):
+    """Check that an image fits into the root partition.
+
+    :param image_mb: The virtual size of the image in MiB.
+    :param root_mb: The size of the root partition in MiB.
+    :raises: InvalidCommandParamsError if the partition is too small.
+    """
+    if image_mb > int(root_mb):
+        msg = ('Root partition is too small for requested image. Image '
+               'virtual size: {} MB, Root size: {} MB').format(image_mb,
+                                                               root_mb)
+        raise errors.InvalidCommandParamsError(msg)
+
+
+def _write_partition_image(image, image_info, device, configdrive_fetch=None):
     """Call disk_util to create partition and write the partition image.
 
     :param image: Local path to image file to be written to the partition.
@@ -147,6 +489,8 @@ def _write_partition_image(image, image_info, device):
     :param image_info: Image information dictionary.
     :param device: The device name, as a string, on which to store the image.
                    Example: '/dev/sda'
+    :param configdrive_fetch: Optional _ConfigdriveFetch already fetching
+        ``image_info['configdrive']``, otherwise it is fetched here.
 
     :raises: InvalidCommandParamsError if the partition is too small for the
              provided image.
@@ -154,7 +498,10 @@ def _write_partition_image(image, image_info, device):
     """
     node_uuid = image_info.get('node_uuid')
     preserve_ep = image_info['preserve_ephemeral']
-    configdrive = image_info['configdrive']
+    if configdrive_fetch is not None:
+        configdrive = configdrive_fetch.get()
+    else:
+        configdrive = _fetch_configdrive(image_info['configdrive'])
     boot_option = image_info.get('boot_option', 'netboot')
     boot_mode = image_info.get('deploy_boot_mode', 'bios')
     disk_label = image_info.get('disk_label', 'msdos')
@@ -163,12 +510,7 @@ def _write_partition_image(image, image_info, device):
     cpu_arch = hardware.dispatch_to_managers('get_cpus').architecture
 
     if image is not None:
-        image_mb = disk_utils.get_image_mb(image)
-        if image_mb > int(root_mb):
-            msg = ('Root partition is too small for requested image. Image '
-                   'virtual size: {} MB, Root size: {} MB').format(image_mb,
-                                                                   root_mb)
-            raise errors.InvalidCommandParamsError(msg)
+        _check_root_size(disk_utils.get_image_mb(image), root_mb)
 
     try:
         return disk_utils.work_on_disk(device, root_mb,
@@ -186,18 +528,185 @@ def _write_partition_image(image, image_info, device):
         raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
 
 
+def _grow_filesystem(partition):
+    """Grow the filesystem on a partition to fill the partition.
+
+    ext2/3/4, XFS and Btrfs filesystems are grown, others are left as they
+    are with a warning.
+
+    :param partition: The partition holding the filesystem.
+    :raises: ImageWriteError if growing the filesystem fails.
+    """
+    try:
+        fstype, _err = utils.execute('blkid', '-o', 'value', '-s', 'TYPE',
+                                     partition, check_exit_code=[0, 2])
+        fstype = fstype.strip()
+        LOG.info('Growing the %(fstype)s filesystem on %(partition)s',
+                 {'fstype': fstype or 'unknown', 'partition': partition})
+        if fstype in ('ext2', 'ext3', 'ext4'):
+            # resize2fs insists on a freshly checked filesystem, e2fsck
+            # exits with 1 when it has fixed something.
+            utils.execute('e2fsck', '-f', '-y', partition,
+                          check_exit_code=[0, 1])
+            utils.execute('resize2fs', partition)
+        elif fstype in ('xfs', 'btrfs'):
+            # Both can only be grown while mounted.
+            path = tempfile.mkdtemp()
+            utils.execute('mount', partition, path)
+            try:
+                if fstype == 'xfs':
+                    utils.execute('xfs_growfs', path)
+                else:
+                    utils.execute('btrfs', 'filesystem', 'resize', 'max',
+                                  path)
+            finally:
+                utils.execute('umount', path)
+                os.rmdir(path)
+        else:
+            LOG.warning('Cannot grow the %(fstype)s filesystem on '
+                        '%(partition)s, it keeps the size of the image',
+                        {'fstype': fstype or 'unknown',
+                         'partition': partition})
+    except processutils.ProcessExecutionError as e:
+        raise errors.ImageWriteError(partition, e.exit_code, e.stdout,
+                                     e.stderr)
+
+
+class _WriteProgress(object):
+    """Periodically logs the progress of writing an image."""
+
+    def __init__(self, device, total, interval=WRITE_PROGRESS_INTERVAL):
+        self.device = device
+        self.total = total
+        self.written = 0
+        self._interval = interval
+        self._started = self._logged = time.time()
+
+    def update(self, nbytes):
+        self.written += nbytes
+        now = time.time()
+        if now - self._logged >= self._interval:
+            self._logged = now
+            LOG.info('Written %(written)d of %(total)d bytes (%(percent)d%%) '
+                     'of the image to %(device)s, %(rate).2f MiB/s',
+                     {'written': self.written, 'total': self.total,
+                      'percent': 100 * self.written // max(self.total, 1),
+                      'device': self.device,
+                      'rate': self.written / (now - self._started)
+                      / units.Mi})
+
+
+def _wipe_partition_tables(device):
+    """Zero the MBR and both copies of the GPT on a device."""
+    with open(device, 'rb+') as f:
+        block_size = image_writer.get_logical_block_size(f.fileno())
+        span = 2 * block_size + _GPT_ENTRIES_SIZE
+        zeros = b'\0' * span
+        f.write(zeros)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size >= 2 * span:
+            f.seek(size - span)
+            f.write(zeros)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_device(device):
+    fd = os.open(device, os.O_WRONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy_image(image, f, progress):
+    with open(image, 'rb') as src:
+        while True:
+            chunk = src.read(CONF.image_direct_io_size)
+            if not chunk:
+                return
+            f.write(chunk)
+            progress.update(len(chunk))
+
+
+def _write_whole_disk_image_in_agent(image, image_info, device):
+    """Writes a raw or qcow2 whole disk image without write_image.sh.
+
+    Raw images are written through the same writers as streamed images,
+    so direct I/O and the sparse policy apply to them. qcow2 images are
+    converted with qcow2.StreamConverter. Only the device is synced
+    afterwards.
+
+    :param image: Local path to image file to be written to the disk.
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string, on which to store the image.
+    :raises: ImageWriteError if writing the image fails.
+    :returns: False if the image cannot be written by the agent, nothing
+              has been written to the device in that case.
+    """
+    with open(image, 'rb') as f:
+        header = f.read(qcow2.HEADER_SIZE)
+    try:
+        qcow2.read_virtual_size(header)
+        disk_format = 'qcow2'
+    except qcow2.Qcow2Error:
+        disk_format = image_info.get('disk_format')
+    if disk_format != 'raw' and disk_format != 'qcow2':
+        LOG.info('Image %(image)s in format %(format)s cannot be written '
+                 'by the agent', {'image': image_info['id'],
+                                  'format': disk_format})
+        return False
+
+    progress = _WriteProgress(device, os.path.getsize(image))
+    try:
+        # Old partition tables must not survive, e.g. a backup GPT past
+        # the end of the image.
+        _wipe_partition_tables(device)
+        if disk_format == 'qcow2':
+            converter = qcow2.StreamConverter(
+                device, spill_dir=CONF.image_spill_dir)
+            try:
+                _copy_image(image, converter, progress)
+                converter.finish()
+            finally:
+                converter.close()
+        else:
+            with _open_device(image_info, device) as f:
+                _copy_image(image, f, progress)
+            _fsync_device(device)
+    except qcow2.UnsupportedImageError as e:
+        LOG.info('Image %(image)s cannot be converted by the agent: '
+                 '%(error)s', {'image': image_info['id'], 'error': e})
+        return False
+    except qcow2.Qcow2Error as e:
+        raise errors.ImageWriteError(device, errno.EINVAL, '', str(e))
+    except (OSError, IOError) as e:
+        raise errors.ImageWriteError(device, e.errno, '', str(e))
+    LOG.info('Wrote %(size)d bytes of image %(image)s to %(device)s',
+             {'size': progress.written, 'image': image_info['id'],
+              'device': device})
+    return True
+
+
 def _write_whole_disk_image(image, image_info, device):
     """Writes a whole disk image to the specified device.
 
+    The image is written by the agent if enabled by ``write_in_agent`` in
+    image_info or the image_write_in_agent option, and supported for the
+    image. Otherwise it is written by write_image.sh.
+
     :param image: Local path to image file to be written to the disk.
     :param image_info: Image information dictionary.
-                       This parameter is currently unused by the function.
     :param device: The device name, as a string, on which to store the image.
                    Example: '/dev/sda'
 
     :raises: ImageWriteError if the command to write the image encounters an
              error.
     """
+    if (image_info.get('write_in_agent', CONF.image_write_in_agent)
+            and _write_whole_disk_image_in_agent(image, image_info, device)):
+        return
     script = _path_to_script('shell/write_image.sh')
     command = ['/bin/bash', script, image, device]
     LOG.info('Writing image with command: {}'.format(' '.join(command)))
@@ -207,12 +716,14 @@ def _write_whole_disk_image(image, image_info, device):
         raise errors.ImageWriteError(device, e.exit_code, e.stdout, e.stderr)
 
 
-def _write_image(image_info, device):
+def _write_image(image_info, device, configdrive_fetch=None):
     """Writes an image to the specified device.
 
     :param image_info: Image information dictionary.
     :param device: The disk name, as a string, on which to store the image.
                    Example: '/dev/sda'
+    :param configdrive_fetch: Optional _ConfigdriveFetch of the configdrive
+                              of a partition image.
     :raises: ImageWriteError if the command to write the image encounters an
              error.
     """
@@ -220,7 +731,8 @@ def _write_image(image_info, device):
     image = _image_location(image_info)
     uuids = {}
     if image_info.get('image_type') == 'partition':
-        uuids = _write_partition_image(image, image_info, device)
+        uuids = _write_partition_image(image, image_info, device,
+                                       configdrive_fetch)
     else:
         _write_whole_disk_image(image, image_info, device)
     totaltime = time.time() - starttime
@@ -261,15 +773,658 @@ def _message_format(msg, image_info, device, partition_uuids):
     return message
 
 
+class _MirrorProbe(object):
+    """The result of probing a URL of an image."""
+
+    def __init__(self, url, ttfb=None, throughput=None, error=None):
+        self.url = url
+        self.ttfb = ttfb
+        self.throughput = throughput
+        self.error = error
+
+    def __str__(self):
+        if self.throughput is None:
+            return '{} failed: {}'.format(self.url, self.error)
+        return '{} TTFB {:.3f}s, {:.2f} MiB/s'.format(
+            self.url, self.ttfb, self.throughput / units.Mi)
+
+
+def _probe_mirror(image_info, url, offset):
+    """Measure the time to first byte and the throughput of a URL.
+
+    :param image_info: Image information dictionary.
+    :param url: The URL of the image.
+    :param offset: The offset to probe at. The server must support byte
+                   ranges if it is not zero.
+    :returns: A _MirrorProbe object.
+    """
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
+    start = time.time()
+    try:
+        # A slow or unreachable mirror must not hold up the others.
+        resp = _download_with_proxy(image_info, url, image_info['id'],
+                                    headers=headers, retries=0,
+                                    timeout=PROBE_TIMEOUT)
+    except (errors.ImageDownloadError, requests.RequestException) as e:
+        return _MirrorProbe(url, error=e)
+
+    ttfb = time.time() - start
+    received = 0
+    try:
+        for chunk in resp.iter_content(64 * units.Ki):
+            received += len(chunk)
+            if received >= CONF.image_download_probe_size:
+                break
+    except requests.RequestException as e:
+        return _MirrorProbe(url, error=e)
+    finally:
+        resp.close()
+    elapsed = max(time.time() - start - ttfb, 1e-6)
+    return _MirrorProbe(url, ttfb=ttfb, throughput=received / elapsed)
+
+
+def _race_mirrors(image_info, urls, offset=0):
+    """Probe URLs concurrently and rank them by throughput.
+
+    :param image_info: Image information dictionary.
+    :param urls: The URLs of the image.
+    :param offset: The offset to probe at.
+    :returns: A list of _MirrorProbe objects, fastest first. Failed probes
+              follow in the original order.
+    """
+    pool = ThreadPool(len(urls))
+    try:
+        results = [pool.apply_async(_probe_mirror, (image_info, url, offset))
+                   for url in urls]
+        probes = []
+        for url, result in zip(urls, results):
+            try:
+                probes.append(result.get(
+                    CONF.image_download_connection_timeout))
+            except Exception as e:
+                probes.append(_MirrorProbe(url, error=e))
+    finally:
+        pool.terminate()
+
+    ranked = sorted((p for p in probes if p.throughput is not None),
+                    key=lambda p: (-p.throughput, p.ttfb))
+    ranked += [p for p in probes if p.throughput is None]
+    LOG.info('Mirror race for image %(image)s at byte %(offset)d: '
+             '%(probes)s', {'image': image_info['id'], 'offset': offset,
+                            'probes': '; '.join(str(p) for p in ranked)})
+    return ranked
+
+
+def _supports_ranges(resp):
+    """Check whether a response advertises byte range support.
+
+    :param resp: A requests.Response object.
+    :returns: The size of the resource in bytes if the server accepts byte
+              range requests for it, None otherwise.
+    """
+    accept_ranges = resp.headers.get('Accept-Ranges')
+    if not isinstance(accept_ranges, six.string_types):
+        return None
+    if accept_ranges.strip().lower() != 'bytes':
+        return None
+    try:
+        return int(resp.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _head_image(image_info, url):
+    """Get the size, ETag and byte range support of an image.
+
+    :param image_info: Image information dictionary.
+    :param url: The URL of the image.
+    :raises: ImageDownloadError if the server does not respond with 200.
+    :raises: RequestException if the request fails.
+    :returns: A dictionary with the ``url``, ``size`` and ``etag`` of the
+              image, the latter two may be None, and whether the server
+              supports byte ``ranges``.
+    """
+    verify, cert = utils.get_ssl_client_options(CONF)
+    resp = _get_session().head(url, proxies=_get_proxies(image_info, url),
+                               verify=verify, cert=cert,
+                               timeout=PREFLIGHT_TIMEOUT,
+                               allow_redirects=True)
+    if resp.status_code != 200:
+        raise errors.ImageDownloadError(
+            image_info['id'], 'Received status code {} from {}'.format(
+                resp.status_code, url))
+    try:
+        size = int(resp.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        size = None
+    return {'url': url, 'size': size, 'etag': resp.headers.get('ETag'),
+            'ranges': _supports_ranges(resp) is not None}
+
+
+def _read_image_header(image_info, url):
+    """Read the first bytes of an image.
+
+    :param image_info: Image information dictionary.
+    :param url: The URL of the image.
+    :raises: ImageDownloadError if the server responds with an error.
+    :raises: RequestException if the request fails.
+    :returns: Up to qcow2.HEADER_SIZE bytes from the start of the image.
+    """
+    verify, cert = utils.get_ssl_client_options(CONF)
+    resp = _get_session().get(
+        url, stream=True, proxies=_get_proxies(image_info, url),
+        verify=verify, cert=cert, timeout=PREFLIGHT_TIMEOUT,
+        headers={'Range': 'bytes=0-{}'.format(qcow2.HEADER_SIZE - 1)})
+    try:
+        # A server not supporting byte ranges sends the whole image.
+        if resp.status_code not in (200, 206):
+            raise errors.ImageDownloadError(
+                image_info['id'], 'Received status code {} from {}'.format(
+                    resp.status_code, url))
+        header = b''
+        for chunk in resp.iter_content(qcow2.HEADER_SIZE):
+            header += chunk
+            if len(header) >= qcow2.HEADER_SIZE:
+                break
+        return header[:qcow2.HEADER_SIZE]
+    finally:
+        resp.close()
+
+
+def _check_image_header(image_info, header, size):
+    """Check the format and the virtual size of an image.
+
+    The virtual size of an uncompressed raw image is the size of the file,
+    as reported by the Content-Length of the response to a HEAD request.
+
+    :param image_info: Image information dictionary.
+    :param header: The first bytes of the image.
+    :param size: The size of the image file, or None if the server did not
+                 report it, the virtual size of a raw image is unknown then.
+    :raises: InvalidCommandParamsError if the image does not match
+             image_info.
+    :returns: The virtual size of the image, or None if it is unknown.
+    """
+    compression = image_info.get('compression')
+    detected = decompress.detect(header)
+    if detected != compression:
+        if compression:
+            msg = 'Image is not compressed with {}'.format(compression)
+        else:
+            msg = ('Image is compressed with {}, but its \'compression\' '
+                   'is not set').format(detected)
+        raise errors.InvalidCommandParamsError(msg)
+    if compression:
+        # The format of the image is hidden inside the compressed stream.
+        return None
+
+    disk_format = image_info.get('disk_format')
+    is_qcow2 = header.startswith(qcow2.QCOW2_MAGIC)
+    if disk_format == 'qcow2' and not is_qcow2:
+        raise errors.InvalidCommandParamsError(
+            'Image {} is not a qcow2 image'.format(image_info['id']))
+    if disk_format == 'raw' and is_qcow2:
+        raise errors.InvalidCommandParamsError(
+            'Image {} is a qcow2 image, not a raw one'.format(
+                image_info['id']))
+
+    if is_qcow2:
+        try:
+            return qcow2.read_virtual_size(header)
+        except qcow2.Qcow2Error as e:
+            raise errors.InvalidCommandParamsError(
+                'Image {} is invalid: {}'.format(image_info['id'], e))
+    elif disk_format == 'raw':
+        return size
+    return None
+
+
+def _remaining(deadline):
+    """Get the number of seconds left until a deadline, at least 0."""
+    return max(0, deadline - time.time())
+
+
+def _preflight_image(image_info):
+    """Check an image before downloading it.
+
+    The image URLs are probed with HEAD requests, the header of the image is
+    read to check its format and virtual size and the checksum is fetched,
+    all concurrently, so that a deployment that is bound to fail does so
+    before anything is transferred. All of them share a deadline of
+    PREFLIGHT_TIMEOUT seconds.
+
+    :param image_info: Image information dictionary.
+    :raises: ImageDownloadError if no image URL is reachable or the checksum
+             cannot be fetched.
+    :raises: InvalidCommandParamsError if the image does not match
+             image_info or does not fit into the root partition.
+    :returns: A dictionary with the results of the checks, the fetched
+              checksum is returned as ``expected_hash``, see
+              _get_expected_hash.
+    """
+    started = time.time()
+    deadline = started + PREFLIGHT_TIMEOUT
+    urls = list(image_info['urls'])
+    pool = ThreadPool(len(urls) + 2)
+    try:
+        heads = [pool.apply_async(_head_image, (image_info, url))
+                 for url in urls]
+        header_result = pool.apply_async(_read_image_header,
+                                         (image_info, urls[0]))
+        checksum = pool.apply_async(_get_expected_hash, (image_info,))
+
+        reachable = []
+        failures = []
+        for url, result in zip(urls, heads):
+            try:
+                reachable.append(result.get(_remaining(deadline)))
+            except Exception as e:
+                LOG.warning('Pre-flight request to %(url)s failed: %(error)s',
+                            {'url': url, 'error': e})
+                failures.append('{}: {}'.format(url, e))
+        if not reachable:
+            raise errors.ImageDownloadError(
+                image_info['id'], 'None of the image URLs is reachable: '
+                '{}'.format('; '.join(failures)))
+        if len(set((head['size'], head['etag']) for head in reachable)) > 1:
+            LOG.warning('The URLs of image %(image)s serve different '
+                        'files: %(heads)s', {'image': image_info['id'],
+                                             'heads': reachable})
+
+        # The checksum is needed for the deployment, failing to fetch it
+        # is fatal.
+        try:
+            expected_hash = checksum.get(_remaining(deadline))
+        except errors.RESTError:
+            raise
+        except multiprocessing.TimeoutError:
+            raise errors.ImageDownloadError(
+                image_info['id'], 'Fetching the checksum from {} timed out '
+                'after {} seconds'.format(_get_hash_source(image_info)[1],
+                                          PREFLIGHT_TIMEOUT))
+        except Exception as e:
+            raise errors.ImageDownloadError(
+                image_info['id'], 'Unable to fetch the checksum from {}: '
+                '{}'.format(_get_hash_source(image_info)[1], e))
+
+        try:
+            header = header_result.get(_remaining(deadline))
+        except Exception as e:
+            LOG.warning('Unable to read the header of image %(image)s, not '
+                        'checking its format: %(error)s',
+                        {'image': image_info['id'], 'error': e})
+            virtual_size = None
+        else:
+            virtual_size = _check_image_header(image_info, header,
+                                               reachable[0]['size'])
+    finally:
+        pool.terminate()
+
+    declared = image_info.get('virtual_size')
+    if (declared is not None and virtual_size is not None
+            and int(declared) != virtual_size):
+        raise errors.InvalidCommandParamsError(
+            'Image {} has a virtual size of {} bytes, not {} as '
+            'declared'.format(image_info['id'], virtual_size, declared))
+    if virtual_size is None and declared is not None:
+        virtual_size = int(declared)
+    if (virtual_size is not None
+            and image_info.get('image_type') == 'partition'):
+        _check_root_size((virtual_size + units.Mi - 1) // units.Mi,
+                         image_info['root_mb'])
+
+    result = {'size': reachable[0]['size'], 'etag': reachable[0]['etag'],
+              'ranges': reachable[0]['ranges'],
+              'virtual_size': virtual_size,
+              'reachable_urls': [head['url'] for head in reachable],
+              'seconds': time.time() - started}
+    LOG.info('Pre-flight checks of image %(image)s passed in %(time).2f '
+             'seconds: %(result)s', {'image': image_info['id'],
+                                     'time': result['seconds'],
+                                     'result': result})
+    result['expected_hash'] = expected_hash
+    return result
+
+
+class _RangeDownload(object):
+    """Fetches an image as byte ranges over several concurrent connections.
+
+    Ranges are requested in parallel through the shared HTTP session and
+    handed back in order, so that consumers (and the hash calculation) see
+    the same stream as with a single connection. At most ``connections``
+    ranges are kept in memory at any time.
+    """
+
+    def __init__(self, image_info, url, size, connections, range_size,
+                 resp=None, start=0):
+        """Initialize an instance of the _RangeDownload class.
+
+        :param image_info: Image information dictionary.
+        :param url: The URL to fetch the ranges from.
+        :param size: The size of the image in bytes.
+        :param connections: The number of concurrent connections to use.
+        :param range_size: The size of a single range in bytes.
+        :param resp: Optional already opened response starting at ``start``.
+                     It is used for the first attempt to read the first
+                     range and closed afterwards.
+        :param start: The byte offset to start downloading from.
+        """
+        self._image_info = image_info
+        self._url = url
+        self._resp = resp
+        self._start = start
+        self._ranges = [(first, min(first + range_size, size) - 1)
+                        for first in range(start, size, range_size)]
+        self._connections = min(connections, len(self._ranges))
+
+    def _read_first_range(self, length):
+        resp, self._resp = self._resp, None
+        data = bytearray()
+        try:
+            for chunk in resp.iter_content(IMAGE_CHUNK_SIZE):
+                data.extend(chunk)
+                if len(data) >= length:
+                    break
+        finally:
+            resp.close()
+        return bytes(data[:length])
+
+    def _fetch_range(self, start, end):
+        headers = {'Range': 'bytes={}-{}'.format(start, end)}
+        length = end - start + 1
+        for attempt in range(CONF.image_download_connection_retries + 1):
+            try:
+                if start == self._start and self._resp is not None:
+                    # The first attempt of the first range reads from the
+                    # response the download was opened with.
+                    data = self._read_first_range(length)
+                else:
+                    # Retried here, together with incomplete responses.
+                    resp = _download_with_proxy(self._image_info, self._url,
+                                                self._image_info['id'],
+                                                headers=headers, retries=0)
+                    data = resp.content
+                if len(data) != length:
+                    raise errors.ImageDownloadError(
+                        self._image_info['id'],
+                        'Received {} bytes for range {}-{} from {}, '
+                        'expected {}'.format(len(data), start, end,
+                                             self._url, length))
+                return data
+            except (errors.ImageDownloadError,
+                    requests.RequestException) as e:
+                if attempt == CONF.image_download_connection_retries:
+                    raise errors.ImageDownloadError(
+                        self._image_info['id'],
+                        'Unable to download range {}-{}: {}'.format(
+                            start, end, e))
+                LOG.warning('Unable to download range %(start)s-%(end)s of '
+                            'image %(image)s, retrying. Error: %(error)s',
+                            {'start': start, 'end': end, 'error': e,
+                             'image': self._image_info['id']})
+                time.sleep(CONF.image_download_connection_retry_interval)
+
+    def __iter__(self):
+        """Downloads the ranges and returns the image in chunks.
+
+        :returns: A chunk of the image, in the order of the image.
+        """
+        LOG.info('Downloading image %(image)s from %(url)s in %(count)d '
+                 'ranges over %(conn)d connections',
+                 {'image': self._image_info['id'], 'url': self._url,
+                  'count': len(self._ranges), 'conn': self._connections})
+        pool = ThreadPool(self._connections)
+        pending = collections.deque()
+        ranges = iter(self._ranges)
+        try:
+            for start, end in ranges:
+                pending.append(pool.apply_async(self._fetch_range,
+                                                (start, end)))
+                if len(pending) >= self._connections:
+                    break
+
+            while pending:
+                data = pending.popleft().get()
+                for start, end in ranges:
+                    pending.append(pool.apply_async(self._fetch_range,
+                                                    (start, end)))
+                    break
+                view = memoryview(data)
+                for offset in range(0, len(data), IMAGE_CHUNK_SIZE):
+                    yield view[offset:offset + IMAGE_CHUNK_SIZE]
+        finally:
+            pool.terminate()
+            self.close()
+
+    def close(self):
+        """Close the response of the first range, if it is still open."""
+        if self._resp is not None:
+            self._resp.close()
+
+
+class _TokenBucket(object):
+    """Limits the rate of image downloads.
+
+    The bucket of the agent is shared by all downloads, so that its limit
+    applies to the agent as a whole, each download has a bucket for the
+    limit of its image too. A bucket holds at most one second worth of
+    tokens, and waits are capped to one second, so that a rate change
+    takes effect quickly.
+    """
+
+    def __init__(self, rate=0):
+        """Create the bucket.
+
+        :param rate: The rate in bytes per second, 0 for no limit.
+        """
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._tokens = 0
+        self._updated = time.time()
+
+    @property
+    def rate(self):
+        """The rate in bytes per second, 0 for no limit."""
+        return self._rate
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self._tokens + (now - self._updated) * self._rate,
+                           self._rate)
+        self._updated = now
+
+    def set_rate(self, rate):
+        """Change the rate, taking effect for waits in progress too."""
+        with self._lock:
+            self._refill()
+            self._rate = rate
+            self._tokens = min(self._tokens, rate)
+
+    def consume(self, nbytes):
+        """Wait until a number of bytes may be downloaded."""
+        with self._lock:
+            if not self._rate:
+                return
+            self._refill()
+            self._tokens -= nbytes
+        while True:
+            with self._lock:
+                if not self._rate:
+                    return
+                self._refill()
+                deficit = -self._tokens
+                rate = self._rate
+            if deficit <= 0:
+                return
+            time.sleep(min(deficit / rate, 1))
+
+
+_RATE_LIMITER = _TokenBucket()
+# The rate limit in KiB/s set at runtime, it takes precedence over the
+# configured limit of the agent and the limits of the images.
+_RATE_LIMIT_OVERRIDE = None
+
+
+def set_rate_limit(rate_limit):
+    """Set the download rate limit of this agent.
+
+    :param rate_limit: The rate in KiB/s, 0 for no limit.
+    """
+    LOG.info('Setting the image download rate limit to %s',
+             '{} KiB/s'.format(rate_limit) if rate_limit else 'unlimited')
+    _RATE_LIMITER.set_rate(rate_limit * units.Ki)
+
+
+def override_rate_limit(rate_limit):
+    """Set the download rate limit of this agent at runtime.
+
+    The limit applies to the downloads in progress and to all following
+    downloads, regardless of the configured limit and the limits in their
+    image information.
+
+    :param rate_limit: The rate in KiB/s, 0 for no limit, or None to
+                       return to the configured limit and the limits of
+                       the images.
+    """
+    global _RATE_LIMIT_OVERRIDE
+
+    _RATE_LIMIT_OVERRIDE = rate_limit
+    if rate_limit is None:
+        LOG.info('Image downloads are rate limited by the image '
+                 'information or the configuration again')
+        set_rate_limit(CONF.image_download_rate_limit)
+    else:
+        set_rate_limit(rate_limit)
+
+
+def _agent_rate_limit():
+    """Get the download rate limit of this agent as a whole in KiB/s."""
+    if _RATE_LIMIT_OVERRIDE is not None:
+        return _RATE_LIMIT_OVERRIDE
+    return CONF.image_download_rate_limit
+
+
+class _DownloadTimings(object):
+    """Timings and throughput of an image download."""
+
+    def __init__(self, started):
+        self.started = started
+        self.connect = 0.0
+        self.first_byte = None
+        self.bytes = 0
+        self.hash = 0.0
+        self.write = 0.0
+        self.retries = 0
+        self._last_byte = None
+        self._peak = 0.0
+        self._window_start = None
+        self._window_bytes = 0
+
+    def received(self, nbytes):
+        """Account for a received chunk."""
+        now = time.time()
+        if self.first_byte is None:
+            self.first_byte = now - self.started
+            self._window_start = now
+        self._last_byte = now
+        self.bytes += nbytes
+        self._window_bytes += nbytes
+        elapsed = now - self._window_start
+        if elapsed >= PEAK_WINDOW:
+            self._peak = max(self._peak, self._window_bytes / elapsed)
+            self._window_start = now
+            self._window_bytes = 0
+
+    def as_dict(self):
+        elapsed = (self._last_byte or time.time()) - self.started
+        throughput = self.bytes / elapsed if elapsed else None
+        return {'connect_seconds': self.connect,
+                'first_byte_seconds': self.first_byte,
+                'seconds': elapsed,
+                'bytes': self.bytes,
+                'bytes_per_second': throughput,
+                'peak_bytes_per_second': max(self._peak, throughput or 0),
+                'hash_seconds': self.hash,
+                'write_seconds': self.write,
+                'retries': self.retries}
+
+
+class _PhaseTimer(object):
+    """Collects the durations of the phases of a deployment command."""
+
+    def __init__(self):
+        self._started = time.time()
+        self.phases = {}
+        self.download = None
+
+    def add(self, name, seconds):
+        """Add time spent in a phase, phases may be entered repeatedly."""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase, also when it fails."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def add_download(self, image_download):
+        """Add the timings of an image download.
+
+        :param image_download: An ImageDownload instance, or None if the
+                               image has not been downloaded.
+        """
+        if image_download is None:
+            return
+        self.download = image_download.timings.as_dict()
+        self.add('hash', self.download['hash_seconds'])
+        if self.download['write_seconds']:
+            self.add('write', self.download['write_seconds'])
+
+    def as_dict(self):
+        return {'total_seconds': time.time() - self._started,
+                'phases': dict(self.phases),
+                'download': self.download}
+
+
 class ImageDownload(object):
     """Helper class that opens a HTTP connection to download an image.
 
     This class opens a HTTP connection to download an image from a URL
     and create an iterator so the image can be downloaded in chunks. The
     MD5 hash of the image being downloaded is calculated on-the-fly.
+
+    If ``download_connections`` in the image information is greater than 1
+    and the server supports byte ranges, the image is fetched in ranges of
+    ``download_range_size`` bytes over that many concurrent connections.
+
+    Agents listed in ``peers`` in the image information are tried before
+    the ``urls``, see :func:`_peer_urls`.
+
+    If ``verify_workers`` in the image information (or
+    ``[DEFAULT]image_verify_workers``) is set and the checksums file has a
+    segment manifest, the image is verified segment by segment on that many
+    threads instead, see :mod:`ironic_python_agent.segment_hash`.
+
+    If ``compression`` in the image information is set, the image is
+    decompressed on a separate thread while it is downloaded, see
+    :mod:`ironic_python_agent.decompress`. The checksum (and the segment
+    manifest) covers the compressed image unless ``compressed_checksum``
+    in the image information (or ``[DEFAULT]image_compressed_checksum``)
+    is False. Either way the iterator returns decompressed data.
+
+    The download is rate limited to ``download_rate_limit`` KiB/s in the
+    image information, other downloads are not affected by that limit. All
+    downloads of the agent together are limited to
+    ``[DEFAULT]image_download_rate_limit`` KiB/s. A limit set at runtime
+    replaces both, see :func:`override_rate_limit`.
+
+    Timings of the download are collected in the ``timings`` attribute.
     """
 
-    def __init__(self, image_info, time_obj=None):
+    def __init__(self, image_info, time_obj=None, expected_hash=None):
         """Initialize an instance of the ImageDownload class.
 
         Trys each URL in image_info successively until a URL returns a
@@ -283,6 +1438,8 @@ class ImageDownload(object):
                          download began. Defaults to None. If None, then
                          time.time() will be used to find the start time of
                          the download.
+        :param expected_hash: Optional result of _get_expected_hash, to avoid
+                              fetching a remote checksum again.
 
         :raises: ImageDownloadError if starting the image download fails for
                  any reason.
@@ -291,45 +1448,75 @@ class ImageDownload(object):
         self._last_chunk_time = None
         self._image_info = image_info
         self._request = None
-
-        # Determine the hash algorithm and value will be used for calculation
-        # and verification, fallback to md5 if algorithm is not set or not
-        # supported.
-        algo = image_info.get('os_hash_algo')
-        if algo and algo in hashlib.algorithms_available:
-            self._hash_algo = hashlib.new(algo)
-            self._expected_hash_value = image_info.get('os_hash_value')
-        elif image_info.get('checksum'):
-            try:
-                self._hash_algo = hashlib.md5()
-            except ValueError as e:
-                message = ('Unable to proceed with image {} as the legacy '
-                           'checksum indicator has been used, which makes use '
-                           'the MD5 algorithm. This algorithm failed to load '
-                           'due to the underlying operating system. Error: '
-                           '{}').format(image_info['id'], str(e))
-                LOG.error(message)
-                raise errors.RESTError(details=message)
-            self._expected_hash_value = image_info['checksum']
-        else:
-            message = ('Unable to verify image {} with available checksums. '
-                       'Please make sure the specified \'os_hash_algo\' '
-                       '(currently {}) is supported by this ramdisk, or '
-                       'provide a md5 checksum via the \'checksum\' '
-                       'field'.format(image_info['id'],
-                                      image_info.get('os_hash_algo')))
+        self._range_download = None
+        self._url = None
+        self._size = None
+        self._offset = 0
+        self.pipeline_stats = None
+        self.timings = _DownloadTimings(self._time)
+
+        if expected_hash is None:
+            expected_hash = _get_expected_hash(image_info)
+        self._hash_factory, self._expected_hash_value = expected_hash
+        self._compression = image_info.get('compression')
+        self._hash_compressed = _checksums_compressed(image_info)
+        self._urls = list(image_info['urls'])
+        if not self._compression:
+            # Peers serve decompressed images.
+            self._urls = _peer_urls(image_info, expected_hash) + self._urls
+        self._mirror_racing = image_info.get(
+            'mirror_racing', CONF.image_download_mirror_racing)
+        self._received = 0
+        # The configured limit of the agent may have changed.
+        _RATE_LIMITER.set_rate(_agent_rate_limit() * units.Ki)
+        self._rate_limiter = _TokenBucket(
+            int(image_info.get('download_rate_limit', 0)) * units.Ki)
+        try:
+            self._hash_algo = self._hash_factory()
+        except ValueError as e:
+            message = ('Unable to proceed with image {} as the legacy '
+                       'checksum indicator has been used, which makes use '
+                       'the MD5 algorithm. This algorithm failed to load '
+                       'due to the underlying operating system. Error: '
+                       '{}').format(image_info['id'], str(e))
             LOG.error(message)
             raise errors.RESTError(details=message)
 
-        self._expected_hash_value = _fetch_checksum(self._expected_hash_value,
-                                                    image_info)
-
+        self._verifier = None
+        workers = int(image_info.get('verify_workers',
+                                     CONF.image_verify_workers))
+        if workers:
+            segments = _fetch_segment_manifest(image_info)
+            if segments:
+                self._verifier = segment_hash.SegmentVerifier(
+                    image_info['id'], self._hash_factory, segments, workers,
+                    self._fetch_segment)
+        self._connect()
+
+    def _connect(self, offset=0, urls=None):
+        """Open the download stream, optionally starting at an offset.
+
+        :param offset: The byte offset to start the download from. A Range
+                       request is sent to the server if it is not zero.
+        :param urls: The URLs to try in order. Defaults to all URLs of the
+                     image, ranked by a mirror race if it is enabled.
+        :raises: ImageDownloadError if none of the URLs could be opened.
+        """
+        image_info = self._image_info
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else None
         details = []
-        for url in image_info['urls']:
+        if urls is None:
+            urls = self._urls
+            if self._mirror_racing and len(urls) > 1:
+                urls = [probe.url for probe in
+                        _race_mirrors(image_info, urls, offset)]
+        for url in urls:
+            started = time.time()
             try:
                 LOG.info("Attempting to download image from {}".format(url))
                 self._request = _download_with_proxy(image_info, url,
-                                                     image_info['id'])
+                                                     image_info['id'],
+                                                     headers=headers)
             except errors.ImageDownloadError as e:
                 failtime = time.time() - self._time
                 log_msg = ('URL: {}; time: {} '
@@ -344,12 +1531,185 @@ class ImageDownload(object):
             details = '\n '.join(details)
             raise errors.ImageDownloadError(image_info['id'], details)
 
+        # Covers name resolution, connecting, the TLS handshake and waiting
+        # for the response headers.
+        self.timings.connect += time.time() - started
+        self._url = url
+        self._last_chunk_time = time.time()
+        self._received = offset
+        self._range_download = None
+        if not offset:
+            self._size = _supports_ranges(self._request)
+
+        connections = int(image_info.get('download_connections', 1))
+        if connections > 1:
+            range_size = int(image_info.get('download_range_size',
+                                            RANGE_SIZE))
+            if (self._size is not None
+                    and self._size - offset > range_size):
+                self._range_download = _RangeDownload(
+                    image_info, url, self._size, connections, range_size,
+                    resp=self._request, start=offset)
+            else:
+                LOG.info('Server %s does not support byte ranges or the '
+                         'image is smaller than one range, downloading '
+                         'over a single connection', url)
+
+    @property
+    def size(self):
+        """The size of the image, if reported by the server."""
+        return self._size
+
+    @property
+    def offset(self):
+        """The number of bytes of the image consumed by the caller.
+
+        Only chunks that the caller has finished processing (i.e. it asked
+        for the next chunk) are accounted for, both here and in the hash.
+        """
+        return self._offset
+
+    def resume(self):
+        """Re-open the download after a failure.
+
+        If the server supports byte ranges, the download continues from
+        :attr:`offset` and the hash state is kept. Otherwise the download
+        starts over and the hash is reset, in which case :attr:`offset`
+        drops to zero and the caller has to rewrite the image from the
+        beginning. Compressed images always start over, as the offset is
+        not known in the compressed stream.
+
+        :raises: ImageDownloadError if the download could not be re-opened.
+        """
+        self.close()
+        self.timings.retries += 1
+        if (self._offset and self._size is not None
+                and not self._compression):
+            LOG.info('Resuming download of image %(image)s at byte '
+                     '%(offset)d of %(size)d',
+                     {'image': self._image_info['id'],
+                      'offset': self._offset, 'size': self._size})
+        else:
+            if self._offset:
+                LOG.warning('Image server does not support byte ranges or '
+                            'the image is compressed, restarting the '
+                            'download of image %s from the beginning',
+                            self._image_info['id'])
+            self._offset = 0
+            self._hash_algo = self._hash_factory()
+        offset = self._offset
+        if self._verifier is not None:
+            # Segments are verified as a whole.
+            offset = self._verifier.segment_start(offset)
+        self._connect(offset)
+
+    def close(self):
+        """Close the connection(s) to the image server."""
+        if self._range_download is not None:
+            self._range_download.close()
+        elif self._request is not None:
+            self._request.close()
+
     def __iter__(self):
         """Downloads and returns the next chunk of the image.
 
         :returns: A chunk of the image. Size of chunk is IMAGE_CHUNK_SIZE
                   which is a constant in this module.
         """
+        for chunk in self._iter_chunks():
+            yield chunk
+            # Only account for the chunk once the caller has asked for the
+            # next one, i.e. it has been written out. This way a retry can
+            # safely resume from self._offset.
+            self._account(chunk)
+
+    def _account(self, chunk):
+        """Add a processed chunk to the hash and the offset."""
+        if self._verifier is None and not self._hash_compressed:
+            started = time.time()
+            self._hash_algo.update(chunk)
+            self.timings.hash += time.time() - started
+        self._offset += len(chunk)
+
+    def _iter_chunks(self):
+        """Returns the decompressed chunks of the image, without hashing.
+
+        With a segment manifest, chunks are returned only once their segment
+        has been verified. If the checksum covers the compressed image, it
+        is calculated here before decompression.
+        """
+        chunks = self._iter_limited()
+        if self._hash_compressed:
+            if self._verifier is not None:
+                chunks = self._verifier.verify(chunks)
+            else:
+                chunks = self._iter_hashed(chunks)
+            return self._decompress(chunks)
+
+        if self._compression:
+            chunks = self._decompress(chunks)
+        if self._verifier is not None:
+            chunks = self._verifier.verify(chunks, self._offset)
+        return chunks
+
+    def _rate_limited(self):
+        """Check whether the download is rate limited."""
+        return bool(_RATE_LIMITER.rate or (_RATE_LIMIT_OVERRIDE is None
+                                           and self._rate_limiter.rate))
+
+    def _iter_limited(self):
+        """Returns the chunks of the image within the rate limit."""
+        for chunk in self._iter_received():
+            self.timings.received(len(chunk))
+            if _RATE_LIMIT_OVERRIDE is None:
+                self._rate_limiter.consume(len(chunk))
+            _RATE_LIMITER.consume(len(chunk))
+            yield chunk
+
+    def _iter_hashed(self, chunks):
+        """Adds chunks of the compressed image to the hash."""
+        for chunk in chunks:
+            started = time.time()
+            self._hash_algo.update(chunk)
+            self.timings.hash += time.time() - started
+            yield chunk
+
+    def _decompress(self, chunks):
+        """Decompresses chunks of the image on a separate thread."""
+        stage = decompress.DecompressionStage(chunks, self._compression,
+                                              IMAGE_CHUNK_SIZE)
+        try:
+            for chunk in stage:
+                yield chunk
+        except decompress.DecompressionError as e:
+            raise errors.ImageDownloadError(self._image_info['id'], str(e))
+
+    def _fetch_segment(self, start, end):
+        """Fetch a segment of the image again.
+
+        :returns: The data of the segment, or None if the server does not
+                  support byte ranges or the segment is in the decompressed
+                  image.
+        """
+        if self._size is None or (self._compression
+                                  and not self._hash_compressed):
+            return None
+        return _download_with_proxy(
+            self._image_info, self._url, self._image_info['id'],
+            headers={'Range': 'bytes={}-{}'.format(start, end)}).content
+
+    def _iter_received(self):
+        """Returns the chunks of the image as they arrive."""
+        if self._range_download is not None:
+            for chunk in self._range_download:
+                yield chunk
+            return
+
+        min_throughput = 0
+        if self._mirror_racing and len(self._urls) > 1:
+            min_throughput = CONF.image_download_min_throughput * units.Ki
+        window_start = time.time()
+        window_bytes = 0
         for chunk in self._request.iter_content(IMAGE_CHUNK_SIZE):
             # Per requests forum posts/discussions, iter_content should
             # periodically yield to the caller for the client to do things
@@ -361,7 +1721,8 @@ class ImageDownload(object):
             # this code.
             if chunk:
                 self._last_chunk_time = time.time()
-                self._hash_algo.update(chunk)
+                self._received += len(chunk)
+                window_bytes += len(chunk)
                 yield chunk
             elif (time.time() - self._last_chunk_time
                   > CONF.image_download_connection_timeout):
@@ -371,6 +1732,51 @@ class ImageDownload(object):
                     self._image_info['id'],
                     'Timed out reading next chunk from webserver')
 
+            if not min_throughput or self._rate_limited():
+                # A rate limited download is slow on purpose.
+                continue
+            elapsed = time.time() - window_start
+            if elapsed >= THROUGHPUT_WINDOW:
+                throughput = window_bytes / elapsed
+                if (throughput < min_throughput
+                        and self._switch_mirror(throughput)):
+                    # Continue from the new URL, which may also be
+                    # downloaded over several connections.
+                    for chunk in self._iter_received():
+                        yield chunk
+                    return
+                window_start = time.time()
+                window_bytes = 0
+
+    def _switch_mirror(self, throughput):
+        """Continue the download from a faster URL, if there is one.
+
+        :param throughput: The current throughput in bytes per second.
+        :returns: True if the download continues from another URL.
+        """
+        if self._size is None or self._received >= self._size:
+            return False
+        others = [url for url in self._urls if url != self._url]
+        probes = _race_mirrors(self._image_info, others, self._received)
+        best = probes[0]
+        if best.throughput is None or best.throughput <= throughput:
+            LOG.info('Throughput from %(url)s dropped to %(rate).2f MiB/s, '
+                     'but no faster URL was found, not switching',
+                     {'url': self._url, 'rate': throughput / units.Mi})
+            return False
+
+        LOG.info('Throughput from %(url)s dropped to %(rate).2f MiB/s, '
+                 'switching to %(new)s (%(new_rate).2f MiB/s) at byte '
+                 '%(offset)d', {'url': self._url,
+                                'rate': throughput / units.Mi,
+                                'new': best.url,
+                                'new_rate': best.throughput / units.Mi,
+                                'offset': self._received})
+        previous = self._url
+        self._request.close()
+        self._connect(self._received, urls=[best.url, previous])
+        return True
+
     def verify_image(self, image_location):
         """Verifies the checksum of the local images matches expectations.
 
@@ -382,6 +1788,29 @@ class ImageDownload(object):
         :raises: ImageChecksumError if the checksum of the local image does
                  not match the checksum as reported by glance in image_info.
         """
+        if self._verifier is not None:
+            # Every segment has been verified on its way to the caller.
+            if self._hash_compressed:
+                # The whole compressed stream has been verified before
+                # reaching the end of the decompressed image.
+                LOG.debug('Compressed image at %(location)s verified in '
+                          '%(count)d segments, %(refetched)d of them fetched '
+                          'again', {'location': image_location,
+                                    'count': len(self._verifier.segments),
+                                    'refetched': self._verifier.refetched})
+                return
+            if self._offset != self._verifier.size:
+                raise errors.ImageChecksumError(
+                    self._image_info['id'], image_location,
+                    '{} bytes'.format(self._verifier.size),
+                    '{} bytes'.format(self._offset))
+            LOG.debug('Image at %(location)s verified in %(count)d segments, '
+                      '%(refetched)d of them fetched again',
+                      {'location': image_location,
+                       'count': len(self._verifier.segments),
+                       'refetched': self._verifier.refetched})
+            return
+
         checksum = self._hash_algo.hexdigest()
         LOG.debug('Verifying image at {} against {} checksum '
                   '{}'.format(image_location, self._hash_algo.name, checksum))
@@ -395,52 +1824,327 @@ class ImageDownload(object):
                                             checksum)
 
 
-def _download_image(image_info):
+class _StageStats(object):
+    """Throughput counters of a single pipeline stage."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.busy = 0.0
+
+    def record(self, nbytes, started):
+        self.bytes += nbytes
+        self.busy += time.time() - started
+
+    def as_dict(self):
+        throughput = self.bytes / self.busy if self.busy else None
+        return {'bytes': self.bytes, 'busy_seconds': self.busy,
+                'bytes_per_second': throughput}
+
+
+class _ImagePipeline(object):
+    """Overlaps network receive, disk writes and hashing of an image.
+
+    A receiver thread copies incoming chunks into a bounded ring of reusable
+    buffers, the calling thread writes them out and a hashing thread feeds
+    them to the image hash before returning them to the ring. The memory
+    used is capped at ``buffers`` times IMAGE_CHUNK_SIZE.
+
+    Chunks are hashed only after they have been written, so that
+    ImageDownload.offset never runs ahead of the data on disk and an
+    interrupted download can be resumed.
+    """
+
+    _STOP = object()
+
+    def __init__(self, image_download, buffers):
+        """Initialize an instance of the _ImagePipeline class.
+
+        :param image_download: An ImageDownload instance.
+        :param buffers: The number of buffers in the ring.
+        """
+        self._image_download = image_download
+        self._free = six.moves.queue.Queue()
+        for _i in range(buffers):
+            self._free.put(bytearray(IMAGE_CHUNK_SIZE))
+        self._to_write = six.moves.queue.Queue()
+        self._to_hash = six.moves.queue.Queue()
+        self._stopped = threading.Event()
+        self.stats = {'receive': _StageStats(),
+                      'write': _StageStats(),
+                      'hash': _StageStats()}
+
+    def _get_free(self):
+        while not self._stopped.is_set():
+            try:
+                return self._free.get(timeout=1)
+            except six.moves.queue.Empty:
+                continue
+
+    def _receive(self):
+        stats = self.stats['receive']
+        try:
+            started = time.time()
+            for chunk in self._image_download._iter_chunks():
+                stats.record(len(chunk), started)
+                view = memoryview(chunk)
+                while view:
+                    buf = self._get_free()
+                    if buf is None:
+                        return
+                    length = min(len(view), len(buf))
+                    buf[:length] = view[:length]
+                    view = view[length:]
+                    self._to_write.put((buf, length))
+                started = time.time()
+        except Exception as e:
+            self._to_write.put(e)
+        else:
+            self._to_write.put(self._STOP)
+
+    def _hash(self):
+        stats = self.stats['hash']
+        while True:
+            item = self._to_hash.get()
+            if item is self._STOP:
+                return
+            buf, length = item
+            started = time.time()
+            try:
+                self._image_download._account(memoryview(buf)[:length])
+            except Exception as e:
+                self._stopped.set()
+                self._to_write.put(e)
+                return
+            stats.record(length, started)
+            self._free.put(buf)
+
+    def run(self, write):
+        """Run the pipeline until the image is fully processed.
+
+        :param write: A callable writing a chunk to the destination.
+        :raises: Any exception raised while receiving or writing the image.
+        """
+        receiver = threading.Thread(target=self._receive,
+                                    name='image-receive')
+        hasher = threading.Thread(target=self._hash, name='image-hash')
+        receiver.daemon = hasher.daemon = True
+        receiver.start()
+        hasher.start()
+        stats = self.stats['write']
+        received = False
+        try:
+            while True:
+                item = self._to_write.get()
+                if item is self._STOP:
+                    received = True
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                buf, length = item
+                started = time.time()
+                write(memoryview(buf)[:length])
+                stats.record(length, started)
+                self._to_hash.put(item)
+        finally:
+            self._stopped.set()
+            self._to_hash.put(self._STOP)
+            if not received:
+                # Interrupt the receiver if it is waiting for the network,
+                # a retry re-opens the download anyway.
+                self._image_download.close()
+            hasher.join()
+            receiver.join(CONF.image_download_connection_timeout)
+            if receiver.is_alive():
+                LOG.warning('The receiving thread of image %s did not stop',
+                            self._image_download._image_info['id'])
+            LOG.info('Image pipeline stage throughput: %s',
+                     ', '.join('{} {:.2f} MiB/s'.format(
+                         name, (stat.as_dict()['bytes_per_second'] or 0)
+                         / units.Mi)
+                         for name, stat in sorted(self.stats.items())))
+
+
+def _write_stream(image_download, f):
+    """Write a downloaded image into an open file.
+
+    If pipelining is enabled, the per-stage statistics are stored in the
+    ``pipeline_stats`` attribute of the ImageDownload. The time spent
+    writing is added to its timings.
+
+    :param image_download: An ImageDownload instance.
+    :param f: A file object opened for writing at the right offset.
+    """
+    if CONF.image_download_pipeline_buffers:
+        pipeline = _ImagePipeline(image_download,
+                                  CONF.image_download_pipeline_buffers)
+        try:
+            pipeline.run(f.write)
+        finally:
+            image_download.pipeline_stats = dict(
+                (name, stat.as_dict())
+                for name, stat in pipeline.stats.items())
+            image_download.timings.write += pipeline.stats['write'].busy
+        return
+
+    for chunk in image_download:
+        started = time.time()
+        f.write(chunk)
+        image_download.timings.write += time.time() - started
+
+
+def _open_device(image_info, device):
+    """Open a device for writing an image onto it.
+
+    Direct I/O is used if requested by ``direct_io`` in image_info or the
+    image_direct_io option, and supported by the device. Blocks of zeros
+    are handled according to ``sparse_policy`` in image_info or the
+    image_sparse_policy option.
+
+    :param image_info: Image information dictionary.
+    :param device: The device name, as a string, to open.
+    :returns: A file-like object supporting the context manager protocol.
+    """
+    f = None
+    if image_info.get('direct_io', CONF.image_direct_io):
+        try:
+            f = image_writer.DirectIOWriter(
+                device, io_size=CONF.image_direct_io_size,
+                queue_depth=CONF.image_direct_io_queue_depth)
+        except OSError as e:
+            LOG.warning('Unable to open %(device)s for direct I/O, falling '
+                        'back to buffered writes. Error: %(error)s',
+                        {'device': device, 'error': e})
+    if f is None:
+        f = open(device, 'wb+')
+
+    policy = image_info.get('sparse_policy', CONF.image_sparse_policy)
+    if policy == 'none':
+        return f
+    return image_writer.SparseWriter(
+        f, policy, block_size=CONF.image_sparse_block_size)
+
+
+def _read_back_image(image_info, device, size=None, expected_hash=None):
+    """Verify an image written to a device by reading it back, if enabled.
+
+    :param image_info: Image information dictionary.
+    :param device: The device the image has been written to.
+    :param size: The size of the image in bytes, defaults to the size of
+                 the local copy of the image.
+    :param expected_hash: Optional result of _get_expected_hash, to avoid
+                          fetching a remote checksum again.
+    :raises: ImageChecksumError if the data on the device does not match.
+    :raises: ImageWriteError if reading the device fails.
+    :returns: The read back statistics, or None if it is disabled.
+    """
+    readers = int(image_info.get('read_back_readers',
+                                 CONF.image_read_back_readers))
+    if not readers:
+        return None
+    if _checksums_compressed(image_info):
+        LOG.warning('Not reading back image %s, its checksum covers the '
+                    'compressed image', image_info['id'])
+        return None
+
+    if size is None:
+        size = os.path.getsize(_image_location(image_info))
+    if expected_hash is None:
+        expected_hash = _get_expected_hash(image_info)
+    hash_factory, expected = expected_hash
+    segments = _fetch_segment_manifest(image_info)
+    LOG.info('Reading back image %(image)s from device %(device)s with '
+             '%(readers)d readers', {'image': image_info['id'],
+                                     'device': device, 'readers': readers})
+    return segment_hash.read_back(device, size, hash_factory, expected,
+                                  segments=segments, readers=readers)
+
+
+def _download_image(image_info, expected_hash=None):
     """Downloads the specified image to the local file system.
 
     :param image_info: Image information dictionary.
+    :param expected_hash: Optional result of _get_expected_hash, to avoid
+                          fetching a remote checksum again.
     :raises: ImageDownloadError if the image download fails for any reason.
     :raises: ImageChecksumError if the downloaded image's checksum does not
              match the one reported in image_info.
+    :returns: The ImageDownload instance, or None if the image has been
+              found in the image cache.
     """
     starttime = time.time()
     image_location = _image_location(image_info)
-    for attempt in range(CONF.image_download_connection_retries + 1):
-        try:
-            image_download = ImageDownload(image_info, time_obj=starttime)
+    cache, key, expected_hash = _get_image_cache(image_info, expected_hash)
+    if cache is not None:
+        cached = cache.lookup(key, expected_hash[0])
+        if cached is not None:
+            _link_image(cached, image_location)
+            return None
+        download_location = cache.part_path(key)
+    else:
+        download_location = image_location
 
-            with open(image_location, 'wb') as f:
-                try:
-                    for chunk in image_download:
-                        f.write(chunk)
-                except Exception as e:
-                    msg = 'Unable to write image to {}. Error: {}'.format(
-                        image_location, str(e))
-                    raise errors.ImageDownloadError(image_info['id'], msg)
-        except errors.ImageDownloadError as e:
-            if attempt == CONF.image_download_connection_retries:
-                raise
+    total_retries = CONF.image_download_connection_retries
+    try:
+        image_download = None
+        for attempt in range(total_retries + 1):
+            try:
+                if image_download is None:
+                    image_download = ImageDownload(
+                        image_info, time_obj=starttime,
+                        expected_hash=expected_hash)
+                    if cache is not None and image_download.size:
+                        cache.evict(keep=key, needed=image_download.size)
+                else:
+                    image_download.resume()
+
+                offset = image_download.offset
+                mode = 'r+b' if offset else 'wb'
+                with open(download_location, mode) as f:
+                    try:
+                        if offset:
+                            f.seek(offset)
+                            f.truncate()
+                        _write_stream(image_download, f)
+                    except Exception as e:
+                        msg = ('Unable to write image to {}. Error: '
+                               '{}').format(download_location, str(e))
+                        raise errors.ImageDownloadError(image_info['id'],
+                                                        msg)
+            except errors.ImageDownloadError as e:
+                if attempt == total_retries:
+                    raise
+                else:
+                    LOG.warning('Image download failed, %(attempt)s of '
+                                '%(total)s: %(error)s',
+                                {'attempt': attempt, 'total': total_retries,
+                                 'error': e})
+                    time.sleep(CONF.image_download_connection_retry_interval)
             else:
-                LOG.warning('Image download failed, %(attempt)s of %(total)s: '
-                            '%(error)s',
-                            {'attempt': attempt,
-                             'total': CONF.image_download_connection_retries,
-                             'error': e})
-                time.sleep(CONF.image_download_connection_retry_interval)
-        else:
-            break
+                break
 
-    totaltime = time.time() - starttime
-    LOG.info("Image downloaded from {} in {} seconds".format(image_location,
-                                                             totaltime))
-    image_download.verify_image(image_location)
+        totaltime = time.time() - starttime
+        LOG.info("Image downloaded from {} in {} seconds".format(
+            download_location, totaltime))
+        image_download.verify_image(download_location)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            if cache is not None:
+                # Do not leave a partial download behind, it would count
+                # against the size of the cache.
+                cache.remove_part(key)
+    if cache is not None:
+        _link_image(cache.add(key), image_location)
+    return image_download
 
 
 def _validate_image_info(ext, image_info=None, **kwargs):
     """Validates the image_info dictionary has all required information.
 
-    :param ext: Object 'self'. Unused by this function directly, but left for
-                compatibility with async_command validation.
+    If the image is checked before downloading it, the fetched checksum is
+    stored in the ``preflight_hash`` attribute of the extension, see
+    StandbyExtension._get_expected_hash.
+
+    :param ext: Object 'self'.
     :param image_info: Image information dictionary.
     :param kwargs: Additional keyword arguments. Unused, but here for
                    compatibility with async_command validation.
@@ -488,6 +2192,67 @@ def _validate_image_info(ext, image_info=None, **kwargs):
             'or the \'os_hash_algo\' and \'os_hash_value\' fields pair must '
             'be set for image verification.')
 
+    for field in ['download_connections', 'download_range_size',
+                  'verify_workers', 'read_back_readers', 'virtual_size']:
+        if field in image_info:
+            try:
+                value = int(image_info[field])
+            except (TypeError, ValueError):
+                value = 0
+            if value < 1:
+                raise errors.InvalidCommandParamsError(
+                    'Image \'{}\' must be a positive integer.'.format(field))
+
+    compression = image_info.get('compression')
+    if compression is not None:
+        if compression not in decompress.FORMATS:
+            raise errors.InvalidCommandParamsError(
+                'Image \'compression\' must be one of {}.'.format(
+                    ', '.join(decompress.FORMATS)))
+        if not decompress.is_supported(compression):
+            raise errors.InvalidCommandParamsError(
+                'Image compression {} is not supported by this '
+                'ramdisk.'.format(compression))
+
+    if 'download_rate_limit' in image_info:
+        _validate_rate_limit(image_info['download_rate_limit'],
+                             'Image \'download_rate_limit\'')
+
+    peers = image_info.get('peers')
+    if peers is not None and (
+            not isinstance(peers, list)
+            or not all(isinstance(peer, six.string_types)
+                       for peer in peers)):
+        raise errors.InvalidCommandParamsError(
+            'Image \'peers\' must be a list of URLs.')
+
+    if ('sparse_policy' in image_info and image_info['sparse_policy']
+            not in image_writer.SPARSE_POLICIES):
+        raise errors.InvalidCommandParamsError(
+            'Image \'sparse_policy\' must be one of {}.'.format(
+                ', '.join(image_writer.SPARSE_POLICIES)))
+
+    if image_info.get('preflight', CONF.image_preflight):
+        result = _preflight_image(image_info)
+        ext.preflight_hash = (image_info['id'], result['expected_hash'])
+
+
+def _validate_rate_limit(rate_limit, name):
+    """Validate a download rate limit.
+
+    :param rate_limit: The rate limit in KiB/s.
+    :param name: The name of the value for the error message.
+    :raises: InvalidCommandParamsError if the rate limit is not a
+             non-negative integer.
+    """
+    try:
+        value = int(rate_limit)
+    except (TypeError, ValueError):
+        value = -1
+    if value < 0:
+        raise errors.InvalidCommandParamsError(
+            '{} must be a non-negative integer.'.format(name))
+
 
 def _validate_partitioning(device):
     """Validate the final partition table.
@@ -506,6 +2271,7 @@ def _validate_partitioning(device):
                     "after writing the image, the partitioning table may "
                     "be broken. Error: %(error)s",
                     {'device': device, 'error': e})
+    hardware.refresh_block_devices()
 
     try:
         nparts = len(disk_utils.list_partitions(device))
@@ -534,6 +2300,34 @@ class StandbyExtension(base.BaseAgentExtension):
 
         self.cached_image_id = None
         self.partition_uuids = None
+        self.write_stats = None
+        self.read_back_stats = None
+        self.timings = _PhaseTimer()
+        self.preflight_hash = None
+        self._expected_hash = None
+        self._configdrive_fetch = None
+
+    def _start_command(self):
+        """Reset the state collected by the previous command."""
+        self.timings = _PhaseTimer()
+        # Only the pre-flight checks of the current command are valid.
+        self._expected_hash, self.preflight_hash = self.preflight_hash, None
+        self._configdrive_fetch = None
+
+    def _get_expected_hash(self, image_info):
+        """Get the expected hash of an image.
+
+        A remote checksum is fetched at most once per command, the one
+        fetched by the pre-flight checks of the command is reused.
+
+        :param image_info: Image information dictionary.
+        :returns: The result of _get_expected_hash.
+        """
+        if (self._expected_hash is None
+                or self._expected_hash[0] != image_info['id']):
+            self._expected_hash = (image_info['id'],
+                                   _get_expected_hash(image_info))
+        return self._expected_hash[1]
 
     def _cache_and_write_image(self, image_info, device):
         """Cache an image and write it to a local device.
@@ -547,9 +2341,23 @@ class StandbyExtension(base.BaseAgentExtension):
                   match the one reported in image_info.
         :raises: ImageWriteError if writing the image fails.
         """
-        _download_image(image_info)
-        self.partition_uuids = _write_image(image_info, device)
+        expected_hash = self._get_expected_hash(image_info)
+        with self.timings.phase('download'):
+            self.timings.add_download(_download_image(image_info,
+                                                      expected_hash))
+        # Partition images are written while partitioning the device.
+        phase = ('partitioning' if image_info.get('image_type') == 'partition'
+                 else 'write')
+        with self.timings.phase(phase):
+            self.partition_uuids = _write_image(
+                image_info, device, configdrive_fetch=self._configdrive_fetch)
         self.cached_image_id = image_info['id']
+        # Only raw whole disk images are written to the device as is.
+        if (image_info.get('image_type') != 'partition'
+                and image_info.get('disk_format') == 'raw'):
+            with self.timings.phase('read_back'):
+                self.read_back_stats = _read_back_image(
+                    image_info, device, expected_hash=expected_hash)
 
     def _stream_raw_image_onto_device(self, image_info, device):
         """Streams raw image data to specified local device.
@@ -564,18 +2372,34 @@ class StandbyExtension(base.BaseAgentExtension):
         """
         starttime = time.time()
         total_retries = CONF.image_download_connection_retries
+        image_download = None
+        write_stats = {'bytes_written': 0, 'bytes_skipped': 0}
         for attempt in range(total_retries + 1):
+            f = None
             try:
-                image_download = ImageDownload(image_info, time_obj=starttime)
+                if image_download is None:
+                    image_download = ImageDownload(
+                        image_info, time_obj=starttime,
+                        expected_hash=self._get_expected_hash(image_info))
+                else:
+                    image_download.resume()
 
-                with open(device, 'wb+') as f:
+                with _open_device(image_info, device) as f:
                     try:
-                        for chunk in image_download:
-                            f.write(chunk)
+                        if image_download.offset:
+                            f.seek(image_download.offset)
+                        _write_stream(image_download, f)
+                    except errors.ImageWriteError:
+                        # Data accepted by the writer may be lost, resuming
+                        # from the current offset is not safe.
+                        raise
                     except Exception as e:
                         msg = ('Unable to write image to device {}. '
                                'Error: {}').format(device, str(e))
                         raise errors.ImageDownloadError(image_info['id'], msg)
+                    closing = time.time()
+                # Closing the device flushes the remaining data.
+                self.timings.add('fsync', time.time() - closing)
             except errors.ImageDownloadError as e:
                 if attempt == CONF.image_download_connection_retries:
                     raise
@@ -588,12 +2412,168 @@ class StandbyExtension(base.BaseAgentExtension):
                     time.sleep(CONF.image_download_connection_retry_interval)
             else:
                 break
+            finally:
+                # The counters are final once the writer has been closed.
+                if isinstance(f, image_writer.SparseWriter):
+                    write_stats['sparse_policy'] = f.policy
+                    write_stats['bytes_written'] += f.bytes_written
+                    write_stats['bytes_skipped'] += f.bytes_skipped
 
         totaltime = time.time() - starttime
-        LOG.info("Image streamed onto device {} in {} "
-                 "seconds".format(device, totaltime))
+        LOG.info("Image streamed onto device {} in {} seconds, peak RSS "
+                 "{} MiB".format(device, totaltime,
+                                 image_writer.get_peak_rss() // units.Mi))
+        self.timings.add('download', totaltime)
+        self.timings.add_download(image_download)
         # Verify if the checksum of the streamed image is correct
         image_download.verify_image(device)
+        with self.timings.phase('read_back'):
+            self.read_back_stats = _read_back_image(
+                image_info, device, image_download.offset,
+                expected_hash=self._get_expected_hash(image_info))
+        if 'sparse_policy' in write_stats:
+            LOG.info('Wrote %(written)d bytes and skipped %(skipped)d bytes '
+                     'of zeros on device %(device)s',
+                     {'written': write_stats['bytes_written'],
+                      'skipped': write_stats['bytes_skipped'],
+                      'device': device})
+            self.write_stats = write_stats
+
+    def _stream_partition_image(self, image_info, device):
+        """Partitions a device and streams a partition image onto it.
+
+        The partition layout only depends on the sizes in image_info, the
+        image is checked to fit into the root partition by its declared
+        ``virtual_size``. Raw and qcow2 images are streamed onto the root
+        partition, without a local copy, and the filesystem is grown to
+        fill the partition afterwards.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+
+        :raises: InvalidCommandParamsError if the root partition is too small
+                 for the image.
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageChecksumError if the checksum of the local image does not
+             match the checksum as reported by glance in image_info.
+        :raises: ImageWriteError if partitioning, writing the image or growing
+                 the filesystem fails.
+        :returns: False if a qcow2 image cannot be converted while streaming,
+                  the device is partitioned but the image is not written in
+                  that case.
+        """
+        image_mb = ((int(image_info['virtual_size']) + units.Mi - 1)
+                    // units.Mi)
+        _check_root_size(image_mb, image_info['root_mb'])
+
+        with self.timings.phase('partitioning'):
+            self.partition_uuids = _write_partition_image(
+                None, image_info, device, self._configdrive_fetch)
+        root = self.partition_uuids['partitions']['root']
+        if image_info.get('disk_format') == 'qcow2':
+            if not self._stream_qcow2_image_onto_device(image_info, root):
+                return False
+        else:
+            self._stream_raw_image_onto_device(image_info, root)
+
+        with self.timings.phase('grow_filesystem'):
+            _grow_filesystem(root)
+        return True
+
+    def _stream_qcow2_image_onto_device(self, image_info, device):
+        """Converts a qcow2 image onto a device while downloading it.
+
+        :param image_info: Image information dictionary.
+        :param device: The disk name, as a string, on which to store the
+                       image.  Example: '/dev/sda'
+
+        :raises: ImageDownloadError if the image download encounters an error.
+        :raises: ImageChecksumError if the checksum of the local image does not
+             match the checksum as reported by glance in image_info.
+        :raises: ImageWriteError if the image is invalid or writing it fails.
+        :returns: False if the image cannot be converted while streaming,
+                  nothing has been written to the device in that case.
+        """
+        if image_info.get('image_type') != 'partition':
+            # Old partition tables must not survive, e.g. a backup GPT
+            # past the end of the image.
+            try:
+                _wipe_partition_tables(device)
+            except (OSError, IOError) as e:
+                raise errors.ImageWriteError(device, e.errno, '', str(e))
+
+        starttime = time.time()
+        total_retries = CONF.image_download_connection_retries
+        image_download = None
+        converter = qcow2.StreamConverter(device,
+                                          spill_dir=CONF.image_spill_dir)
+        try:
+            for attempt in range(total_retries + 1):
+                try:
+                    if image_download is None:
+                        image_download = ImageDownload(
+                            image_info, time_obj=starttime,
+                            expected_hash=self._get_expected_hash(
+                                image_info))
+                    else:
+                        image_download.resume()
+                        if not image_download.offset:
+                            # The download starts over, so must the
+                            # conversion. A new converter rewrites and
+                            # zeroes the whole device again.
+                            converter.close()
+                            converter = qcow2.StreamConverter(
+                                device, spill_dir=CONF.image_spill_dir)
+
+                    try:
+                        _write_stream(image_download, converter)
+                    except (errors.ImageWriteError, qcow2.Qcow2Error):
+                        # The converter has consumed part of the current
+                        # chunk, resuming would feed it twice.
+                        raise
+                    except Exception as e:
+                        msg = ('Unable to write image to device {}. '
+                               'Error: {}').format(device, str(e))
+                        raise errors.ImageDownloadError(image_info['id'], msg)
+                except errors.ImageDownloadError as e:
+                    if attempt == CONF.image_download_connection_retries:
+                        raise
+                    else:
+                        LOG.warning('Image download failed, %(attempt)s of '
+                                    '%(total)s: %(error)s',
+                                    {'attempt': attempt,
+                                     'total': total_retries,
+                                     'error': e})
+                        time.sleep(
+                            CONF.image_download_connection_retry_interval)
+                else:
+                    break
+            with self.timings.phase('fsync'):
+                converter.finish()
+        except qcow2.UnsupportedImageError as e:
+            LOG.info('Image %(image)s cannot be streamed onto device '
+                     '%(device)s, falling back to a local copy: %(error)s',
+                     {'image': image_info['id'], 'device': device,
+                      'error': e})
+            image_download.close()
+            return False
+        except qcow2.Qcow2Error as e:
+            raise errors.ImageWriteError(device, errno.EINVAL, '', str(e))
+        finally:
+            converter.close()
+
+        totaltime = time.time() - starttime
+        LOG.info("Image streamed onto device {} in {} seconds, peak RSS "
+                 "{} MiB".format(device, totaltime,
+                                 image_writer.get_peak_rss() // units.Mi))
+        self.timings.add('download', totaltime)
+        self.timings.add_download(image_download)
+        image_download.verify_image(device)
+        self.write_stats = {'bytes_written': converter.bytes_written,
+                            'bytes_zeroed': converter.bytes_zeroed,
+                            'bytes_spilled': converter.bytes_spilled}
+        return True
 
     @base.async_command('cache_image', _validate_image_info)
     def cache_image(self, image_info=None, force=False):
@@ -610,6 +2590,7 @@ class StandbyExtension(base.BaseAgentExtension):
         :raises: ImageWriteError if writing the image fails.
         """
         LOG.debug('Caching image %s', image_info['id'])
+        self._start_command()
         device = hardware.dispatch_to_managers('get_os_install_device')
 
         msg = 'image ({}) already present on device {} '
@@ -624,7 +2605,8 @@ class StandbyExtension(base.BaseAgentExtension):
                                      self.partition_uuids)
 
         LOG.info(result_msg)
-        return result_msg
+        return {'result': 'cache_image: {}'.format(result_msg),
+                'timings': self._report_timings(image_info)}
 
     @base.async_command('prepare_image', _validate_image_info)
     def prepare_image(self,
@@ -636,7 +2618,9 @@ class StandbyExtension(base.BaseAgentExtension):
         reboot to the image specified by image_info.
 
         Downloads and writes an image to disk if necessary. Also writes a
-        configdrive to disk if the configdrive parameter is specified.
+        configdrive to disk if the configdrive parameter is specified. A
+        remote configdrive is downloaded while the image is being downloaded
+        or written, for partition images it is the one in image_info.
 
         :param image_info: Image information dictionary.
         :param configdrive: A string containing the location of the config
@@ -652,47 +2636,114 @@ class StandbyExtension(base.BaseAgentExtension):
         """
         LOG.debug('Preparing image %s', image_info['id'])
         device = hardware.dispatch_to_managers('get_os_install_device')
+        self.write_stats = None
+        self.read_back_stats = None
+        self._start_command()
+        is_partition = image_info.get('image_type') == 'partition'
+        if not is_partition and configdrive is not None:
+            self._configdrive_fetch = _ConfigdriveFetch(configdrive)
+        elif (is_partition and self.cached_image_id != image_info['id']
+              and image_info.get('configdrive') is not None):
+            # ironic-lib writes it while partitioning the device, which
+            # comes after the download unless the image is streamed.
+            self._configdrive_fetch = _ConfigdriveFetch(
+                image_info['configdrive'])
 
-        disk_format = image_info.get('disk_format')
-        stream_raw_images = image_info.get('stream_raw_images', False)
-        # don't write image again if already cached
-        if self.cached_image_id != image_info['id']:
-            if self.cached_image_id is not None:
-                LOG.debug('Already had %s cached, overwriting',
-                          self.cached_image_id)
-
-            if stream_raw_images and disk_format == 'raw':
-                if image_info.get('image_type') == 'partition':
-                    self.partition_uuids = _write_partition_image(None,
-                                                                  image_info,
-                                                                  device)
-                    stream_to = self.partition_uuids['partitions']['root']
-                else:
-                    stream_to = device
-
-                self._stream_raw_image_onto_device(image_info, stream_to)
-            else:
-                self._cache_and_write_image(image_info, device)
-
-        _validate_partitioning(device)
-
-        # the configdrive creation is taken care by ironic-lib's
-        # work_on_disk().
-        if image_info.get('image_type') != 'partition':
-            if configdrive is not None:
-                # Will use dummy value of 'local' for 'node_uuid',
-                # if it is not available. This is to handle scenario
-                # wherein new IPA is being used with older version
-                # of Ironic that did not pass 'node_uuid' in 'image_info'
-                node_uuid = image_info.get('node_uuid', 'local')
-                disk_utils.create_config_drive_partition(node_uuid,
-                                                         device,
-                                                         configdrive)
+        try:
+            disk_format = image_info.get('disk_format')
+            stream_raw_images = image_info.get('stream_raw_images', False)
+            # don't write image again if already cached
+            if self.cached_image_id != image_info['id']:
+                if self.cached_image_id is not None:
+                    LOG.debug('Already had %s cached, overwriting',
+                              self.cached_image_id)
+
+                streamed = False
+                # The checksum is kept for the download, see
+                # _get_expected_hash.
+                if _is_image_cached(image_info,
+                                    self._get_expected_hash(image_info)):
+                    LOG.info('Image %s is cached, writing it from the cache '
+                             'instead of streaming it', image_info['id'])
+                elif stream_raw_images and disk_format == 'raw':
+                    if image_info.get('image_type') == 'partition':
+                        with self.timings.phase('partitioning'):
+                            self.partition_uuids = _write_partition_image(
+                                None, image_info, device,
+                                self._configdrive_fetch)
+                        stream_to = self.partition_uuids['partitions']['root']
+                    else:
+                        stream_to = device
+
+                    self._stream_raw_image_onto_device(image_info, stream_to)
+                    streamed = True
+                elif (disk_format == 'qcow2'
+                      and image_info.get('image_type') != 'partition'
+                      and image_info.get('stream_qcow2',
+                                         CONF.image_stream_qcow2)):
+                    streamed = self._stream_qcow2_image_onto_device(image_info,
+                                                                    device)
+                elif (disk_format in ('raw', 'qcow2')
+                      and image_info.get('image_type') == 'partition'
+                      and image_info.get('stream_partition',
+                                         CONF.image_stream_partition)):
+                    if image_info.get('virtual_size'):
+                        streamed = self._stream_partition_image(image_info,
+                                                                device)
+                    else:
+                        LOG.info('Image %s does not declare its virtual size, '
+                                 'it cannot be streamed onto a partition',
+                                 image_info['id'])
+                if not streamed:
+                    self._cache_and_write_image(image_info, device)
+
+            with self.timings.phase('validate_partitioning'):
+                _validate_partitioning(device)
+
+            # the configdrive creation is taken care by ironic-lib's
+            # work_on_disk().
+            if image_info.get('image_type') != 'partition':
+                if configdrive is not None:
+                    # Will use dummy value of 'local' for 'node_uuid',
+                    # if it is not available. This is to handle scenario
+                    # wherein new IPA is being used with older version
+                    # of Ironic that did not pass 'node_uuid' in 'image_info'
+                    node_uuid = image_info.get('node_uuid', 'local')
+                    with self.timings.phase('configdrive'):
+                        configdrive = self._configdrive_fetch.get()
+                        disk_utils.create_config_drive_partition(
+                            node_uuid, device, configdrive)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if self._configdrive_fetch is not None:
+                    self._configdrive_fetch.join()
+        if self._configdrive_fetch is not None:
+            # Overlapped with downloading or writing the image.
+            self.timings.add('configdrive_fetch',
+                             self._configdrive_fetch.seconds)
         msg = 'image ({}) written to device {} '
         result_msg = _message_format(msg, image_info, device,
                                      self.partition_uuids)
         LOG.info(result_msg)
-        return result_msg
+        result = {'result': 'prepare_image: {}'.format(result_msg),
+                  'timings': self._report_timings(image_info)}
+        if self.write_stats is not None:
+            result['write_stats'] = self.write_stats
+        if self.read_back_stats is not None:
+            result['read_back_stats'] = self.read_back_stats
+        return result
+
+    def _report_timings(self, image_info):
+        """Log the phase timings of the current command and return them."""
+        timings = self.timings.as_dict()
+        LOG.info('Phase timings of image %(image)s: %(phases)s, total '
+                 '%(total).2f seconds',
+                 {'image': image_info['id'], 'total': timings['total_seconds'],
+                  'phases': ', '.join(
+                      '{} {:.2f}s'.format(name, seconds)
+                      for name, seconds in sorted(timings['phases'].items()))
+                  or 'none'})
+        return timings
 
     def _run_shutdown_command(self, command):
         """Run the shutdown or reboot command
@@ -736,6 +2787,24 @@ class StandbyExtension(base.BaseAgentExtension):
         LOG.info('Powering off system')
         self._run_shutdown_command('poweroff')
 
+    @base.sync_command('set_download_rate_limit')
+    def set_download_rate_limit(self, rate_limit=None):
+        """Change the image download rate limit of the agent.
+
+        The new limit applies to the downloads in progress immediately, and
+        to downloads started later, instead of the configured limit and the
+        limits from their image information.
+
+        :param rate_limit: The rate limit in KiB/s, 0 to remove the limit,
+                           or None to use the configured limit and the
+                           limits of the images again.
+        :raises: InvalidCommandParamsError if the rate limit is invalid.
+        """
+        if rate_limit is not None:
+            _validate_rate_limit(rate_limit, 'Rate limit')
+            rate_limit = int(rate_limit)
+        override_rate_limit(rate_limit)
+
     @base.sync_command('sync')
     def sync(self):
         """Flush file system buffers forcing changed blocks to disk.
@@ -14,12 +14,15 @@
 
 import abc
 import binascii
+import copy
 import functools
 import json
+import multiprocessing
 from multiprocessing.pool import ThreadPool
 import os
 import re
 import shlex
+import threading
 import time
 
 from ironic_lib import disk_utils
@@ -35,6 +38,7 @@ import six
 import stevedore
 import yaml
 
+from ironic_python_agent import block_devices
 from ironic_python_agent import encoding
 from ironic_python_agent import errors
 from ironic_python_agent import netutils
@@ -50,6 +54,12 @@ UNIT_CONVERTER = pint.UnitRegistry(filename=None)
 UNIT_CONVERTER.define('bytes = []')
 UNIT_CONVERTER.define('MB = 1048576 bytes')
 _MEMORY_ID_RE = re.compile(r'^memory(:\d+)?$')
+_LSBLK_COLUMNS = ('KNAME', 'MODEL', 'SIZE', 'ROTA', 'TYPE')
+_LSHW_CACHE = None
+_LSHW_LOCK = threading.Lock()
+_BLOCK_DEVICE_CACHE = {}
+_BLOCK_DEVICE_LOCK = threading.Lock()
+_BLOCK_DEVICE_MONITOR = None
 NODE = None
 
 SUPPORTED_SOFTWARE_RAID_LEVELS = frozenset(['0', '1', '1+0'])
@@ -68,16 +78,94 @@ def _get_device_info(dev, devclass, field):
                 field, dev, devclass))
 
 
-def _get_system_lshw_dict():
+def get_system_lshw_dict():
     """Get a dict representation of the system from lshw
 
     Retrieves a json representation of the system from lshw and converts
-    it to a python dict
+    it to a python dict. lshw is slow, its output is cached for
+    CONF.lshw_cache_ttl seconds and concurrent callers share a single run
+    of it. Hardware managers should use this function instead of running
+    lshw themselves.
+
+    :raises: ProcessExecutionError or OSError if lshw fails.
+    :raises: ValueError if the output of lshw is invalid.
+    :return: A python dict from the lshw json output, a copy that the caller
+             may modify.
+    """
+    global _LSHW_CACHE
+
+    if not CONF.lshw_cache_ttl:
+        out, _e = utils.execute('lshw', '-quiet', '-json', log_stdout=False)
+        return json.loads(out)
+
+    with _LSHW_LOCK:
+        if (_LSHW_CACHE is None
+                or time.time() - _LSHW_CACHE[0] >= CONF.lshw_cache_ttl):
+            out, _e = utils.execute('lshw', '-quiet', '-json',
+                                    log_stdout=False)
+            _LSHW_CACHE = (time.time(), json.loads(out))
+        return copy.deepcopy(_LSHW_CACHE[1])
+
+
+# NOTE: kept for hardware managers using the former private name.
+_get_system_lshw_dict = get_system_lshw_dict
+
+
+def invalidate_system_lshw_dict():
+    """Drop the cached output of lshw, e.g. after a hardware change."""
+    global _LSHW_CACHE
+
+    with _LSHW_LOCK:
+        _LSHW_CACHE = None
+
+
+def _warm_lshw_cache():
+    try:
+        get_system_lshw_dict()
+    except (processutils.ProcessExecutionError, OSError, ValueError) as e:
+        LOG.debug('Unable to run lshw in advance: %s', e)
+
 
-    :return: A python dict from the lshw json output
+def _get_block_device_monitor():
+    """Get the udev monitor of block devices, starting it on first use.
+
+    :return: A BlockDeviceMonitor, or None if udev events cannot be
+             followed here.
+    """
+    global _BLOCK_DEVICE_MONITOR
+
+    with _BLOCK_DEVICE_LOCK:
+        if _BLOCK_DEVICE_MONITOR is None:
+            monitor = block_devices.BlockDeviceMonitor()
+            try:
+                monitor.start()
+            except (OSError, ImportError) as e:
+                LOG.warning('Unable to follow udev events of block '
+                            'devices, they will not be cached: %s', e)
+                monitor = False
+            _BLOCK_DEVICE_MONITOR = monitor
+        return _BLOCK_DEVICE_MONITOR or None
+
+
+def refresh_block_devices():
+    """Make sure the next listing of block devices reflects all changes.
+
+    Listed block devices are cached when CONF.block_device_cache is
+    enabled, until udev reports an event for a block device. Callers that
+    have just changed partitions or RAID devices use this as a barrier: it
+    waits for udev to process the resulting events and drops the cache.
+    The cached output of lshw, which lists disks too, is dropped as well.
     """
-    out, _e = utils.execute('lshw', '-quiet', '-json', log_stdout=False)
-    return json.loads(out)
+    invalidate_system_lshw_dict()
+    with _BLOCK_DEVICE_LOCK:
+        if not _BLOCK_DEVICE_CACHE:
+            # Nothing is cached, the next listing waits for udev anyway.
+            return
+    _udev_settle()
+    with _BLOCK_DEVICE_LOCK:
+        _BLOCK_DEVICE_CACHE.clear()
+        if _BLOCK_DEVICE_MONITOR:
+            _BLOCK_DEVICE_MONITOR.invalidate()
 
 
 def _udev_settle():
@@ -275,13 +363,36 @@ def list_all_block_devices(block_type='disk',
     :param ignore_empty: Whether to ignore disks with size equal 0.
     :return: A list of BlockDevices
     """
+    monitor = (_get_block_device_monitor() if CONF.block_device_cache
+               else None)
+    if monitor is None:
+        return _list_all_block_devices(block_type, ignore_raid,
+                                       ignore_floppy, ignore_empty)
+
+    key = (block_type, ignore_raid, ignore_floppy, ignore_empty)
+    generation = monitor.generation
+    with _BLOCK_DEVICE_LOCK:
+        cached = _BLOCK_DEVICE_CACHE.get(key)
+    if cached is None or cached[0] != generation:
+        # An event arriving while listing makes the result stale at once,
+        # since it is stored with the generation from before listing.
+        devices = _list_all_block_devices(*key)
+        with _BLOCK_DEVICE_LOCK:
+            _BLOCK_DEVICE_CACHE[key] = (generation, devices)
+    else:
+        devices = cached[1]
+    return copy.deepcopy(devices)
 
-    def _is_known_device(existing, new_device_name):
-        """Return true if device name is already known."""
-        for known_dev in existing:
-            if os.path.join('/dev', new_device_name) == known_dev.name:
-                return True
-        return False
+
+def _list_all_block_devices(block_type, ignore_raid, ignore_floppy,
+                            ignore_empty):
+    if CONF.block_device_enumerator == 'sysfs':
+        # Only wait for udev if it has not settled yet.
+        if not block_devices.udev_queue_empty():
+            _udev_settle()
+        return _build_block_devices(
+            block_devices.enumerate_block_devices().values(), block_type,
+            ignore_raid, ignore_floppy, ignore_empty)
 
     _udev_settle()
 
@@ -308,25 +419,62 @@ def list_all_block_devices(block_type='disk',
                     "version of block device name is unavailable "
                     "Cause: %(error)s", {'path': disk_by_path_dir, 'error': e})
 
-    columns = ['KNAME', 'MODEL', 'SIZE', 'ROTA', 'TYPE']
-    report = utils.execute('lsblk', '-Pbia', '-o{}'.format(','.join(columns)),
+    report = utils.execute('lsblk', '-Pbia',
+                           '-o{}'.format(','.join(_LSBLK_COLUMNS)),
                            check_exit_code=[0])[0]
-    lines = report.splitlines()
-    context = pyudev.Context()
-
-    devices = []
-    for line in lines:
+    lsblk_devices = []
+    for line in report.splitlines():
         device = {}
         # Split into KEY=VAL pairs
         vals = shlex.split(line)
         for key, val in (v.split('=', 1) for v in vals):
             device[key] = val.strip()
+        device['by_path'] = by_path_mapping.get(
+            os.path.join('/dev', device.get('KNAME', '')))
+        lsblk_devices.append(device)
+    return _build_block_devices(lsblk_devices, block_type, ignore_raid,
+                                ignore_floppy, ignore_empty)
+
+
+def _block_device_from_udev(device):
+    """Convert the pyudev Device of a udev event to a BlockDevice.
+
+    :return: A BlockDevice, or None if the device is not a disk that
+             list_all_block_devices would list by default.
+    """
+    if device.device_type != 'disk':
+        return None
+    row = block_devices.read_block_device(device.sys_name, device.sys_path)
+    devices = _build_block_devices([row], block_type='disk', ignore_raid=False,
+                                   ignore_floppy=True, ignore_empty=True)
+    return devices[0] if devices else None
+
+
+def _build_block_devices(rows, block_type, ignore_raid, ignore_floppy,
+                         ignore_empty):
+    """Filter block devices and convert them to BlockDevice objects.
+
+    :param rows: An iterable of dictionaries with the fields of lsblk, see
+                 :func:`list_all_block_devices` for the other parameters.
+                 They may also contain the ``udev`` properties, the
+                 ``hctl`` and the ``vendor`` of a device, which are looked
+                 up otherwise, and must contain its ``by_path`` link.
+    :return: A list of BlockDevices
+    """
+    context = None
+    devices = []
+    known = set()
+    for device in rows:
+        # The dictionary without the additional fields, for logging.
+        line = ' '.join('{}="{}"'.format(column, device[column])
+                        for column in _LSBLK_COLUMNS if column in device)
         # Ignore block types not specified
         devtype = device.get('TYPE')
 
         # We already have devices, we should ensure we don't store duplicates.
-        if _is_known_device(devices, device.get('KNAME')):
+        if device.get('KNAME') in known:
             continue
+        known.add(device.get('KNAME'))
 
         # If we collected the RM column, we could consult it for removable
         # media, however USB devices are also flagged as removable media.
@@ -365,7 +513,7 @@ def list_all_block_devices(block_type='disk',
                 continue
 
         # Ensure all required columns are at least present, even if blank
-        missing = set(columns) - set(device)
+        missing = set(_LSBLK_COLUMNS) - set(device)
         if missing:
             raise errors.BlockDeviceError(
                 '%s must be returned by lsblk.' % ', '.join(sorted(missing)))
@@ -385,16 +533,23 @@ def list_all_block_devices(block_type='disk',
 
         name = os.path.join('/dev', device['KNAME'])
 
-        try:
-            udev = pyudev.Devices.from_device_file(context, name)
-        except pyudev.DeviceNotFoundByFileError as e:
-            LOG.warning("Device %(dev)s is inaccessible, skipping... "
-                        "Error: %(error)s", {'dev': name, 'error': e})
-            extra = {}
-        except pyudev.DeviceNotFoundByNumberError as e:
-            LOG.warning("Device %(dev)s is not supported by pyudev, "
-                        "skipping... Error: %(error)s",
-                        {'dev': name, 'error': e})
+        if 'udev' in device:
+            udev = device['udev']
+        else:
+            if context is None:
+                context = pyudev.Context()
+            try:
+                udev = pyudev.Devices.from_device_file(context, name)
+            except pyudev.DeviceNotFoundByFileError as e:
+                LOG.warning("Device %(dev)s is inaccessible, skipping... "
+                            "Error: %(error)s", {'dev': name, 'error': e})
+                udev = None
+            except pyudev.DeviceNotFoundByNumberError as e:
+                LOG.warning("Device %(dev)s is not supported by pyudev, "
+                            "skipping... Error: %(error)s",
+                            {'dev': name, 'error': e})
+                udev = None
+        if udev is None:
             extra = {}
         else:
             # TODO(lucasagomes): Since lsblk only supports
@@ -406,26 +561,32 @@ def list_all_block_devices(block_type='disk',
                       ('wwn_with_extension', 'WWN_WITH_EXTENSION'),
                       ('wwn_vendor_extension', 'WWN_VENDOR_EXTENSION')]}
 
-        # NOTE(lucasagomes): Newer versions of the lsblk tool supports
-        # HCTL as a parameter but let's get it from sysfs to avoid breaking
-        # old distros.
-        try:
-            extra['hctl'] = os.listdir(
-                '/sys/block/%s/device/scsi_device' % device['KNAME'])[0]
-        except (OSError, IndexError):
-            LOG.warning('Could not find the SCSI address (HCTL) for '
-                        'device %s. Skipping', name)
+        if 'hctl' in device:
+            if device['hctl'] is not None:
+                extra['hctl'] = device['hctl']
+        else:
+            # NOTE(lucasagomes): Newer versions of the lsblk tool supports
+            # HCTL as a parameter but let's get it from sysfs to avoid
+            # breaking old distros.
+            try:
+                extra['hctl'] = os.listdir(
+                    '/sys/block/%s/device/scsi_device' % device['KNAME'])[0]
+            except (OSError, IndexError):
+                LOG.warning('Could not find the SCSI address (HCTL) for '
+                            'device %s. Skipping', name)
+
+        if 'vendor' in device:
+            vendor = device['vendor']
+        else:
+            vendor = _get_device_info(device['KNAME'], 'block', 'vendor')
 
         # Not all /dev entries are pointed to from /dev/disk/by-path
-        by_path_name = by_path_mapping.get(name)
-
         devices.append(BlockDevice(name=name,
                                    model=device['MODEL'],
                                    size=int(device['SIZE'] or 0),
                                    rotational=bool(int(device['ROTA'])),
-                                   vendor=_get_device_info(device['KNAME'],
-                                                           'block', 'vendor'),
-                                   by_path=by_path_name,
+                                   vendor=vendor,
+                                   by_path=device['by_path'],
                                    **extra))
     return devices
 
@@ -535,6 +696,75 @@ class BootInfo(encoding.SerializableComparable):
         self.pxe_interface = pxe_interface
 
 
+def _collect_section(name, collector, started, timings):
+    started[name] = time.time()
+    try:
+        return collector()
+    finally:
+        timings[name] = time.time() - started[name]
+
+
+def _collect_inventory(collectors):
+    """Run inventory collectors concurrently.
+
+    At most CONF.inventory_workers collectors run at the same time. A
+    collector that fails or runs longer than CONF.inventory_section_timeout
+    leaves its section None, the other sections are still returned.
+
+    :param collectors: A list of tuples of a section name and a callable
+                       collecting it.
+    :returns: A tuple of a dictionary mapping the section names to their
+              values, and a dictionary with the seconds taken by every
+              section and the errors of the failed ones.
+    """
+    timeout = CONF.inventory_section_timeout or None
+    started = {}
+    timings = {}
+    failed = {}
+    inventory = {}
+    pool = ThreadPool(min(CONF.inventory_workers, len(collectors)))
+    try:
+        results = [(name, pool.apply_async(
+            _collect_section, (name, collector, started, timings)))
+            for name, collector in collectors]
+        for name, result in results:
+            # The timeout counts from the start of the collector, which may
+            # have been waiting for a free worker.
+            while True:
+                begun = started.get(name)
+                wait = timeout
+                if timeout is not None and begun is not None:
+                    wait = max(begun + timeout - time.time(), 0)
+                try:
+                    inventory[name] = result.get(wait)
+                except multiprocessing.TimeoutError:
+                    if begun is None and started.get(name) is not None:
+                        continue
+                    LOG.error('Collecting %(section)s for the inventory '
+                              'did not finish in %(timeout)d seconds',
+                              {'section': name, 'timeout': timeout})
+                    inventory[name] = None
+                    failed[name] = 'Timed out after {} seconds'.format(
+                        timeout)
+                except Exception as e:
+                    LOG.exception('Collecting %(section)s for the inventory '
+                                  'failed: %(error)s',
+                                  {'section': name, 'error': e})
+                    inventory[name] = None
+                    failed[name] = str(e)
+                break
+    finally:
+        # Collectors that have timed out are left running.
+        pool.terminate()
+
+    if failed:
+        LOG.warning('The inventory is missing sections %s',
+                    ', '.join(sorted(failed)))
+    return inventory, {'sections': dict((name, timings.get(name))
+                                        for name, _collector in collectors),
+                       'errors': failed}
+
+
 @six.add_metaclass(abc.ABCMeta)
 class HardwareManager(object):
     @abc.abstractmethod
@@ -641,30 +871,95 @@ class HardwareManager(object):
         if any device hint is specified. Otherwise neither inspection
         not deployment have any chances to succeed.
 
+        The wait wakes up on udev events of block devices, only looking at
+        the device that has appeared, and lasts up to
+        CONF.disk_wait_delay seconds times the number of attempts after the
+        first one. Without udev events, the root device is looked up every
+        CONF.disk_wait_delay seconds instead.
         """
         if not CONF.disk_wait_attempts:
             return
 
         max_waits = CONF.disk_wait_attempts - 1
-        for attempt in range(CONF.disk_wait_attempts):
-            try:
-                self.get_os_install_device()
-            except errors.DeviceNotFound:
-                LOG.debug('Still waiting for the root device to appear, '
-                          'attempt %d of %d', attempt + 1,
-                          CONF.disk_wait_attempts)
-
-                if attempt < max_waits:
-                    time.sleep(CONF.disk_wait_delay)
+        if self._root_device_present(1):
+            return
+
+        found = False
+        if max_waits:
+            monitor = _get_block_device_monitor()
+            if monitor is None:
+                found = self._poll_for_root_device()
             else:
-                break
-        else:
+                found = self._wait_for_root_device_event(
+                    monitor, CONF.disk_wait_delay * max_waits)
+
+        if not found:
             if max_waits:
                 LOG.warning('The root device was not detected in %d seconds',
                             CONF.disk_wait_delay * max_waits)
             else:
                 LOG.warning('The root device was not detected')
 
+    def _root_device_present(self, attempt):
+        try:
+            self.get_os_install_device()
+        except errors.DeviceNotFound:
+            LOG.debug('Still waiting for the root device to appear, '
+                      'attempt %d of %d', attempt, CONF.disk_wait_attempts)
+            return False
+        return True
+
+    def _poll_for_root_device(self):
+        for attempt in range(2, CONF.disk_wait_attempts + 1):
+            time.sleep(CONF.disk_wait_delay)
+            if self._root_device_present(attempt):
+                return True
+        return False
+
+    def _wait_for_root_device_event(self, monitor, timeout):
+        events = six.moves.queue.Queue()
+
+        def _on_event(device):
+            if device.action in ('add', 'change'):
+                events.put(device)
+
+        monitor.add_listener(_on_event)
+        try:
+            # A device may have appeared before the listener was added.
+            if self._root_device_present(2):
+                return True
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    device = events.get(timeout=remaining)
+                except six.moves.queue.Empty:
+                    return False
+                if self._is_root_device(device):
+                    return True
+        finally:
+            monitor.remove_listener(_on_event)
+
+    def _is_root_device(self, device):
+        """Check whether a block device that has appeared is the root device.
+
+        Hardware managers that can tell from the device alone should
+        override this method, by default the root device is looked up again
+        among all block devices.
+
+        :param device: The pyudev Device of the udev event.
+        :returns: True if the root device is present now.
+        """
+        try:
+            self.get_os_install_device()
+        except errors.DeviceNotFound:
+            LOG.debug('Block device %s is not the root device',
+                      device.sys_name)
+            return False
+        return True
+
     def list_hardware_info(self):
         """Return full hardware inventory as a serializable dict.
 
@@ -676,17 +971,20 @@ class HardwareManager(object):
         start = time.time()
         LOG.info('Collecting full inventory')
         # NOTE(dtantsur): don't forget to update docs when extending inventory
-        hardware_info = {}
-        hardware_info['interfaces'] = self.list_network_interfaces()
-        hardware_info['cpu'] = self.get_cpus()
-        hardware_info['disks'] = self.list_block_devices()
-        hardware_info['memory'] = self.get_memory()
-        hardware_info['bmc_address'] = self.get_bmc_address()
-        hardware_info['bmc_v6address'] = self.get_bmc_v6address()
-        hardware_info['system_vendor'] = self.get_system_vendor_info()
-        hardware_info['boot'] = self.get_boot_info()
+        collectors = [('interfaces', self.list_network_interfaces),
+                      ('cpu', self.get_cpus),
+                      ('disks', self.list_block_devices),
+                      ('memory', self.get_memory),
+                      ('bmc_address', self.get_bmc_address),
+                      ('bmc_v6address', self.get_bmc_v6address),
+                      ('system_vendor', self.get_system_vendor_info),
+                      ('boot', self.get_boot_info)]
+        hardware_info, metadata = _collect_inventory(collectors)
         hardware_info['hostname'] = netutils.get_hostname()
-        LOG.info('Inventory collected in %.2f second(s)', time.time() - start)
+        metadata['total_seconds'] = time.time() - start
+        hardware_info['metadata'] = metadata
+        LOG.info('Inventory collected in %.2f second(s)',
+                 metadata['total_seconds'])
         return hardware_info
 
     def get_clean_steps(self, node, ports):
@@ -942,7 +1240,7 @@ class GenericHardwareManager(HardwareManager):
                            "version %s"), psutil.version_info[0])
         sys_dict = None
         try:
-            sys_dict = _get_system_lshw_dict()
+            sys_dict = get_system_lshw_dict()
         except (processutils.ProcessExecutionError, OSError, ValueError) as e:
             LOG.warning('Could not get real physical RAM from lshw: %s', e)
             physical = None
@@ -979,6 +1277,28 @@ class GenericHardwareManager(HardwareManager):
         return block_devices
 
     def get_os_install_device(self):
+        return self._find_root_device(self.list_block_devices())
+
+    def _is_root_device(self, device):
+        generic = GenericHardwareManager
+        if (type(self).get_os_install_device != generic.get_os_install_device
+                or type(self).list_block_devices
+                != generic.list_block_devices):
+            # The root device is picked differently, look it up as usual.
+            return super(GenericHardwareManager, self)._is_root_device(device)
+
+        block_device = _block_device_from_udev(device)
+        if block_device is None:
+            return False
+        try:
+            self._find_root_device([block_device])
+        except errors.DeviceNotFound:
+            LOG.debug('Block device %s is not the root device',
+                      block_device.name)
+            return False
+        return True
+
+    def _find_root_device(self, block_devices):
         cached_node = get_cached_node()
         root_device_hints = None
         if cached_node is not None:
@@ -986,7 +1306,6 @@ class GenericHardwareManager(HardwareManager):
             LOG.debug('Looking for a device matching root hints %s',
                       root_device_hints)
 
-        block_devices = self.list_block_devices()
         if not root_device_hints:
             dev_name = utils.guess_root_disk(block_devices).name
         else:
@@ -1019,7 +1338,7 @@ class GenericHardwareManager(HardwareManager):
 
     def get_system_vendor_info(self):
         try:
-            sys_dict = _get_system_lshw_dict()
+            sys_dict = get_system_lshw_dict()
         except (processutils.ProcessExecutionError, OSError, ValueError) as e:
             LOG.warning('Could not retrieve vendor info from lshw: %s', e)
             sys_dict = {}
@@ -1121,6 +1440,7 @@ class GenericHardwareManager(HardwareManager):
                           'Error: %(error)s', {'dev': dev.name, 'error': e})
                 erase_errors[dev.name] = e
 
+        refresh_block_devices()
         if erase_errors:
             excpt_msg = ('Failed to erase the metadata on the device(s): %s' %
                          '; '.join(['"%s": %s' % (k, v)
@@ -1682,6 +2002,7 @@ class GenericHardwareManager(HardwareManager):
                     md_device, ' '.join(component_devices), e)
                 raise errors.SoftwareRAIDError(msg)
 
+        refresh_block_devices()
         LOG.info("Successfully created Software RAID")
 
         return raid_config
@@ -1704,6 +2025,7 @@ class GenericHardwareManager(HardwareManager):
         def _scan_raids():
             utils.execute('mdadm', '--assemble', '--scan',
                           check_exit_code=False)
+            refresh_block_devices()
             raid_devices = list_all_block_devices(block_type='raid',
                                                   ignore_raid=False,
                                                   ignore_empty=False)
@@ -1839,6 +2161,7 @@ class GenericHardwareManager(HardwareManager):
                 LOG.warning('Failed to remove superblock from %s: %s',
                             raid_device.name, e)
 
+        refresh_block_devices()
         LOG.debug("Finished deleting Software RAID(s)")
 
     def validate_configuration(self, raid_config, node):
@@ -2043,9 +2366,16 @@ def load_managers():
     called. Used to resolve bug 1490008, where agents can crash the first
     time a hardware manager is needed.
 
+    The output of lshw is collected in the background as well, if it is
+    cached.
+
     :raises HardwareManagerNotFound: if no valid hardware managers found
     """
     _get_managers()
+    if CONF.lshw_cache_ttl:
+        thread = threading.Thread(target=_warm_lshw_cache, name='lshw')
+        thread.daemon = True
+        thread.start()
 
 
 _CACHED_HW_INFO = None
@@ -0,0 +1,219 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed cache of downloaded images.
+
+Images are stored under the name of their hash, so an image is found
+regardless of the image ID it is requested with. Entries are verified
+against their hash on every hit, and the least recently used ones are
+evicted when the cache grows over its size limit.
+"""
+
+import errno
+import os
+import re
+
+from oslo_concurrency import processutils
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import units
+
+from ironic_python_agent import utils
+
+CONF = cfg.CONF
+LOG = log.getLogger(__name__)
+
+_CHUNK_SIZE = units.Mi
+_PART_SUFFIX = '.part'
+_VALID_KEY = re.compile(r'^[a-z0-9_]+-[0-9a-fA-F]+$')
+
+
+def cache_key(algo, value):
+    """Build the cache key of an image.
+
+    :param algo: The name of the hash algorithm, e.g. "sha512".
+    :param value: The hex digest of the image.
+    :returns: The key as a string, or None if the values cannot be used as
+              a file name.
+    """
+    key = '{}-{}'.format(algo, value).lower()
+    if not is_valid_key(key):
+        return None
+    return key
+
+
+def is_valid_key(key):
+    """Check whether a string is a valid cache key."""
+    return bool(_VALID_KEY.match(key))
+
+
+class ImageCache(object):
+    """A directory of images named after their hash."""
+
+    def __init__(self, path, max_size=0):
+        """Create the cache.
+
+        :param path: The directory holding the cache.
+        :param max_size: The maximum size of all entries in bytes, 0 for no
+                         limit.
+        """
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entry_path(self, key):
+        """Get the path of a (possibly missing) entry."""
+        return os.path.join(self.path, key)
+
+    def part_path(self, key):
+        """Get the path to download a new entry to before it is added."""
+        return self.entry_path(key) + _PART_SUFFIX
+
+    def contains(self, key):
+        """Check whether an entry exists, without verifying it."""
+        return os.path.exists(self.entry_path(key))
+
+    def lookup(self, key, hash_factory):
+        """Find a valid entry.
+
+        The entry is re-hashed, a corrupted entry is removed.
+
+        :param key: The cache key, see :func:`cache_key`.
+        :param hash_factory: A callable returning a new hash object.
+        :returns: The path to the entry or None on a miss.
+        """
+        path = self.entry_path(key)
+        if not os.path.exists(path):
+            LOG.debug('Image %s is not cached', key)
+            return None
+
+        hash_obj = hash_factory()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                hash_obj.update(chunk)
+        if '{}-{}'.format(hash_obj.name,
+                          hash_obj.hexdigest()).lower() != key:
+            LOG.warning('Cached image %(path)s is corrupted, its hash is '
+                        '%(hash)s, removing it',
+                        {'path': path, 'hash': hash_obj.hexdigest()})
+            os.unlink(path)
+            return None
+
+        # Mark the entry as recently used.
+        os.utime(path, None)
+        LOG.info('Using cached image %s', path)
+        return path
+
+    def remove_part(self, key):
+        """Remove the partial download of an entry, if any."""
+        try:
+            os.unlink(self.part_path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def remove_parts(self):
+        """Remove the partial downloads left behind by failed downloads."""
+        for name in os.listdir(self.path):
+            if not name.endswith(_PART_SUFFIX):
+                continue
+            LOG.info('Removing partially downloaded image %(name)s from the '
+                     'cache in %(path)s', {'name': name, 'path': self.path})
+            os.unlink(os.path.join(self.path, name))
+
+    def add(self, key):
+        """Add an entry downloaded to :meth:`part_path`.
+
+        :param key: The cache key, see :func:`cache_key`.
+        :returns: The path to the entry.
+        """
+        path = self.entry_path(key)
+        os.rename(self.part_path(key), path)
+        self.evict(keep=key)
+        return path
+
+    def evict(self, keep=None, needed=0):
+        """Remove the least recently used entries over the size limit.
+
+        :param keep: The key of an entry that must not be removed.
+        :param needed: The number of bytes to make room for.
+        """
+        if not self.max_size:
+            return
+
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((name, stat.st_mtime, stat.st_size))
+
+        total = sum(size for _name, _mtime, size in entries) + needed
+        for name, _mtime, size in sorted(entries, key=lambda e: e[1]):
+            if total <= self.max_size:
+                break
+            if keep is not None and name in (keep, keep + _PART_SUFFIX):
+                continue
+            LOG.info('Evicting image %(name)s (%(size)d bytes) from the '
+                     'cache in %(path)s', {'name': name, 'size': size,
+                                           'path': self.path})
+            os.unlink(os.path.join(self.path, name))
+            total -= size
+
+
+def get_cache():
+    """Get the image cache if it is enabled.
+
+    If ``[DEFAULT]image_cache_device`` is set, it is mounted on
+    ``[DEFAULT]image_cache_dir`` first. Partial downloads left behind by an
+    interrupted agent are removed, so only call this when no image is being
+    downloaded to the cache.
+
+    :returns: An ImageCache object, or None if the cache is disabled or
+              cannot be used.
+    """
+    if not CONF.image_cache_dir:
+        return None
+
+    path = CONF.image_cache_dir
+    try:
+        if CONF.image_cache_device and not os.path.ismount(path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            utils.execute('mount', CONF.image_cache_device, path)
+        cache = ImageCache(path,
+                           max_size=CONF.image_cache_max_size * units.Mi)
+        cache.remove_parts()
+        return cache
+    except (OSError, IOError, processutils.ProcessExecutionError) as e:
+        LOG.warning('Unable to use the image cache in %(path)s: %(error)s',
+                    {'path': path, 'error': e})
+        return None
+
+
+def find_cache():
+    """Get the image cache if it is enabled and already available.
+
+    Unlike :func:`get_cache`, nothing is mounted or created, so that it is
+    safe to use when serving requests of other agents.
+
+    :returns: An ImageCache object, or None if the cache is disabled or has
+              not been set up yet.
+    """
+    path = CONF.image_cache_dir
+    if not path or not os.path.isdir(path):
+        return None
+    if CONF.image_cache_device and not os.path.ismount(path):
+        return None
+    return ImageCache(path, max_size=CONF.image_cache_max_size * units.Mi)
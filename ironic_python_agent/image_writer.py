@@ -0,0 +1,473 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writers used to put image data onto block devices."""
+
+import collections
+import errno
+import fcntl
+import mmap
+from multiprocessing.pool import ThreadPool
+import os
+import resource
+import struct
+import threading
+
+from oslo_log import log
+from oslo_utils import units
+
+from ironic_python_agent import errors
+
+LOG = log.getLogger(__name__)
+
+# Alignment of offsets, lengths and buffers for O_DIRECT. 4 KiB is a
+# multiple of the logical block size of all devices we support.
+DIRECT_IO_ALIGNMENT = 4096
+
+# ioctl requests from linux/fs.h: _IO(0x12, 104) and _IO(0x12, 127).
+BLKSSZGET = 0x1268
+BLKZEROOUT = 0x127f
+
+# BLKZEROOUT requires ranges aligned to the 512 byte sector size.
+_SECTOR_SIZE = 512
+
+SPARSE_POLICIES = ('none', 'skip', 'zeroout')
+
+_PWRITE_LOCK = threading.Lock()
+
+
+def get_peak_rss():
+    """Get the peak resident set size of the agent process.
+
+    :returns: The peak RSS in bytes.
+    """
+    # NOTE: ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * units.Ki
+
+
+def _pwrite_all(fd, data, offset):
+    """Write all of ``data`` to ``fd`` at ``offset``.
+
+    :param fd: An open file descriptor.
+    :param data: A bytes-like object.
+    :param offset: The offset in the file to write at.
+    """
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, offset)
+        else:
+            # Python 2 has no pwrite, serialize seek and write.
+            with _PWRITE_LOCK:
+                os.lseek(fd, offset, os.SEEK_SET)
+                written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+class DirectIOWriter(object):
+    """File-like object writing to a device with O_DIRECT.
+
+    Data is collected into page-aligned buffers of ``io_size`` bytes, which
+    are written with up to ``queue_depth`` concurrent requests, bypassing
+    the page cache. The final chunk that is not a multiple of
+    DIRECT_IO_ALIGNMENT is written through the page cache. Closing the
+    writer waits for all requests and issues an fsync barrier.
+
+    The object is a context manager and supports ``seek`` before the first
+    write and from aligned positions afterwards, so it can replace a file
+    object opened with ``open``.
+    """
+
+    def __init__(self, path, io_size=4 * units.Mi, queue_depth=4):
+        """Open ``path`` for direct I/O.
+
+        :param path: The path to the device (or file) to write to.
+        :param io_size: The size of a single write request in bytes. It is
+                        rounded up to a multiple of DIRECT_IO_ALIGNMENT.
+        :param queue_depth: The maximum number of concurrent write requests.
+        :raises: OSError if the device cannot be opened with O_DIRECT.
+        """
+        self.name = path
+        self._io_size = max(DIRECT_IO_ALIGNMENT,
+                            -(-io_size // DIRECT_IO_ALIGNMENT)
+                            * DIRECT_IO_ALIGNMENT)
+        self._queue_depth = max(1, queue_depth)
+        self._fd = os.open(path, os.O_WRONLY | getattr(os, 'O_DIRECT', 0))
+        self._pool = ThreadPool(self._queue_depth)
+        self._free = collections.deque(
+            mmap.mmap(-1, self._io_size)
+            for _i in range(self._queue_depth + 1))
+        self._pending = collections.deque()
+        self._buf = self._free.popleft()
+        self._fill = 0
+        self._buf_offset = 0
+        self._started = False
+        self._closed = False
+        self.bytes_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Always flush whatever was accepted, even on errors, so that the
+        # data on the device matches what the caller believes is written.
+        self.close()
+
+    def seek(self, offset):
+        """Set the position to start writing at.
+
+        If the offset is not aligned, the partial block in front of it is
+        read from the device so that it can be written back unchanged.
+        Once writing has started, seeking is only possible from an aligned
+        position.
+
+        :param offset: The byte offset to start writing at.
+        """
+        if self._started and self._fill:
+            if self._fill % DIRECT_IO_ALIGNMENT:
+                raise ValueError('Cannot seek from an unaligned position')
+            self._submit(self._fill)
+        remainder = offset % DIRECT_IO_ALIGNMENT
+        self._buf_offset = offset - remainder
+        self._fill = remainder
+        if remainder:
+            fd = os.open(self.name, os.O_RDONLY)
+            try:
+                os.lseek(fd, self._buf_offset, os.SEEK_SET)
+                head = os.read(fd, remainder)
+            finally:
+                os.close(fd)
+            self._buf[:len(head)] = head
+
+    def fileno(self):
+        return self._fd
+
+    def _wait_oldest(self):
+        result, buf = self._pending.popleft()
+        try:
+            result.get()
+        except (OSError, IOError) as e:
+            raise errors.ImageWriteError(self.name, e.errno, '', str(e))
+        finally:
+            self._free.append(buf)
+
+    def _submit(self, length):
+        self._pending.append((self._pool.apply_async(
+            _pwrite_all,
+            (self._fd, memoryview(self._buf)[:length], self._buf_offset)),
+            self._buf))
+        self.bytes_written += length
+        self._buf_offset += length
+        if not self._free:
+            self._wait_oldest()
+        self._buf = self._free.popleft()
+        self._fill = 0
+
+    def write(self, data):
+        """Write data at the current position.
+
+        :param data: A bytes-like object.
+        :raises: ImageWriteError if a previous write request failed.
+        """
+        self._started = True
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self._io_size - self._fill)
+            self._buf[self._fill:self._fill + length] = view[:length]
+            self._fill += length
+            view = view[length:]
+            if self._fill == self._io_size:
+                self._submit(self._io_size)
+
+    def close(self):
+        """Write out the remaining data, fsync and close the device.
+
+        :raises: ImageWriteError if any write request failed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            aligned = self._fill - self._fill % DIRECT_IO_ALIGNMENT
+            tail = bytes(self._buf[aligned:self._fill])
+            if aligned:
+                self._submit(aligned)
+            while self._pending:
+                self._wait_oldest()
+
+            if tail:
+                fd = os.open(self.name, os.O_WRONLY)
+                try:
+                    _pwrite_all(fd, tail, self._buf_offset)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self.bytes_written += len(tail)
+            os.fsync(self._fd)
+        except (OSError, IOError) as e:
+            raise errors.ImageWriteError(self.name, e.errno, '', str(e))
+        finally:
+            os.close(self._fd)
+            self._pool.terminate()
+
+
+def zero_range(fd, offset, length, offload=True):
+    """Zero a range of a device.
+
+    :param fd: A file descriptor open for writing.
+    :param offset: The start of the range in bytes.
+    :param length: The length of the range in bytes.
+    :param offload: Whether to try the BLKZEROOUT ioctl first.
+    :returns: True if the range was zeroed with BLKZEROOUT, False if zeros
+              were written.
+    """
+    if offload:
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            return True
+        except (OSError, IOError):
+            pass
+
+    zeros = b'\0' * min(length, units.Mi)
+    while length:
+        size = min(length, len(zeros))
+        _pwrite_all(fd, zeros[:size], offset)
+        offset += size
+        length -= size
+    return False
+
+
+def get_logical_block_size(fd):
+    """Get the logical block size of a device.
+
+    :param fd: A file descriptor of the device.
+    :returns: The logical block size in bytes, 512 if ``fd`` is not a block
+              device.
+    """
+    try:
+        result = fcntl.ioctl(fd, BLKSSZGET, struct.pack('i', 0))
+    except (OSError, IOError):
+        return _SECTOR_SIZE
+    return struct.unpack('i', result)[0]
+
+
+class DirectIOReader(object):
+    """Reads ranges of a device with O_DIRECT, bypassing the page cache.
+
+    Reading back through the page cache would only prove that the cache
+    holds the right data. If the device does not support O_DIRECT (or
+    Python lacks ``os.preadv``), it is read normally after asking the
+    kernel to drop its cached pages.
+
+    Reads into page-aligned buffers, e.g. ``mmap.mmap(-1, size)``, may be
+    issued from several threads concurrently.
+    """
+
+    def __init__(self, path):
+        """Open ``path`` for reading.
+
+        :param path: The path to the device (or file) to read.
+        :raises: OSError if the device cannot be opened.
+        """
+        self.name = path
+        self.direct = hasattr(os, 'preadv') and hasattr(os, 'O_DIRECT')
+        self._fd = None
+        if self.direct:
+            try:
+                self._fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                LOG.warning('%s does not support direct I/O, reading it '
+                            'through the page cache', path)
+                self.direct = False
+        if self._fd is None:
+            self._fd = os.open(path, os.O_RDONLY)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, offset, length, buf):
+        """Read a range of the device.
+
+        :param offset: The start of the range, a multiple of
+                       DIRECT_IO_ALIGNMENT.
+        :param length: The length of the range in bytes.
+        :param buf: A page-aligned writable buffer of at least ``length``
+                    bytes rounded up to DIRECT_IO_ALIGNMENT.
+        :raises: IOError if the device ends before the range.
+        :returns: A memoryview of the ``length`` bytes read, backed by
+                  ``buf``.
+        """
+        view = memoryview(buf)
+        aligned = -(-length // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+        done = 0
+        while done < length:
+            if self.direct:
+                count = os.preadv(self._fd, [view[done:aligned]],
+                                  offset + done)
+            else:
+                with _PWRITE_LOCK:
+                    os.lseek(self._fd, offset + done, os.SEEK_SET)
+                    data = os.read(self._fd, length - done)
+                count = len(data)
+                view[done:done + count] = data
+            if not count:
+                raise IOError(errno.EIO, 'Unexpected end of {} at byte '
+                                         '{}'.format(self.name,
+                                                     offset + done))
+            done += count
+        return view[:length]
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SparseWriter(object):
+    """File-like object that avoids writing blocks consisting of zeros.
+
+    The data is split into blocks aligned to ``block_size`` on the device.
+    Runs of all-zero blocks are handled according to ``policy``:
+
+    * ``skip`` - seek over them, the device must already contain zeros.
+    * ``zeroout`` - zero them with the BLKZEROOUT ioctl. The kernel
+      offloads it to the device with WRITE ZEROES, unmapping the blocks if
+      the device supports it, and writes zeros otherwise.
+
+    If an ioctl is not supported for the target, the zeros are written.
+    Partial blocks at the start and end of the stream are always written.
+    """
+
+    def __init__(self, f, policy, block_size=units.Mi):
+        """Wrap a writer.
+
+        :param f: The file-like object to write to. It must support
+                  ``seek`` to block aligned offsets and ``fileno``.
+        :param policy: Either ``skip`` or ``zeroout``.
+        :param block_size: The size of the blocks checked for zeros. It is
+                           rounded up to a multiple of DIRECT_IO_ALIGNMENT.
+        """
+        if policy not in SPARSE_POLICIES[1:]:
+            raise ValueError('Unsupported sparse policy %s' % policy)
+        self.name = f.name
+        self._f = f
+        self._block_size = max(DIRECT_IO_ALIGNMENT,
+                               -(-block_size // DIRECT_IO_ALIGNMENT)
+                               * DIRECT_IO_ALIGNMENT)
+        self._zeros = b'\0' * self._block_size
+        self.policy = policy
+        self._buf = bytearray()
+        self._pos = 0
+        self._zero_start = None
+        self._zero_length = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def seek(self, offset):
+        """Set the position to start writing at.
+
+        :param offset: The byte offset to start writing at.
+        """
+        self._flush_zeros()
+        self._write_data(self._buf)
+        self._buf = bytearray()
+        self._f.seek(offset)
+        self._pos = offset
+
+    def _block_left(self):
+        return self._block_size - self._pos % self._block_size
+
+    def _write_data(self, data):
+        if not data:
+            return
+        self._f.write(data)
+        self.bytes_written += len(data)
+
+    def _flush_zeros(self):
+        if not self._zero_length:
+            return
+        start, length = self._zero_start, self._zero_length
+        self._zero_start, self._zero_length = None, 0
+
+        if self.policy == 'skip':
+            self._f.seek(start + length)
+            self.bytes_skipped += length
+            return
+
+        try:
+            fcntl.ioctl(self._f.fileno(), BLKZEROOUT,
+                        struct.pack('QQ', start, length))
+        except (OSError, IOError) as e:
+            LOG.warning('Cannot %(policy)s %(length)d bytes at offset '
+                        '%(start)d of %(dev)s, writing zeros instead: '
+                        '%(err)s', {'policy': self.policy, 'length': length,
+                                    'start': start, 'dev': self.name,
+                                    'err': e})
+            self.policy = 'none'
+            self._f.seek(start)
+            while length:
+                block = min(length, self._block_size)
+                self._write_data(self._zeros[:block])
+                length -= block
+            return
+        self._f.seek(start + length)
+        self.bytes_skipped += length
+
+    def _add_block(self, block):
+        start = self._pos - len(block)
+        if (self.policy != 'none' and len(block) == self._block_size
+                and block == self._zeros):
+            if self._zero_start is None:
+                self._zero_start = start
+            self._zero_length += len(block)
+        else:
+            self._flush_zeros()
+            self._write_data(block)
+
+    def write(self, data):
+        """Write data at the current position.
+
+        :param data: A bytes-like object.
+        """
+        view = memoryview(data)
+        while view:
+            length = min(len(view), self._block_left())
+            self._buf += view[:length]
+            self._pos += length
+            view = view[length:]
+            if self._pos % self._block_size == 0:
+                self._add_block(self._buf)
+                self._buf = bytearray()
+
+    def close(self):
+        """Write out the remaining data and close the wrapped writer."""
+        try:
+            self._flush_zeros()
+            self._write_data(self._buf)
+            self._buf = bytearray()
+        finally:
+            self._f.close()
@@ -207,7 +207,8 @@ def collect_default(data, failures):
     # root device hints are not set, inspector will use the same root disk as
     # will be used for deploy.
     try:
-        root_disk = utils.guess_root_disk(inventory['disks'][:])
+        # The disks are missing if collecting them has failed.
+        root_disk = utils.guess_root_disk(list(inventory['disks'] or []))
     except errors.DeviceNotFound:
         root_disk = None
         LOG.warning('no suitable root device detected')
@@ -216,7 +217,8 @@ def collect_default(data, failures):
         LOG.debug('default root device is %s', root_disk.name)
     # The boot interface might not be present, we don't count it as failure.
     # TODO(dtantsur): stop using the boot_interface field.
-    data['boot_interface'] = inventory['boot'].pxe_interface
+    data['boot_interface'] = (inventory['boot'].pxe_interface
+                              if inventory['boot'] is not None else None)
     LOG.debug('boot devices was %s', data['boot_interface'])
     LOG.debug('BMC IP address: %s', inventory.get('bmc_address'))
 
@@ -0,0 +1,495 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming conversion of qcow2 images onto block devices.
+
+The image is consumed front to back exactly once. The header points to the
+L1 table, which points to the L2 tables, which point to the data clusters.
+As long as every table appears in the file before the clusters it points
+to, which is the case for images created by qemu-img, data clusters are
+written to the device as soon as they arrive. Clusters arriving before the
+table referencing them are spilled to a temporary file until the table is
+seen.
+"""
+
+import os
+import struct
+import tempfile
+import zlib
+
+from oslo_log import log
+
+from ironic_python_agent import errors
+from ironic_python_agent import image_writer
+
+LOG = log.getLogger(__name__)
+
+QCOW2_MAGIC = b'QFI\xfb'
+
+# magic, version, backing_file_offset, backing_file_size, cluster_bits,
+# size, crypt_method, l1_size, l1_table_offset, refcount_table_offset,
+# refcount_table_clusters, nb_snapshots, snapshots_offset
+_HEADER_V2 = struct.Struct('>4sIQIIQIIQQIIQ')
+# incompatible_features, compatible_features, autoclear_features,
+# refcount_order, header_length
+_HEADER_V3 = struct.Struct('>QQQII')
+_HEADER_SIZE = _HEADER_V2.size + _HEADER_V3.size
+# Enough of the image to read its virtual size, see read_virtual_size.
+HEADER_SIZE = _HEADER_V2.size
+
+# The only incompatible feature we can handle is the dirty bit, the L1 and
+# L2 tables of dirty images are still valid.
+_INCOMPAT_DIRTY = 1
+
+_OFFSET_MASK = 0x00fffffffffffe00
+_L2_COMPRESSED = 1 << 62
+_L2_ZERO = 1
+
+
+class Qcow2Error(Exception):
+    """The image is not a valid qcow2 image."""
+
+
+class UnsupportedImageError(Qcow2Error):
+    """The image uses features the streaming converter does not support.
+
+    It is raised before anything is written to the device, so the image can
+    be converted by other means.
+    """
+
+
+def read_virtual_size(header):
+    """Get the virtual size of a qcow2 image from its header.
+
+    :param header: The beginning of the image file, at least HEADER_SIZE
+                   bytes.
+    :raises: Qcow2Error if the data is not a qcow2 header.
+    :returns: The virtual size of the image in bytes.
+    """
+    if len(header) < _HEADER_V2.size:
+        raise Qcow2Error('The qcow2 header is truncated')
+    fields = _HEADER_V2.unpack_from(header)
+    if fields[0] != QCOW2_MAGIC:
+        raise Qcow2Error('Not a qcow2 image')
+    return fields[5]
+
+
+class _Extent(object):
+    """A range of the image file waiting to be read."""
+
+    def __init__(self, start, length, callback, claims=True):
+        self.start = start
+        self.end = start + length
+        self.callback = callback
+        # Whether the extent covers whole clusters that are not shared with
+        # other data. Compressed clusters do not.
+        self.claims = claims
+        self.buf = None
+        self.filled = 0
+        self.done = False
+
+    def feed(self, cluster_start, data):
+        start = max(self.start, cluster_start)
+        end = min(self.end, cluster_start + len(data))
+        if end <= start or self.done:
+            return
+        if start == self.start and end == self.end:
+            self.filled = end - start
+            self.done = True
+            self.callback(data[start - cluster_start:end - cluster_start])
+            return
+        if self.buf is None:
+            self.buf = bytearray(self.end - self.start)
+        self.buf[start - self.start:end - self.start] = (
+            data[start - cluster_start:end - cluster_start])
+        self.filled += end - start
+        if self.filled == self.end - self.start:
+            self.complete()
+
+    def complete(self):
+        buf, self.buf = self.buf, None
+        self.done = True
+        self.callback(memoryview(buf)[:self.filled])
+
+
+class StreamConverter(object):
+    """File-like object converting a qcow2 stream onto a device.
+
+    Data is passed to ``write`` in the order of the image file. Calling
+    ``finish`` after the last write checks that the whole image has been
+    converted, zeroes the unallocated ranges and syncs the device.
+    """
+
+    def __init__(self, device, spill_dir=None):
+        """Open ``device`` for writing.
+
+        :param device: The path to the device to write to.
+        :param spill_dir: The directory for clusters that cannot be written
+                          when they arrive. Defaults to the system temporary
+                          directory.
+        """
+        self.name = device
+        self._spill_dir = spill_dir
+        self._fd = None
+        self._partial = bytearray()
+        self._version = None
+        self._cluster_bits = None
+        self._cluster_size = None
+        self._l2_entries = None
+        self._next_cluster = 0
+        self._current = None
+        self._needed = {}
+        self._truncated = []
+        self._pending_l2 = None
+        self._spill = None
+        self._spilled = {}
+        self._zero_run = None
+        self._offload_zeroing = True
+        self.virtual_size = None
+        self.bytes_written = 0
+        self.bytes_zeroed = 0
+        self.bytes_spilled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.close()
+
+    @property
+    def metadata_complete(self):
+        """Whether the L1 table and all L2 tables have been read."""
+        return self._pending_l2 == 0
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = os.open(self.name, os.O_WRONLY)
+
+    def _parse_header(self):
+        (magic, version, backing_file_offset, _backing_file_size,
+         cluster_bits, size, crypt_method, l1_size, l1_table_offset,
+         refcount_table_offset, refcount_table_clusters, _nb_snapshots,
+         _snapshots_offset) = _HEADER_V2.unpack_from(self._partial)
+        if magic != QCOW2_MAGIC:
+            raise Qcow2Error('Not a qcow2 image')
+        if version not in (2, 3):
+            raise UnsupportedImageError(
+                'Unsupported qcow2 version %d' % version)
+        if backing_file_offset:
+            raise UnsupportedImageError('Images with a backing file are '
+                                        'not supported')
+        if crypt_method:
+            raise UnsupportedImageError('Encrypted images are not supported')
+        if not 9 <= cluster_bits <= 21:
+            raise Qcow2Error('Invalid cluster size 2^%d' % cluster_bits)
+        if version == 3:
+            incompatible = _HEADER_V3.unpack_from(self._partial,
+                                                  _HEADER_V2.size)[0]
+            if incompatible & ~_INCOMPAT_DIRTY:
+                raise UnsupportedImageError(
+                    'Unsupported incompatible features 0x%x' % incompatible)
+
+        self._version = version
+        self._cluster_bits = cluster_bits
+        self._cluster_size = 1 << cluster_bits
+        self._l2_entries = self._cluster_size // 8
+        self.virtual_size = size
+        LOG.debug('Streaming qcow2 image of %(size)d bytes with cluster size '
+                  '%(cluster)d onto %(dev)s',
+                  {'size': size, 'cluster': self._cluster_size,
+                   'dev': self.name})
+
+        self._add(l1_table_offset, l1_size * 8, self._on_l1_table)
+        self._add(refcount_table_offset,
+                  refcount_table_clusters * self._cluster_size,
+                  self._on_refcount_table)
+
+    def _add(self, start, length, callback, claims=True):
+        """Request a range of the image file.
+
+        :param start: The offset of the range in the image file.
+        :param length: The length of the range.
+        :param callback: Called with the data of the range, or None to only
+                         mark the range as not needing to be spilled.
+        :param claims: Whether the range covers whole clusters.
+        """
+        extent = _Extent(start, length, callback, claims=claims)
+        if not length:
+            if callback is not None:
+                callback(memoryview(b''))
+            return extent
+        cluster_size = self._cluster_size
+        for cluster in range(start // cluster_size,
+                             (start + length - 1) // cluster_size + 1):
+            if self._current is not None and cluster == self._current[0]:
+                if callback is not None:
+                    extent.feed(cluster * cluster_size, self._current[1])
+            elif cluster < self._next_cluster:
+                if callback is not None:
+                    extent.feed(cluster * cluster_size,
+                                self._read_spilled(cluster))
+            else:
+                self._needed.setdefault(cluster, []).append(extent)
+
+    def _read_spilled(self, cluster):
+        try:
+            offset, length = self._spilled[cluster]
+        except KeyError:
+            raise Qcow2Error('Cluster at offset %d is referenced after it '
+                             'has been discarded'
+                             % (cluster * self._cluster_size))
+        self._spill.seek(offset)
+        return self._spill.read(length)
+
+    def _spill_cluster(self, cluster, data):
+        if self._spill is None:
+            LOG.warning('The layout of the qcow2 image requires temporarily '
+                        'storing clusters in %s',
+                        self._spill_dir or tempfile.gettempdir())
+            self._spill = tempfile.TemporaryFile(dir=self._spill_dir)
+        self._spill.seek(0, 2)
+        self._spilled[cluster] = (self._spill.tell(), len(data))
+        self._spill.write(data)
+        self.bytes_spilled += len(data)
+
+    def _drop_spill(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        self._spilled = {}
+
+    def _process_cluster(self, data):
+        cluster = self._next_cluster
+        self._current = (cluster, data)
+        try:
+            claimed = cluster == 0
+            for extent in self._needed.pop(cluster, ()):
+                claimed = claimed or extent.claims
+                if extent.callback is not None:
+                    extent.feed(cluster * self._cluster_size, data)
+                    if len(data) < self._cluster_size and not extent.done:
+                        # The last cluster of the file is incomplete.
+                        self._truncated.append(extent)
+            if not claimed and not self.metadata_complete:
+                self._spill_cluster(cluster, data)
+        finally:
+            self._current = None
+            self._next_cluster += 1
+
+    def write(self, data):
+        """Convert the next part of the image.
+
+        :param data: A bytes-like object.
+        :raises: Qcow2Error if the image is invalid.
+        :raises: UnsupportedImageError if the image cannot be converted.
+        :raises: ImageWriteError if writing to the device fails.
+        """
+        try:
+            self._write(memoryview(data))
+        except (OSError, IOError) as e:
+            raise errors.ImageWriteError(self.name, e.errno, '', str(e))
+
+    def _write(self, view):
+        while view:
+            if self._cluster_size is None:
+                length = min(len(view), _HEADER_SIZE - len(self._partial))
+                self._partial += view[:length]
+                view = view[length:]
+                if len(self._partial) == _HEADER_SIZE:
+                    self._parse_header()
+                continue
+
+            if not self._partial and len(view) >= self._cluster_size:
+                self._process_cluster(view[:self._cluster_size])
+                view = view[self._cluster_size:]
+                continue
+
+            length = min(len(view), self._cluster_size - len(self._partial))
+            self._partial += view[:length]
+            view = view[length:]
+            if len(self._partial) == self._cluster_size:
+                self._process_cluster(memoryview(self._partial))
+                self._partial = bytearray()
+
+    def _on_l1_table(self, data):
+        entries = struct.unpack('>%dQ' % (len(data) // 8), data)
+        guest_span = self._l2_entries * self._cluster_size
+        self._pending_l2 = 0
+        for index, entry in enumerate(entries):
+            guest = index * guest_span
+            if guest >= self.virtual_size:
+                break
+            offset = entry & _OFFSET_MASK
+            if offset:
+                self._check_aligned(offset)
+                self._pending_l2 += 1
+                self._add(offset, self._cluster_size,
+                          self._l2_table_callback(guest))
+            else:
+                self._zero(guest, guest_span)
+        else:
+            # The L1 table does not cover the whole image.
+            guest = len(entries) * guest_span
+            if guest < self.virtual_size:
+                self._zero(guest, self.virtual_size - guest)
+        self._check_metadata_complete()
+
+    def _l2_table_callback(self, guest):
+        def _callback(data):
+            self._on_l2_table(guest, data)
+        return _callback
+
+    def _on_l2_table(self, guest_start, data):
+        entries = struct.unpack('>%dQ' % self._l2_entries, data)
+        cluster_size = self._cluster_size
+        for index, entry in enumerate(entries):
+            guest = guest_start + index * cluster_size
+            if guest >= self.virtual_size:
+                break
+            if entry & _L2_COMPRESSED:
+                self._add_compressed(guest, entry)
+                continue
+            offset = entry & _OFFSET_MASK
+            if offset and not (self._version == 3
+                               and entry & _L2_ZERO):
+                self._check_aligned(offset)
+                self._add(offset, cluster_size, self._data_callback(guest))
+            else:
+                self._zero(guest, cluster_size)
+        self._pending_l2 -= 1
+        self._check_metadata_complete()
+
+    def _add_compressed(self, guest, entry):
+        bits = 62 - (self._cluster_bits - 8)
+        offset = entry & ((1 << bits) - 1)
+        sectors = ((entry >> bits)
+                   & ((1 << (self._cluster_bits - 8)) - 1)) + 1
+        length = sectors * 512 - (offset & 511)
+
+        def _callback(data):
+            decompressor = zlib.decompressobj(-12)
+            try:
+                cluster = decompressor.decompress(bytes(data),
+                                                  self._cluster_size)
+            except zlib.error as e:
+                raise Qcow2Error('Invalid compressed cluster at offset '
+                                 '%d: %s' % (offset, e))
+            if len(cluster) < min(self._cluster_size,
+                                  self.virtual_size - guest):
+                raise Qcow2Error('Short compressed cluster at offset %d'
+                                 % offset)
+            self._write_guest(guest, cluster)
+
+        self._add(offset, length, _callback, claims=False)
+
+    def _data_callback(self, guest):
+        def _callback(data):
+            self._write_guest(guest, data)
+        return _callback
+
+    def _on_refcount_table(self, data):
+        # Refcount blocks are not needed, but must not be spilled.
+        for entry in struct.unpack('>%dQ' % (len(data) // 8), data):
+            offset = entry & _OFFSET_MASK
+            if offset:
+                self._add(offset, self._cluster_size, None)
+
+    def _check_aligned(self, offset):
+        if offset % self._cluster_size:
+            raise Qcow2Error('Unaligned cluster offset %d' % offset)
+
+    def _check_metadata_complete(self):
+        if self.metadata_complete:
+            LOG.debug('All qcow2 tables of the image for %s have been read',
+                      self.name)
+            self._drop_spill()
+
+    def _write_guest(self, guest, data):
+        self._open()
+        length = min(len(data), self.virtual_size - guest)
+        image_writer._pwrite_all(self._fd, memoryview(data)[:length], guest)
+        self.bytes_written += length
+
+    def _zero(self, guest, length):
+        length = min(length, self.virtual_size - guest)
+        if self._zero_run is not None:
+            start, end = self._zero_run
+            if guest == end:
+                self._zero_run = (start, end + length)
+                return
+            self._flush_zero_run()
+        self._zero_run = (guest, guest + length)
+
+    def _flush_zero_run(self):
+        if self._zero_run is None:
+            return
+        self._open()
+        start, end = self._zero_run
+        self._zero_run = None
+        self._offload_zeroing = image_writer.zero_range(
+            self._fd, start, end - start, offload=self._offload_zeroing)
+        self.bytes_zeroed += end - start
+
+    def finish(self):
+        """Finish the conversion after the whole image has been written.
+
+        :raises: Qcow2Error if the image is truncated or invalid.
+        :raises: ImageWriteError if writing to the device fails.
+        """
+        try:
+            self._finish()
+        except (OSError, IOError) as e:
+            raise errors.ImageWriteError(self.name, e.errno, '', str(e))
+
+    def _finish(self):
+        if self._cluster_size is None:
+            raise Qcow2Error('The image is too short for a qcow2 image')
+        if self._partial:
+            self._process_cluster(memoryview(self._partial))
+            self._partial = bytearray()
+
+        missing = self._truncated
+        for cluster in sorted(self._needed):
+            missing.extend(self._needed.pop(cluster))
+        for extent in missing:
+            if extent.callback is None or extent.done:
+                continue
+            # Compressed data may be described as ending past the end of
+            # the file, anything else must be complete.
+            if extent.claims or not extent.filled:
+                raise Qcow2Error('The image is truncated, offset %d is '
+                                 'past its end' % extent.start)
+            extent.complete()
+        if not self.metadata_complete:
+            raise Qcow2Error('The image is truncated, some of its tables '
+                             'are missing')
+
+        self._flush_zero_run()
+        self._open()
+        os.fsync(self._fd)
+        LOG.info('Converted qcow2 image onto %(dev)s: %(written)d bytes '
+                 'written, %(zeroed)d bytes zeroed, %(spilled)d bytes '
+                 'spilled', {'dev': self.name,
+                             'written': self.bytes_written,
+                             'zeroed': self.bytes_zeroed,
+                             'spilled': self.bytes_spilled})
+
+    def close(self):
+        """Release the device and the temporary storage."""
+        self._drop_spill()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,297 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parallel verification of images against per-segment digests.
+
+A segment manifest lists the digests of consecutive byte ranges of an
+image. It is published in the checksum file of the image, one line per
+segment, next to the usual line for the whole image::
+
+    <hex digest>  <file name>@<offset>+<length>
+
+Segments are hashed on a pool of threads, hashlib releases the GIL while
+hashing, so verification scales with the number of CPUs instead of being
+bound to one. Data is only handed out once its segment has verified, and a
+segment failing to verify is fetched again on its own.
+
+The same digests are used to read an image back from the device it has
+been written to, see :func:`read_back`.
+"""
+
+import bisect
+import collections
+import mmap
+from multiprocessing.pool import ThreadPool
+import time
+
+from oslo_log import log
+from oslo_utils import units
+
+from ironic_python_agent import errors
+from ironic_python_agent import image_writer
+
+LOG = log.getLogger(__name__)
+
+Segment = collections.namedtuple('Segment', ['start', 'length', 'digest'])
+
+
+def parse_manifest(lines, name):
+    """Parse the segment manifest of an image from a checksum file.
+
+    :param lines: The non-empty lines of the checksum file.
+    :param name: The file name of the image.
+    :raises: ValueError if the segments are malformed or do not cover the
+             image without gaps.
+    :returns: A list of Segment tuples ordered by offset, empty if the file
+              has no segments for the image.
+    """
+    segments = []
+    for line in lines:
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            continue
+        digest, fname = parts
+        # The star symbol designates binary mode, like for whole images.
+        base, sep, span = fname.strip().lstrip('*').rpartition('@')
+        if not sep or base != name:
+            continue
+        try:
+            start, length = (int(value) for value in span.split('+'))
+        except ValueError:
+            raise ValueError('Invalid segment {}'.format(span))
+        segments.append(Segment(start, length, digest.strip().lower()))
+
+    segments.sort()
+    end = 0
+    for segment in segments:
+        if segment.start != end or segment.length <= 0:
+            raise ValueError('Segments do not cover the image without gaps '
+                             'at byte {}'.format(end))
+        end += segment.length
+    return segments
+
+
+def _digest(hash_factory, chunks):
+    hash_obj = hash_factory()
+    for chunk in chunks:
+        hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
+class SegmentVerifier(object):
+    """Verifies a stream of image data segment by segment."""
+
+    def __init__(self, image_id, hash_factory, segments, workers, refetch):
+        """Create the verifier.
+
+        :param image_id: The image ID for logging and errors.
+        :param hash_factory: A callable returning a new hash object.
+        :param segments: A list of Segment tuples, see
+                         :func:`parse_manifest`.
+        :param workers: The number of segments hashed concurrently. As many
+                        segments are kept in memory while being hashed.
+        :param refetch: A callable taking the first and the last byte of a
+                        segment and returning its data again, or None if
+                        that is not possible.
+        """
+        self.image_id = image_id
+        self.segments = segments
+        self.size = segments[-1].start + segments[-1].length
+        self.refetched = 0
+        self._hash_factory = hash_factory
+        self._workers = workers
+        self._refetch = refetch
+        self._starts = [segment.start for segment in segments]
+
+    def segment_start(self, offset):
+        """Get the start of the segment containing an offset."""
+        index = bisect.bisect_right(self._starts, offset) - 1
+        return self._starts[max(index, 0)]
+
+    def _error(self, segment, calculated):
+        location = 'bytes {}-{}'.format(segment.start,
+                                        segment.start + segment.length - 1)
+        return errors.ImageChecksumError(self.image_id, location,
+                                         segment.digest, calculated)
+
+    def _finish(self, segment, chunks, result, offset):
+        calculated = result.get()
+        if calculated != segment.digest:
+            LOG.warning('Segment at bytes %(start)d-%(end)d of image '
+                        '%(image)s failed to verify, fetching it again',
+                        {'start': segment.start, 'image': self.image_id,
+                         'end': segment.start + segment.length - 1})
+            data = self._refetch(segment.start,
+                                 segment.start + segment.length - 1)
+            if data is None or len(data) != segment.length:
+                raise self._error(segment, calculated)
+            calculated = _digest(self._hash_factory, [data])
+            if calculated != segment.digest:
+                raise self._error(segment, calculated)
+            self.refetched += 1
+            chunks = [memoryview(data)]
+
+        position = segment.start
+        for chunk in chunks:
+            if position + len(chunk) > offset:
+                yield chunk[max(offset - position, 0):]
+            position += len(chunk)
+
+    def verify(self, chunks, offset=0):
+        """Verify a stream of image data.
+
+        :param chunks: An iterable of chunks of the image, starting at
+                       ``segment_start(offset)``.
+        :param offset: The first byte of the image to return.
+        :raises: ImageChecksumError if a segment fails to verify, even after
+                 fetching it again, or if the stream does not match the
+                 manifest in size.
+        :returns: A generator of verified chunks of the image, starting at
+                  ``offset``.
+        """
+        index = bisect.bisect_right(self._starts, offset) - 1
+        pool = ThreadPool(self._workers)
+        pending = collections.deque()
+        buffered = []
+        size = 0
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                while view:
+                    if index >= len(self.segments):
+                        raise errors.ImageChecksumError(
+                            self.image_id, 'bytes {}-'.format(self.size),
+                            'end of image', 'more data')
+                    segment = self.segments[index]
+                    length = min(len(view), segment.length - size)
+                    buffered.append(view[:length])
+                    size += length
+                    view = view[length:]
+                    if size < segment.length:
+                        continue
+
+                    pending.append((segment, buffered, pool.apply_async(
+                        _digest, (self._hash_factory, buffered))))
+                    buffered = []
+                    size = 0
+                    index += 1
+                    if len(pending) >= self._workers:
+                        for verified in self._finish(*pending.popleft(),
+                                                     offset=offset):
+                            yield verified
+
+            while pending:
+                for verified in self._finish(*pending.popleft(),
+                                             offset=offset):
+                    yield verified
+
+            if index < len(self.segments):
+                segment = self.segments[index]
+                raise errors.ImageChecksumError(
+                    self.image_id, 'bytes {}-'.format(segment.start + size),
+                    'more data', 'end of image')
+        finally:
+            pool.terminate()
+
+
+def _read_segment(reader, hash_factory, start, length, block_size):
+    buf = mmap.mmap(-1, block_size)
+    hash_obj = hash_factory()
+    for offset in range(start, start + length, block_size):
+        hash_obj.update(reader.read(
+            offset, min(block_size, start + length - offset), buf))
+    return hash_obj.hexdigest()
+
+
+def _read_block(reader, offset, length):
+    buf = mmap.mmap(-1, length + image_writer.DIRECT_IO_ALIGNMENT)
+    return bytes(reader.read(offset, length, buf))
+
+
+def read_back(path, size, hash_factory, expected, segments=None,
+              readers=4, block_size=4 * units.Mi):
+    """Verify an image written to a device by reading it back.
+
+    The device is read with ``readers`` concurrent O_DIRECT readers. With a
+    segment manifest every reader hashes whole segments, otherwise blocks
+    are read ahead concurrently and hashed in order. Ranges skipped as
+    sparse holes are read like any other, so they are checked to be zeros
+    through the digests.
+
+    :param path: The path to the device.
+    :param size: The size of the image in bytes.
+    :param hash_factory: A callable returning a new hash object.
+    :param expected: The expected hex digest of the whole image, used if
+                     there are no segments.
+    :param segments: Optional list of Segment tuples covering ``size``.
+    :param readers: The number of concurrent readers.
+    :param block_size: The size of a single read request in bytes, a
+                       multiple of image_writer.DIRECT_IO_ALIGNMENT.
+    :raises: ImageChecksumError if the data on the device does not match.
+    :raises: ImageWriteError if reading the device fails.
+    :returns: A dictionary with the number of bytes read, the time taken
+              and the read throughput.
+    """
+    started = time.time()
+    pool = ThreadPool(readers)
+    try:
+        with image_writer.DirectIOReader(path) as reader:
+            if segments:
+                results = [(segment, pool.apply_async(
+                    _read_segment, (reader, hash_factory, segment.start,
+                                    segment.length, block_size)))
+                           for segment in segments]
+                for segment, result in results:
+                    calculated = result.get()
+                    if calculated != segment.digest:
+                        location = '{} bytes {}-{}'.format(
+                            path, segment.start,
+                            segment.start + segment.length - 1)
+                        raise errors.ImageChecksumError(
+                            path, location, segment.digest, calculated)
+            else:
+                hash_obj = hash_factory()
+                pending = collections.deque()
+                offsets = iter(range(0, size, block_size))
+                for offset in offsets:
+                    pending.append(pool.apply_async(
+                        _read_block,
+                        (reader, offset, min(block_size, size - offset))))
+                    if len(pending) >= readers:
+                        break
+                while pending:
+                    data = pending.popleft().get()
+                    for offset in offsets:
+                        pending.append(pool.apply_async(
+                            _read_block,
+                            (reader, offset, min(block_size, size - offset))))
+                        break
+                    hash_obj.update(data)
+                calculated = hash_obj.hexdigest()
+                if calculated != expected:
+                    raise errors.ImageChecksumError(path, path, expected,
+                                                    calculated)
+    except (OSError, IOError) as e:
+        raise errors.ImageWriteError(path, e.errno, '',
+                                     'Unable to read back the image: '
+                                     '{}'.format(e))
+    finally:
+        pool.terminate()
+
+    elapsed = time.time() - started
+    stats = {'bytes_read': size, 'seconds': elapsed,
+             'bytes_per_second': size / elapsed if elapsed else None}
+    LOG.info('Read back %(size)d bytes from %(path)s in %(time).2f seconds '
+             '(%(rate).2f MiB/s), the image is intact',
+             {'size': size, 'path': path, 'time': elapsed,
+              'rate': (stats['bytes_per_second'] or 0) / units.Mi})
+    return stats
@@ -60,6 +60,9 @@ class IronicAgentTest(test_base.BaseTestCase):
             self.patch(utils, 'execute', do_not_call)
 
         hardware._CACHED_HW_INFO = None
+        hardware.invalidate_system_lshw_dict()
+        hardware._BLOCK_DEVICE_CACHE.clear()
+        hardware._BLOCK_DEVICE_MONITOR = None
 
     def _set_config(self):
         self.cfg_fixture = self.useFixture(config_fixture.Config(CONF))
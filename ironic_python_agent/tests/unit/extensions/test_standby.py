@@ -12,17 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import errno
+import hashlib
 import os
+import struct
 import tempfile
+import threading
 import time
+import zlib
 
+import fixtures
+from ironic_lib import disk_utils
 import mock
 from oslo_concurrency import processutils
 import requests
 
+from ironic_python_agent import decompress
 from ironic_python_agent import errors
 from ironic_python_agent.extensions import standby
 from ironic_python_agent import hardware
+from ironic_python_agent import image_writer
+from ironic_python_agent import qcow2
+from ironic_python_agent import segment_hash
 from ironic_python_agent.tests.unit import base
 
 
@@ -36,6 +48,11 @@ def _build_fake_image_info(url='http://example.org'):
     }
 
 
+def _gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
 def _build_fake_partition_image_info():
     return {
         'id': 'fake_id',
@@ -91,6 +108,82 @@ class TestStandbyExtension(base.IronicAgentTest):
                               standby._validate_image_info,
                               invalid_info)
 
+    def test_validate_image_info_invalid_download_connections(self):
+        for value in (0, -1, 'many', None):
+            invalid_info = _build_fake_image_info()
+            invalid_info['download_connections'] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    def test_validate_image_info_invalid_peers(self):
+        for value in ('http://peer', [1]):
+            invalid_info = _build_fake_image_info()
+            invalid_info['peers'] = value
+
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              standby._validate_image_info,
+                              None, invalid_info)
+
+    def test_validate_image_info_invalid_rate_limit(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['download_rate_limit'] = -1
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_invalid_sparse_policy(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['sparse_policy'] = 'trim'
+
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          standby._validate_image_info,
+                          None, invalid_info)
+
+    def test_validate_image_info_invalid_compression(self):
+        invalid_info = _build_fake_image_info()
+        invalid_info['compression'] = 'bzip2'
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'must be one of gzip, xz, zstd',
+                               standby._validate_image_info,
+                               None, invalid_info)
+
+    @mock.patch.object(decompress, 'is_supported', autospec=True,
+                       return_value=False)
+    def test_validate_image_info_unsupported_compression(self,
+                                                         supported_mock):
+        invalid_info = _build_fake_image_info()
+        invalid_info['compression'] = 'zstd'
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'not supported by this ramdisk',
+                               standby._validate_image_info,
+                               None, invalid_info)
+        supported_mock.assert_called_once_with('zstd')
+
+    @mock.patch.object(standby, '_preflight_image', autospec=True)
+    def test_validate_image_info_preflight(self, preflight_mock):
+        self.config(image_preflight=True)
+        image_info = _build_fake_image_info()
+
+        preflight_mock.return_value = {
+            'expected_hash': (hashlib.md5, 'abc123')}
+
+        standby._validate_image_info(self.agent_extension, image_info)
+
+        preflight_mock.assert_called_once_with(image_info)
+        self.assertEqual(('fake_id', (hashlib.md5, 'abc123')),
+                         self.agent_extension.preflight_hash)
+
+    @mock.patch.object(standby, '_preflight_image', autospec=True)
+    def test_validate_image_info_no_preflight(self, preflight_mock):
+        standby._validate_image_info(None, _build_fake_image_info())
+
+        self.assertFalse(preflight_mock.called)
+
     def test_validate_image_info_invalid_urls(self):
         invalid_info = _build_fake_image_info()
         invalid_info['urls'] = 'this_is_not_a_list'
@@ -176,6 +269,114 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         execute_mock.assert_called_once_with(*command, check_exit_code=[0])
 
+    def _write_in_agent_files(self, image_data):
+        image_info = _build_fake_image_info()
+        image_info['write_in_agent'] = True
+        image_info['disk_format'] = 'raw'
+        with open(standby._image_location(image_info), 'wb') as f:
+            f.write(image_data)
+        device = os.path.join(tempfile.gettempdir(), 'device')
+        with open(device, 'wb') as f:
+            f.write(b'\xff' * 100 * 1024)
+        return image_info, device
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_image_in_agent(self, execute_mock):
+        data = b'SpongeBob' * 1000
+        image_info, device = self._write_in_agent_files(data)
+
+        standby._write_image(image_info, device)
+
+        with open(device, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertFalse(execute_mock.called)
+
+    def test_wipe_partition_tables(self):
+        image_info, device = self._write_in_agent_files(b'')
+
+        standby._wipe_partition_tables(device)
+
+        # 512 byte blocks: the MBR, the GPT header and 32 blocks of entries.
+        span = 34 * 512
+        with open(device, 'rb') as f:
+            written = f.read()
+        self.assertEqual(b'\0' * span, written[:span])
+        self.assertEqual(b'\xff' * (100 * 1024 - 2 * span),
+                         written[span:-span])
+        self.assertEqual(b'\0' * span, written[-span:])
+
+    @mock.patch.object(image_writer, 'get_logical_block_size', autospec=True)
+    def test_wipe_partition_tables_4k(self, block_size_mock):
+        block_size_mock.return_value = 4096
+        image_info, device = self._write_in_agent_files(b'')
+
+        standby._wipe_partition_tables(device)
+
+        # 4096 byte blocks: the MBR, the GPT header and 4 blocks of entries.
+        span = 6 * 4096
+        with open(device, 'rb') as f:
+            written = f.read()
+        self.assertEqual(b'\0' * span, written[:span])
+        self.assertEqual(b'\xff' * (100 * 1024 - 2 * span),
+                         written[span:-span])
+        self.assertEqual(b'\0' * span, written[-span:])
+
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_image_in_agent_qcow2(self, execute_mock, converter_mock):
+        image_info, device = self._write_in_agent_files(
+            b'QFI\xfb' + b'\0' * 1000)
+        image_info['disk_format'] = 'qcow2'
+        converter = converter_mock.return_value
+
+        standby._write_image(image_info, device)
+
+        converter_mock.assert_called_once_with(device, spill_dir=None)
+        converter.write.assert_called_once_with(b'QFI\xfb' + b'\0' * 1000)
+        converter.finish.assert_called_once_with()
+        converter.close.assert_called_once_with()
+        self.assertFalse(execute_mock.called)
+
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_image_in_agent_unsupported_qcow2(self, execute_mock,
+                                                    converter_mock):
+        image_info, device = self._write_in_agent_files(
+            b'QFI\xfb' + b'\0' * 1000)
+        converter_mock.return_value.write.side_effect = (
+            qcow2.UnsupportedImageError('backing files'))
+        execute_mock.return_value = ('', '')
+
+        standby._write_image(image_info, device)
+
+        script = standby._path_to_script('shell/write_image.sh')
+        execute_mock.assert_called_once_with(
+            '/bin/bash', script, standby._image_location(image_info), device,
+            check_exit_code=[0])
+        converter_mock.return_value.close.assert_called_once_with()
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_image_in_agent_unsupported_format(self, execute_mock):
+        image_info, device = self._write_in_agent_files(b'KDMV' + b'\0' * 60)
+        image_info['disk_format'] = 'vmdk'
+        execute_mock.return_value = ('', '')
+
+        standby._write_image(image_info, device)
+
+        self.assertTrue(execute_mock.called)
+        with open(device, 'rb') as f:
+            self.assertEqual(b'\xff' * 100 * 1024, f.read())
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_write_image_in_agent_device_error(self, execute_mock):
+        image_info, device = self._write_in_agent_files(b'SpongeBob')
+        os.unlink(device)
+        os.mkdir(device)
+
+        self.assertRaises(errors.ImageWriteError, standby._write_image,
+                          image_info, device)
+        self.assertFalse(execute_mock.called)
+
     @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
@@ -341,9 +542,27 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         self.assertEqual(expected_uuid, work_on_disk_mock.return_value)
 
+    @mock.patch.object(standby, '_fetch_configdrive', autospec=True)
+    @mock.patch.object(hardware, 'dispatch_to_managers', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.work_on_disk', autospec=True)
+    def test_write_partition_image_configdrive_fetch(self, work_on_disk_mock,
+                                                     dispatch_mock,
+                                                     fetch_configdrive_mock):
+        image_info = _build_fake_partition_image_info()
+        dispatch_mock.return_value = self.fake_cpu
+        configdrive_fetch = mock.Mock(spec=standby._ConfigdriveFetch)
+        configdrive_fetch.get.return_value = 'H4sICDw'
+
+        standby._write_partition_image(None, image_info, '/dev/sda',
+                                       configdrive_fetch)
+
+        self.assertFalse(fetch_configdrive_mock.called)
+        self.assertEqual('H4sICDw',
+                         work_on_disk_mock.call_args[1]['configdrive'])
+
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_download_image(self, requests_mock, open_mock, md5_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
@@ -356,7 +575,7 @@ class TestStandbyExtension(base.IronicAgentTest):
         hexdigest_mock.return_value = image_info['checksum']
 
         standby._download_image(image_info)
-        requests_mock.assert_called_once_with(image_info['urls'][0],
+        requests_mock.assert_called_once_with(mock.ANY, image_info['urls'][0],
                                               cert=None, verify=True,
                                               stream=True, proxies={},
                                               timeout=60)
@@ -367,14 +586,14 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     @mock.patch.dict(os.environ, {})
     def test_download_image_proxy(
             self, requests_mock, open_mock, md5_mock):
         image_info = _build_fake_image_info()
         proxies = {'http': 'http://a.b.com',
                    'https': 'https://secure.a.b.com'}
-        no_proxy = '.example.org,.b.com'
+        no_proxy = '.example.com,.b.com'
         image_info['proxies'] = proxies
         image_info['no_proxy'] = no_proxy
         response = requests_mock.return_value
@@ -387,17 +606,109 @@ class TestStandbyExtension(base.IronicAgentTest):
         hexdigest_mock.return_value = image_info['checksum']
 
         standby._download_image(image_info)
-        self.assertEqual(no_proxy, os.environ['no_proxy'])
-        requests_mock.assert_called_once_with(image_info['urls'][0],
+        self.assertNotIn('no_proxy', os.environ)
+        expected = dict(proxies, no_proxy=no_proxy)
+        requests_mock.assert_called_once_with(mock.ANY, image_info['urls'][0],
                                               cert=None, verify=True,
-                                              stream=True, proxies=proxies,
+                                              stream=True, proxies=expected,
                                               timeout=60)
         write = file_mock.write
         write.assert_any_call('some')
         write.assert_any_call('content')
         self.assertEqual(2, write.call_count)
 
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    @mock.patch.dict(os.environ, {})
+    def test_download_image_no_proxy(self, requests_mock):
+        image_info = _build_fake_image_info('http://images.b.com/image')
+        image_info['proxies'] = {'http': 'http://a.b.com'}
+        image_info['no_proxy'] = '.example.org,.b.com'
+        requests_mock.return_value.status_code = 200
+
+        standby._download_with_proxy(image_info, image_info['urls'][0],
+                                     image_info['id'])
+
+        self.assertNotIn('no_proxy', os.environ)
+        requests_mock.assert_called_once_with(
+            mock.ANY, image_info['urls'][0], cert=None, verify=True,
+            stream=True, proxies={'no_proxy': '.example.org,.b.com'},
+            timeout=60)
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_download_shared_session(self, requests_mock):
+        requests_mock.return_value.status_code = 200
+        image_info = _build_fake_image_info()
+
+        standby._download_with_proxy(image_info, 'http://example.org/1',
+                                     image_info['id'])
+        standby._download_with_proxy(image_info, 'http://example.org/2',
+                                     image_info['id'])
+
+        first, second = requests_mock.call_args_list
+        self.assertIs(first[0][0], second[0][0])
+        self.assertIs(standby._get_session(), first[0][0])
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_fetch_configdrive(self, requests_mock):
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.content = b'H4sICDw'
+
+        self.assertEqual('H4sICDw', standby._fetch_configdrive(
+            'http://example.org/configdrive'))
+        requests_mock.assert_called_once_with(
+            mock.ANY, 'http://example.org/configdrive', cert=None,
+            verify=True, stream=True, proxies={}, timeout=60)
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_fetch_configdrive_for_ironic_lib(self, requests_mock):
+        content = base64.b64encode(_gzip(b'configdrive'))
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.content = content
+
+        configdrive = standby._fetch_configdrive(
+            'http://example.org/configdrive')
+        size, path = disk_utils._get_configdrive(
+            configdrive, 'node', tempdir=self.useFixture(
+                fixtures.TempDir()).path)
+
+        self.assertEqual(content.decode('ascii'), configdrive)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'configdrive', f.read())
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_fetch_configdrive_binary(self, requests_mock):
+        requests_mock.return_value.status_code = 200
+        requests_mock.return_value.content = b'\xff\xfe binary'
+
+        self.assertEqual('http://example.org/configdrive',
+                         standby._fetch_configdrive(
+                             'http://example.org/configdrive'))
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_fetch_configdrive_content(self, requests_mock):
+        self.assertEqual('H4sICDw', standby._fetch_configdrive('H4sICDw'))
+        self.assertIsNone(standby._fetch_configdrive(None))
+        self.assertFalse(requests_mock.called)
+
+    @mock.patch.object(standby, '_fetch_configdrive', autospec=True)
+    def test_configdrive_fetch(self, fetch_mock):
+        fetch_mock.return_value = b'H4sICDw'
+
+        fetch = standby._ConfigdriveFetch('http://example.org/configdrive')
+
+        self.assertEqual(b'H4sICDw', fetch.get())
+        self.assertIsNotNone(fetch.seconds)
+        fetch_mock.assert_called_once_with('http://example.org/configdrive')
+
+    @mock.patch.object(standby, '_fetch_configdrive', autospec=True)
+    def test_configdrive_fetch_error(self, fetch_mock):
+        fetch_mock.side_effect = errors.ImageDownloadError('fake', 'boom')
+
+        fetch = standby._ConfigdriveFetch('http://example.org/configdrive')
+
+        self.assertRaisesRegex(errors.ImageDownloadError, 'boom', fetch.get)
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_download_image_bad_status(self, requests_mock):
         self.config(image_download_connection_retry_interval=0)
         image_info = _build_fake_image_info()
@@ -409,7 +720,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_download_image_verify_fails(self, requests_mock, open_mock,
                                          md5_mock):
         image_info = _build_fake_image_info()
@@ -423,7 +734,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_success(self, requests_mock, open_mock, md5_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
@@ -436,7 +747,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.new', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_success_with_new_hash_fields(self, requests_mock,
                                                        open_mock,
                                                        hashlib_mock):
@@ -454,7 +765,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.new', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_success_without_md5(self, requests_mock,
                                               open_mock, hashlib_mock):
         image_info = _build_fake_image_info()
@@ -472,7 +783,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_success_with_md5_fallback(self, requests_mock,
                                                     open_mock, md5_mock):
         image_info = _build_fake_image_info()
@@ -488,7 +799,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.new', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_failure_with_new_hash_fields(self, requests_mock,
                                                        open_mock,
                                                        hashlib_mock):
@@ -508,7 +819,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_failure(self, requests_mock, open_mock, md5_mock):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
@@ -523,7 +834,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
     @mock.patch('hashlib.new', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_verify_image_failure_without_fallback(self, requests_mock,
                                                    open_mock, hashlib_mock):
         image_info = _build_fake_image_info()
@@ -554,8 +865,10 @@ class TestStandbyExtension(base.IronicAgentTest):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -580,8 +893,10 @@ class TestStandbyExtension(base.IronicAgentTest):
         dispatch_mock.return_value = 'manager'
         async_result = self.agent_extension.cache_image(image_info=image_info)
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -591,6 +906,38 @@ class TestStandbyExtension(base.IronicAgentTest):
                       'root_uuid={}').format(image_info['id'], 'manager',
                                              'root_uuid')
         self.assertEqual(cmd_result, async_result.command_result['result'])
+        timings = async_result.command_result['timings']
+        self.assertEqual({'download', 'partitioning'},
+                         set(timings['phases']))
+        self.assertIsNone(timings['download'])
+
+    @mock.patch.object(standby, '_get_expected_hash', autospec=True)
+    @mock.patch.object(standby, '_preflight_image', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_cache_image_preflight_checksum(self, download_mock, write_mock,
+                                            dispatch_mock, preflight_mock,
+                                            hash_mock):
+        self.config(image_preflight=True)
+        image_info = _build_fake_partition_image_info()
+        download_mock.return_value = None
+        write_mock.return_value = {'root uuid': 'root_uuid'}
+        dispatch_mock.return_value = 'manager'
+        expected_hash = (hashlib.sha256, 'fetched')
+        preflight_mock.return_value = {'expected_hash': expected_hash}
+
+        async_result = self.agent_extension.cache_image(image_info=image_info)
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        download_mock.assert_called_once_with(image_info, expected_hash)
+        self.assertFalse(hash_mock.called)
+        # The next command has to check the image again.
+        self.assertIsNone(self.agent_extension.preflight_hash)
 
     @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
                 lambda dev: 'ROOT')
@@ -611,8 +958,10 @@ class TestStandbyExtension(base.IronicAgentTest):
             image_info=image_info, force=True
         )
         async_result.join()
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertEqual(image_info['id'],
                          self.agent_extension.cached_image_id)
@@ -684,8 +1033,10 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=mock.ANY)
         dispatch_mock.assert_called_once_with('get_os_install_device')
         configdrive_copy_mock.assert_called_once_with(image_info['node_uuid'],
                                                       'manager',
@@ -696,11 +1047,86 @@ class TestStandbyExtension(base.IronicAgentTest):
         cmd_result = ('prepare_image: image ({}) written to device {} '
                       'root_uuid=ROOT').format(image_info['id'], 'manager')
         self.assertEqual(cmd_result, async_result.command_result['result'])
+        self.assertEqual({'download', 'write', 'validate_partitioning',
+                          'configdrive', 'configdrive_fetch'},
+                         set(async_result.command_result['timings']['phases']))
         list_part_mock.assert_called_with('manager')
         execute_mock.assert_called_with('partprobe', 'manager',
                                         run_as_root=True,
                                         attempts=mock.ANY)
 
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch.object(standby, '_ConfigdriveFetch', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._write_image',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_prepare_image_configdrive_fetch(self, download_mock, write_mock,
+                                             dispatch_mock,
+                                             configdrive_copy_mock,
+                                             fetch_mock):
+        image_info = _build_fake_image_info()
+        download_mock.return_value = None
+        write_mock.return_value = None
+        dispatch_mock.return_value = 'manager'
+        fetch_mock.return_value.get.return_value = b'H4sICDw'
+        fetch_mock.return_value.seconds = 1.5
+        started = []
+        download_mock.side_effect = (
+            lambda info, expected_hash: started.append(fetch_mock.called))
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive='http://example.org/configdrive')
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        # The configdrive is being fetched while the image is downloaded.
+        self.assertEqual([True], started)
+        fetch_mock.assert_called_once_with('http://example.org/configdrive')
+        configdrive_copy_mock.assert_called_once_with(image_info['node_uuid'],
+                                                      'manager', b'H4sICDw')
+        self.assertEqual(1.5, async_result.command_result['timings'][
+            'phases']['configdrive_fetch'])
+
+    @mock.patch.object(standby, '_ConfigdriveFetch', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.create_config_drive_partition',
+                autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby._download_image',
+                autospec=True)
+    def test_prepare_image_configdrive_fetch_error(self, download_mock,
+                                                   dispatch_mock,
+                                                   configdrive_copy_mock,
+                                                   fetch_mock):
+        for image_info, configdrive in (
+                (_build_fake_image_info(), 'http://example.org/configdrive'),
+                (_build_fake_partition_image_info(), None)):
+            fetch_mock.reset_mock()
+            download_mock.side_effect = errors.ImageDownloadError('fake',
+                                                                  'boom')
+            dispatch_mock.return_value = 'manager'
+
+            async_result = self.agent_extension.prepare_image(
+                image_info=image_info,
+                configdrive=configdrive)
+            async_result.join()
+
+            self.assertEqual('FAILED', async_result.command_status)
+            # The fetch does not outlive the failed command.
+            fetch_mock.return_value.join.assert_called_once_with()
+            self.assertFalse(fetch_mock.return_value.get.called)
+            self.assertFalse(configdrive_copy_mock.called)
+
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
     @mock.patch('ironic_lib.disk_utils.list_partitions',
                 autospec=True)
@@ -732,8 +1158,13 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=mock.ANY)
+        # The configdrive is fetched while the image is downloaded.
+        self.assertEqual('configdrive', write_mock.call_args[1][
+            'configdrive_fetch'].get())
         dispatch_mock.assert_called_once_with('get_os_install_device')
         self.assertFalse(configdrive_copy_mock.called)
 
@@ -802,8 +1233,10 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
 
         self.assertEqual(0, configdrive_copy_mock.call_count)
@@ -852,8 +1285,10 @@ class TestStandbyExtension(base.IronicAgentTest):
         )
         async_result.join()
 
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, 'manager')
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, 'manager',
+                                           configdrive_fetch=None)
         dispatch_mock.assert_called_once_with('get_os_install_device')
 
         self.assertFalse(configdrive_copy_mock.called)
@@ -917,102 +1352,433 @@ class TestStandbyExtension(base.IronicAgentTest):
         image_info['stream_raw_images'] = True
         self._test_prepare_image_raw(image_info)
 
-    def test_prepare_image_raw_and_stream_false(self):
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_raw_stream_write_stats(self, stream_mock,
+                                                  dispatch_mock):
         image_info = _build_fake_image_info()
         image_info['disk_format'] = 'raw'
-        image_info['stream_raw_images'] = False
-        self._test_prepare_image_raw(image_info)
-
-    def test_prepare_partition_image_raw_stream_true(self):
-        image_info = _build_fake_partition_image_info()
-        image_info['disk_format'] = 'raw'
         image_info['stream_raw_images'] = True
-        self._test_prepare_image_raw(image_info, partition=True)
+        image_info['sparse_policy'] = 'zeroout'
+        dispatch_mock.return_value = '/dev/foo'
+        stats = {'sparse_policy': 'zeroout', 'bytes_written': 4096,
+                 'bytes_skipped': 8192}
 
-    def test_prepare_partition_image_raw_and_stream_false(self):
-        image_info = _build_fake_partition_image_info()
-        image_info['disk_format'] = 'raw'
-        image_info['stream_raw_images'] = False
-        self._test_prepare_image_raw(image_info, partition=True)
+        def _stream(extension, image_info, device):
+            extension.write_stats = stats
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_run_shutdown_command_invalid(self, execute_mock):
-        self.assertRaises(errors.InvalidCommandParamsError,
-                          self.agent_extension._run_shutdown_command, 'boot')
+        stream_mock.side_effect = _stream
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_run_shutdown_command_fails(self, execute_mock):
-        execute_mock.side_effect = processutils.ProcessExecutionError
-        self.assertRaises(errors.SystemRebootError,
-                          self.agent_extension._run_shutdown_command, 'reboot')
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_run_shutdown_command_valid(self, execute_mock):
-        execute_mock.return_value = ('', '')
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        cmd_result = ('prepare_image: image ({}) written to device {} '
+                      'root_uuid=ROOT').format(image_info['id'], '/dev/foo')
+        self.assertEqual(cmd_result, async_result.command_result['result'])
+        self.assertEqual(stats, async_result.command_result['write_stats'])
 
-        self.agent_extension._run_shutdown_command('poweroff')
-        calls = [mock.call('sync'),
-                 mock.call('poweroff', use_standard_locale=True,
-                           check_exit_code=[0])]
-        execute_mock.assert_has_calls(calls)
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_raw_stream_read_back_stats(self, stream_mock,
+                                                      dispatch_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        image_info['read_back_readers'] = 4
+        dispatch_mock.return_value = '/dev/foo'
+        stats = {'bytes_read': 4096, 'seconds': 2.0,
+                 'bytes_per_second': 2048.0}
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_run_shutdown_command_valid_poweroff_sysrq(self, execute_mock):
-        execute_mock.side_effect = [('', ''), ('',
-                                    'Running in chroot, ignoring request.'),
-                                    ('', '')]
+        def _stream(extension, image_info, device):
+            extension.read_back_stats = stats
 
-        self.agent_extension._run_shutdown_command('poweroff')
-        calls = [mock.call('sync'),
-                 mock.call('poweroff', use_standard_locale=True,
-                           check_exit_code=[0]),
-                 mock.call("echo o > /proc/sysrq-trigger", shell=True)]
-        execute_mock.assert_has_calls(calls)
+        stream_mock.side_effect = _stream
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_run_shutdown_command_valid_reboot_sysrq(self, execute_mock):
-        execute_mock.side_effect = [('', ''), ('',
-                                    'Running in chroot, ignoring request.'),
-                                    ('', '')]
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
 
-        self.agent_extension._run_shutdown_command('reboot')
-        calls = [mock.call('sync'),
-                 mock.call('reboot', use_standard_locale=True,
-                           check_exit_code=[0]),
-                 mock.call("echo b > /proc/sysrq-trigger", shell=True)]
-        execute_mock.assert_has_calls(calls)
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        self.assertEqual(stats,
+                         async_result.command_result['read_back_stats'])
+        self.assertNotIn('write_stats', async_result.command_result)
+
+    @mock.patch.object(standby, '_read_back_image', autospec=True)
+    @mock.patch.object(standby, '_write_image', autospec=True)
+    @mock.patch.object(standby, '_download_image', autospec=True)
+    def test_cache_and_write_image_read_back(self, download_mock,
+                                             write_mock, read_back_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_run_image(self, execute_mock):
-        execute_mock.return_value = ('', '')
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
 
-        success_result = self.agent_extension.run_image()
-        success_result.join()
-        calls = [mock.call('sync'),
-                 mock.call('reboot', use_standard_locale=True,
-                           check_exit_code=[0])]
-        execute_mock.assert_has_calls(calls)
-        self.assertEqual('SUCCEEDED', success_result.command_status)
+        read_back_mock.assert_called_once_with(
+            image_info, '/dev/foo', expected_hash=(hashlib.md5, 'abc123'))
+        self.assertEqual(read_back_mock.return_value,
+                         self.agent_extension.read_back_stats)
 
-        execute_mock.reset_mock()
-        execute_mock.return_value = ('', '')
-        execute_mock.side_effect = processutils.ProcessExecutionError
+    @mock.patch.object(standby, '_read_back_image', autospec=True)
+    @mock.patch.object(standby, '_write_image', autospec=True)
+    @mock.patch.object(standby, '_download_image', autospec=True)
+    def test_cache_and_write_image_read_back_converted(self, download_mock,
+                                                       write_mock,
+                                                       read_back_mock):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
 
-        failed_result = self.agent_extension.run_image()
-        failed_result.join()
+        self.agent_extension._cache_and_write_image(image_info, '/dev/foo')
 
-        execute_mock.assert_any_call('sync')
-        self.assertEqual('FAILED', failed_result.command_status)
+        self.assertFalse(read_back_mock.called)
+        self.assertIsNone(self.agent_extension.read_back_stats)
 
-    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
-    def test_power_off(self, execute_mock):
-        execute_mock.return_value = ('', '')
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(segment_hash, 'read_back', autospec=True)
+    def test_read_back_image(self, read_back_mock, md5_mock):
+        self.config(image_read_back_readers=2)
+        image_info = _build_fake_image_info()
 
-        success_result = self.agent_extension.power_off()
-        success_result.join()
+        self.assertEqual(read_back_mock.return_value,
+                         standby._read_back_image(image_info, '/dev/foo',
+                                                  1000))
+        read_back_mock.assert_called_once_with(
+            '/dev/foo', 1000, md5_mock, 'abc123', segments=None, readers=2)
+
+    @mock.patch.object(segment_hash, 'read_back', autospec=True)
+    def test_read_back_image_disabled(self, read_back_mock):
+        self.assertIsNone(standby._read_back_image(_build_fake_image_info(),
+                                                   '/dev/foo', 1000))
+        self.assertFalse(read_back_mock.called)
+
+    @mock.patch.object(segment_hash, 'read_back', autospec=True)
+    def test_read_back_image_compressed_checksum(self, read_back_mock):
+        self.config(image_read_back_readers=2)
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'xz'
 
-        calls = [mock.call('sync'),
-                 mock.call('poweroff', use_standard_locale=True,
+        self.assertIsNone(standby._read_back_image(image_info, '/dev/foo',
+                                                   1000))
+        self.assertFalse(read_back_mock.called)
+
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_qcow2_image_onto_device', autospec=True)
+    def _test_prepare_image_qcow2(self, image_info, streamed, stream_mock,
+                                  cache_write_mock, dispatch_mock):
+        dispatch_mock.return_value = '/dev/foo'
+        stream_mock.return_value = streamed
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        stream_mock.assert_called_once_with(mock.ANY, image_info, '/dev/foo')
+        if streamed:
+            self.assertFalse(cache_write_mock.called)
+        else:
+            cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                     '/dev/foo')
+
+    def test_prepare_image_qcow2_stream(self):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['stream_qcow2'] = True
+        self._test_prepare_image_qcow2(image_info, True)
+
+    def test_prepare_image_qcow2_stream_unsupported(self):
+        self.config(image_stream_qcow2=True)
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+        self._test_prepare_image_qcow2(image_info, False)
+
+    def test_prepare_image_raw_and_stream_false(self):
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = False
+        self._test_prepare_image_raw(image_info)
+
+    def test_prepare_partition_image_raw_stream_true(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        self._test_prepare_image_raw(image_info, partition=True)
+
+    def test_prepare_partition_image_raw_and_stream_false(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = False
+        self._test_prepare_image_raw(image_info, partition=True)
+
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_partition_image', autospec=True)
+    def _test_prepare_partition_image_stream(self, image_info, streamed,
+                                             stream_mock, cache_write_mock,
+                                             dispatch_mock):
+        self.config(image_stream_partition=True)
+        self.agent_extension.partition_uuids = {'root uuid': 'root_uuid'}
+        dispatch_mock.return_value = '/dev/foo'
+        stream_mock.return_value = streamed
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        if image_info.get('virtual_size'):
+            stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                                '/dev/foo')
+        else:
+            self.assertFalse(stream_mock.called)
+        if streamed:
+            self.assertFalse(cache_write_mock.called)
+        else:
+            cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                     '/dev/foo')
+
+    def test_prepare_partition_image_stream(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['virtual_size'] = 1024 * 1024
+        self._test_prepare_partition_image_stream(image_info, True)
+
+    def test_prepare_partition_image_stream_unsupported(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['virtual_size'] = 1024 * 1024
+        self._test_prepare_partition_image_stream(image_info, False)
+
+    def test_prepare_partition_image_stream_no_virtual_size(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        self._test_prepare_partition_image_stream(image_info, False)
+
+    @mock.patch.object(standby, '_grow_filesystem', autospec=True)
+    @mock.patch('ironic_lib.disk_utils.work_on_disk', autospec=True)
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_qcow2_image_onto_device', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def _test_stream_partition_image(self, image_info, raw_mock, qcow2_mock,
+                                     dispatch_mock, work_on_disk_mock,
+                                     grow_mock, streamed=True):
+        dispatch_mock.return_value = self.fake_cpu
+        work_on_disk_mock.return_value = {
+            'root uuid': 'a318821b-2a60-40e5-a011-7ac07fce342b',
+            'partitions': {'root': '/dev/foo-part1'},
+        }
+        qcow2_mock.return_value = streamed
+
+        self.assertIs(streamed, self.agent_extension._stream_partition_image(
+            image_info, '/dev/foo'))
+
+        work_on_disk_mock.assert_called_once_with(
+            '/dev/foo', image_info['root_mb'], image_info['swap_mb'],
+            image_info['ephemeral_mb'], image_info['ephemeral_format'],
+            None, image_info['node_uuid'],
+            preserve_ephemeral=image_info['preserve_ephemeral'],
+            configdrive='configdrive', boot_option='netboot',
+            boot_mode='bios', disk_label='msdos',
+            cpu_arch=self.fake_cpu.architecture)
+        stream_mock = (qcow2_mock if image_info['disk_format'] == 'qcow2'
+                       else raw_mock)
+        stream_mock.assert_called_once_with(mock.ANY, image_info,
+                                            '/dev/foo-part1')
+        if streamed:
+            grow_mock.assert_called_once_with('/dev/foo-part1')
+        else:
+            self.assertFalse(grow_mock.called)
+        return work_on_disk_mock
+
+    def test_stream_partition_image_raw(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['virtual_size'] = 10 * 1024 * 1024
+        self._test_stream_partition_image(image_info)
+
+    def test_stream_partition_image_qcow2_unsupported(self):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+        image_info['virtual_size'] = 10 * 1024 * 1024
+        self._test_stream_partition_image(image_info, streamed=False)
+
+    @mock.patch('ironic_lib.disk_utils.work_on_disk', autospec=True)
+    def test_stream_partition_image_too_large(self, work_on_disk_mock):
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['virtual_size'] = 10 * 1024 * 1024 + 1
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'Root partition is too small',
+                               self.agent_extension._stream_partition_image,
+                               image_info, '/dev/foo')
+        self.assertFalse(work_on_disk_mock.called)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_grow_filesystem_ext4(self, execute_mock):
+        execute_mock.return_value = ('ext4\n', '')
+
+        standby._grow_filesystem('/dev/foo-part1')
+
+        execute_mock.assert_has_calls([
+            mock.call('blkid', '-o', 'value', '-s', 'TYPE', '/dev/foo-part1',
+                      check_exit_code=[0, 2]),
+            mock.call('e2fsck', '-f', '-y', '/dev/foo-part1',
+                      check_exit_code=[0, 1]),
+            mock.call('resize2fs', '/dev/foo-part1')])
+
+    @mock.patch.object(os, 'rmdir', autospec=True)
+    @mock.patch.object(tempfile, 'mkdtemp', autospec=True)
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_grow_filesystem_xfs(self, execute_mock, mkdtemp_mock,
+                                 rmdir_mock):
+        execute_mock.return_value = ('xfs\n', '')
+        mkdtemp_mock.return_value = '/tmp/fake'
+
+        standby._grow_filesystem('/dev/foo-part1')
+
+        execute_mock.assert_has_calls([
+            mock.call('mount', '/dev/foo-part1', '/tmp/fake'),
+            mock.call('xfs_growfs', '/tmp/fake'),
+            mock.call('umount', '/tmp/fake')])
+        rmdir_mock.assert_called_once_with('/tmp/fake')
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_grow_filesystem_unknown(self, execute_mock):
+        execute_mock.return_value = ('', '')
+
+        standby._grow_filesystem('/dev/foo-part1')
+
+        self.assertEqual(1, execute_mock.call_count)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_grow_filesystem_fails(self, execute_mock):
+        execute_mock.side_effect = [
+            ('ext4\n', ''), ('', ''),
+            processutils.ProcessExecutionError(exit_code=1)]
+
+        self.assertRaises(errors.ImageWriteError, standby._grow_filesystem,
+                          '/dev/foo-part1')
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_shutdown_command_invalid(self, execute_mock):
+        self.assertRaises(errors.InvalidCommandParamsError,
+                          self.agent_extension._run_shutdown_command, 'boot')
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_shutdown_command_fails(self, execute_mock):
+        execute_mock.side_effect = processutils.ProcessExecutionError
+        self.assertRaises(errors.SystemRebootError,
+                          self.agent_extension._run_shutdown_command, 'reboot')
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_shutdown_command_valid(self, execute_mock):
+        execute_mock.return_value = ('', '')
+
+        self.agent_extension._run_shutdown_command('poweroff')
+        calls = [mock.call('sync'),
+                 mock.call('poweroff', use_standard_locale=True,
+                           check_exit_code=[0])]
+        execute_mock.assert_has_calls(calls)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_shutdown_command_valid_poweroff_sysrq(self, execute_mock):
+        execute_mock.side_effect = [('', ''), ('',
+                                    'Running in chroot, ignoring request.'),
+                                    ('', '')]
+
+        self.agent_extension._run_shutdown_command('poweroff')
+        calls = [mock.call('sync'),
+                 mock.call('poweroff', use_standard_locale=True,
+                           check_exit_code=[0]),
+                 mock.call("echo o > /proc/sysrq-trigger", shell=True)]
+        execute_mock.assert_has_calls(calls)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_shutdown_command_valid_reboot_sysrq(self, execute_mock):
+        execute_mock.side_effect = [('', ''), ('',
+                                    'Running in chroot, ignoring request.'),
+                                    ('', '')]
+
+        self.agent_extension._run_shutdown_command('reboot')
+        calls = [mock.call('sync'),
+                 mock.call('reboot', use_standard_locale=True,
+                           check_exit_code=[0]),
+                 mock.call("echo b > /proc/sysrq-trigger", shell=True)]
+        execute_mock.assert_has_calls(calls)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_run_image(self, execute_mock):
+        execute_mock.return_value = ('', '')
+
+        success_result = self.agent_extension.run_image()
+        success_result.join()
+        calls = [mock.call('sync'),
+                 mock.call('reboot', use_standard_locale=True,
+                           check_exit_code=[0])]
+        execute_mock.assert_has_calls(calls)
+        self.assertEqual('SUCCEEDED', success_result.command_status)
+
+        execute_mock.reset_mock()
+        execute_mock.return_value = ('', '')
+        execute_mock.side_effect = processutils.ProcessExecutionError
+
+        failed_result = self.agent_extension.run_image()
+        failed_result.join()
+
+        execute_mock.assert_any_call('sync')
+        self.assertEqual('FAILED', failed_result.command_status)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_power_off(self, execute_mock):
+        execute_mock.return_value = ('', '')
+
+        success_result = self.agent_extension.power_off()
+        success_result.join()
+
+        calls = [mock.call('sync'),
+                 mock.call('poweroff', use_standard_locale=True,
                            check_exit_code=[0])]
         execute_mock.assert_has_calls(calls)
         self.assertEqual('SUCCEEDED', success_result.command_status)
@@ -1033,6 +1799,51 @@ class TestStandbyExtension(base.IronicAgentTest):
         execute_mock.assert_called_once_with('sync')
         self.assertEqual('SUCCEEDED', result.command_status)
 
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_set_download_rate_limit(self, requests_mock):
+        self.addCleanup(standby.override_rate_limit, None)
+        image_info = _build_fake_image_info()
+        image_info['download_rate_limit'] = 10
+        requests_mock.return_value.status_code = 200
+
+        result = self.agent_extension.set_download_rate_limit(rate_limit=100)
+
+        self.assertEqual('SUCCEEDED', result.command_status)
+        self.assertEqual(100 * 1024, standby._RATE_LIMITER.rate)
+        # The limit set at runtime survives new downloads and replaces the
+        # limit of their image.
+        image_download = standby.ImageDownload(image_info)
+        self.assertEqual(100 * 1024, standby._RATE_LIMITER.rate)
+        self.assertTrue(image_download._rate_limited())
+        with mock.patch.object(standby._TokenBucket, 'consume',
+                               autospec=True) as consume_mock:
+            requests_mock.return_value.iter_content.return_value = [b'data']
+            list(image_download._iter_limited())
+        consume_mock.assert_called_once_with(standby._RATE_LIMITER, 4)
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_set_download_rate_limit_reset(self, requests_mock):
+        self.addCleanup(standby._RATE_LIMITER.set_rate, 0)
+        self.config(image_download_rate_limit=50)
+        image_info = _build_fake_image_info()
+        image_info['download_rate_limit'] = 10
+        requests_mock.return_value.status_code = 200
+        self.agent_extension.set_download_rate_limit(rate_limit=100)
+
+        self.agent_extension.set_download_rate_limit()
+
+        self.assertIsNone(standby._RATE_LIMIT_OVERRIDE)
+        self.assertEqual(50 * 1024, standby._RATE_LIMITER.rate)
+        image_download = standby.ImageDownload(image_info)
+        self.assertEqual(50 * 1024, standby._RATE_LIMITER.rate)
+        self.assertEqual(10 * 1024, image_download._rate_limiter.rate)
+
+    def test_set_download_rate_limit_invalid(self):
+        for value in (-1, 'fast', ''):
+            self.assertRaises(errors.InvalidCommandParamsError,
+                              self.agent_extension.set_download_rate_limit,
+                              rate_limit=value)
+
     @mock.patch('ironic_python_agent.utils.execute', autospec=True)
     def test_sync_error(self, execute_mock):
         execute_mock.side_effect = processutils.ProcessExecutionError
@@ -1048,12 +1859,14 @@ class TestStandbyExtension(base.IronicAgentTest):
         image_info = _build_fake_image_info()
         device = '/dev/foo'
         self.agent_extension._cache_and_write_image(image_info, device)
-        download_mock.assert_called_once_with(image_info)
-        write_mock.assert_called_once_with(image_info, device)
+        download_mock.assert_called_once_with(image_info,
+                                              (hashlib.md5, 'abc123'))
+        write_mock.assert_called_once_with(image_info, device,
+                                           configdrive_fetch=None)
 
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_stream_raw_image_onto_device(self, requests_mock, open_mock,
                                           md5_mock):
         image_info = _build_fake_image_info()
@@ -1068,16 +1881,45 @@ class TestStandbyExtension(base.IronicAgentTest):
 
         self.agent_extension._stream_raw_image_onto_device(image_info,
                                                            '/dev/foo')
-        requests_mock.assert_called_once_with(image_info['urls'][0],
+        requests_mock.assert_called_once_with(mock.ANY, image_info['urls'][0],
                                               cert=None, verify=True,
                                               stream=True, proxies={},
                                               timeout=60)
         expected_calls = [mock.call('some'), mock.call('content')]
         file_mock.write.assert_has_calls(expected_calls)
 
+    @mock.patch.object(standby, '_write_stream', autospec=True)
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_raw_image_onto_device_timings(self, requests_mock,
+                                                  open_mock, md5_mock,
+                                                  write_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        open_mock.return_value.__enter__.return_value.read.return_value = None
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        def _write(image_download, f):
+            for chunk in image_download:
+                f.write(chunk)
+            image_download.timings.write = 5.0
+
+        write_mock.side_effect = _write
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        timings = self.agent_extension.timings.as_dict()
+        self.assertEqual(5.0, timings['phases']['write'])
+        self.assertEqual(5.0, timings['download']['write_seconds'])
+        self.assertEqual(11, timings['download']['bytes'])
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_stream_raw_image_onto_device_write_error(self, requests_mock,
                                                       open_mock, md5_mock):
         self.config(image_download_connection_timeout=1)
@@ -1085,30 +1927,605 @@ class TestStandbyExtension(base.IronicAgentTest):
         image_info = _build_fake_image_info()
         response = requests_mock.return_value
         response.status_code = 200
-        response.iter_content.return_value = ['some', 'content']
-        file_mock = mock.Mock()
-        open_mock.return_value.__enter__.return_value = file_mock
-        file_mock.write.side_effect = Exception('Surprise!!!1!')
-        hexdigest_mock = md5_mock.return_value.hexdigest
-        hexdigest_mock.return_value = image_info['checksum']
+        response.headers = {}
+        response.iter_content.return_value = ['some', 'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        file_mock.write.side_effect = Exception('Surprise!!!1!')
+        hexdigest_mock = md5_mock.return_value.hexdigest
+        hexdigest_mock.return_value = image_info['checksum']
+
+        self.assertRaises(errors.ImageDownloadError,
+                          self.agent_extension._stream_raw_image_onto_device,
+                          image_info, '/dev/foo')
+        calls = [mock.call(mock.ANY, 'http://example.org', cert=None,
+                           proxies={}, stream=True, timeout=1, verify=True),
+                 mock.call().iter_content(mock.ANY),
+                 mock.call().close(),
+                 mock.call(mock.ANY, 'http://example.org', cert=None,
+                           proxies={}, stream=True, timeout=1, verify=True),
+                 mock.call().iter_content(mock.ANY),
+                 mock.call().close(),
+                 mock.call(mock.ANY, 'http://example.org', cert=None,
+                           proxies={}, stream=True, timeout=1, verify=True),
+                 mock.call().iter_content(mock.ANY)]
+        requests_mock.assert_has_calls(calls)
+        write_calls = [mock.call('some'),
+                       mock.call('some'),
+                       mock.call('some')]
+        file_mock.write.assert_has_calls(write_calls)
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_raw_image_onto_device_resume(self, requests_mock,
+                                                 open_mock, md5_mock,
+                                                 sleep_mock):
+        image_info = _build_fake_image_info()
+
+        def _broken():
+            yield b'some'
+            raise requests.ConnectionError('Connection reset')
+
+        response = mock.Mock(status_code=200)
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': '11'}
+        response.iter_content.return_value = _broken()
+        resumed = mock.Mock(status_code=206)
+        resumed.iter_content.return_value = [b'content']
+        requests_mock.side_effect = [response, resumed]
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           '/dev/foo')
+        requests_mock.assert_called_with(mock.ANY, image_info['urls'][0],
+                                         cert=None, verify=True,
+                                         stream=True, proxies={},
+                                         timeout=60,
+                                         headers={'Range': 'bytes=4-'})
+        file_mock.seek.assert_called_once_with(4)
+        file_mock.write.assert_has_calls([mock.call(b'some'),
+                                          mock.call(b'content')])
+        self.assertEqual(1, md5_mock.call_count)
+        md5_mock.return_value.update.assert_has_calls(
+            [mock.call(b'some'), mock.call(b'content')])
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_download_image_resume_no_ranges(self, requests_mock, open_mock,
+                                             md5_mock, sleep_mock):
+        image_info = _build_fake_image_info()
+
+        def _broken():
+            yield b'some'
+            raise requests.ConnectionError('Connection reset')
+
+        response = mock.Mock(status_code=200, headers={})
+        response.iter_content.return_value = _broken()
+        restarted = mock.Mock(status_code=200, headers={})
+        restarted.iter_content.return_value = [b'some', b'content']
+        requests_mock.side_effect = [response, restarted]
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        standby._download_image(image_info)
+        requests_mock.assert_called_with(mock.ANY, image_info['urls'][0],
+                                         cert=None, verify=True,
+                                         stream=True, proxies={},
+                                         timeout=60)
+        open_mock.assert_called_with(standby._image_location(image_info),
+                                     'wb')
+        self.assertFalse(file_mock.seek.called)
+        self.assertEqual(2, md5_mock.call_count)
+
+    @mock.patch('random.shuffle', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_image_download_peers(self, requests_mock, shuffle_mock):
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = 'ABCDEF'
+        image_info['peers'] = ['http://peer1:9999/', 'http://peer2:9999']
+        missing = mock.Mock(status_code=404, headers={})
+        response = mock.Mock(status_code=200, headers={})
+        requests_mock.side_effect = [missing, response]
+
+        standby.ImageDownload(image_info)
+
+        self.assertEqual(1, shuffle_mock.call_count)
+        requests_mock.assert_has_calls([
+            mock.call(mock.ANY, 'http://peer1:9999/v1/images/sha256-abcdef',
+                      cert=None, verify=True, stream=True, proxies={},
+                      timeout=60),
+            mock.call(mock.ANY, 'http://peer2:9999/v1/images/sha256-abcdef',
+                      cert=None, verify=True, stream=True, proxies={},
+                      timeout=60),
+        ])
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_image_download_peers_fall_back(self, requests_mock):
+        image_info = _build_fake_image_info()
+        image_info['peers'] = ['http://peer1:9999']
+        missing = mock.Mock(status_code=404, headers={})
+        response = mock.Mock(status_code=200, headers={})
+        requests_mock.side_effect = [missing, response]
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(image_info['urls'][0], image_download._url)
+        requests_mock.assert_called_with(mock.ANY, image_info['urls'][0],
+                                         cert=None, verify=True,
+                                         stream=True, proxies={},
+                                         timeout=60)
+
+    def _setup_image_cache(self):
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        cache_dir = os.path.join(tmpdir, 'cache')
+        self.config(image_cache_dir=cache_dir)
+        location = os.path.join(tmpdir, 'fake_id')
+        self.useFixture(fixtures.MockPatchObject(
+            standby, '_image_location', autospec=True,
+            return_value=location))
+        image_info = _build_fake_image_info()
+        image_info['checksum'] = hashlib.md5(b'somecontent').hexdigest()
+        entry = os.path.join(cache_dir, 'md5-' + image_info['checksum'])
+        return image_info, location, entry
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_download_image_cache_miss(self, requests_mock):
+        image_info, location, entry = self._setup_image_cache()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+
+        standby._download_image(image_info)
+
+        self.assertEqual(1, requests_mock.call_count)
+        self.assertEqual(entry, os.readlink(location))
+        with open(location, 'rb') as f:
+            self.assertEqual(b'somecontent', f.read())
+        self.assertEqual([os.path.basename(entry)],
+                         os.listdir(os.path.dirname(entry)))
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_download_image_cache_compressed(self, requests_mock):
+        image_info, location, entry = self._setup_image_cache()
+        compressed = _gzip(b'somecontent')
+        image_info['compression'] = 'gzip'
+        image_info['checksum'] = hashlib.md5(compressed).hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [compressed]
+
+        standby._download_image(image_info)
+
+        # The checksum covers the compressed image, it is not cached.
+        self.assertFalse(os.path.islink(location))
+        with open(location, 'rb') as f:
+            self.assertEqual(b'somecontent', f.read())
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_download_image_cache_hit(self, requests_mock):
+        image_info, location, entry = self._setup_image_cache()
+        os.makedirs(os.path.dirname(entry))
+        with open(entry, 'wb') as f:
+            f.write(b'somecontent')
+        with open(location, 'wb') as f:
+            f.write(b'stale')
+
+        standby._download_image(image_info)
+
+        self.assertFalse(requests_mock.called)
+        self.assertEqual(entry, os.readlink(location))
+
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_download_image_cache_failure(self, requests_mock):
+        image_info, location, entry = self._setup_image_cache()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'other']
+
+        self.assertRaises(errors.ImageChecksumError,
+                          standby._download_image, image_info)
+
+        self.assertEqual([], os.listdir(os.path.dirname(entry)))
+
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch.object(standby, '_fetch_checksum', autospec=True)
+    def test_prepare_image_cached_checksum_fetched_once(self, fetch_mock,
+                                                        cache_write_mock,
+                                                        dispatch_mock):
+        image_info, _location, entry = self._setup_image_cache()
+        image_info['checksum'] = 'http://example.com/checksums'
+        fetch_mock.return_value = hashlib.md5(b'somecontent').hexdigest()
+        os.makedirs(os.path.dirname(entry))
+        open(entry, 'wb').close()
+        dispatch_mock.return_value = '/dev/foo'
+        cache_write_mock.side_effect = (
+            lambda ext, info, device: ext._get_expected_hash(info))
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                 '/dev/foo')
+        fetch_mock.assert_called_once_with('http://example.com/checksums',
+                                           image_info)
+
+    @mock.patch('ironic_python_agent.utils.execute', mock.Mock())
+    @mock.patch('ironic_lib.disk_utils.list_partitions',
+                lambda _dev: [mock.Mock()])
+    @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
+                lambda dev: 'ROOT')
+    @mock.patch('ironic_python_agent.hardware.dispatch_to_managers',
+                autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._cache_and_write_image', autospec=True)
+    @mock.patch('ironic_python_agent.extensions.standby.StandbyExtension'
+                '._stream_raw_image_onto_device', autospec=True)
+    def test_prepare_image_cached_not_streamed(self, stream_mock,
+                                               cache_write_mock,
+                                               dispatch_mock):
+        image_info, _location, entry = self._setup_image_cache()
+        image_info['disk_format'] = 'raw'
+        image_info['stream_raw_images'] = True
+        os.makedirs(os.path.dirname(entry))
+        open(entry, 'wb').close()
+        dispatch_mock.return_value = '/dev/foo'
+
+        async_result = self.agent_extension.prepare_image(
+            image_info=image_info,
+            configdrive=None
+        )
+        async_result.join()
+
+        self.assertEqual('SUCCEEDED', async_result.command_status)
+        self.assertFalse(stream_mock.called)
+        cache_write_mock.assert_called_once_with(mock.ANY, image_info,
+                                                 '/dev/foo')
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_write_stream_pipeline(self, requests_mock, md5_mock):
+        self.config(image_download_pipeline_buffers=2)
+        image_info = _build_fake_image_info()
+        content = [b'some', b'content', b'and', b'more']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = content
+        file_mock = mock.Mock()
+        written = []
+        file_mock.write.side_effect = lambda chunk: written.append(
+            bytes(chunk))
+        hashed = []
+        md5_mock.return_value.update.side_effect = lambda chunk: (
+            hashed.append(bytes(chunk)))
+
+        image_download = standby.ImageDownload(image_info)
+        standby._write_stream(image_download, file_mock)
+        self.assertEqual(content, written)
+        self.assertEqual(content, hashed)
+        self.assertEqual(18, image_download.offset)
+        self.assertEqual({'receive', 'write', 'hash'},
+                         set(image_download.pipeline_stats))
+        self.assertEqual(18, image_download.pipeline_stats['hash']['bytes'])
+
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_raw_image_onto_device_pipeline_write_error(
+            self, requests_mock, open_mock, md5_mock):
+        self.config(image_download_pipeline_buffers=2)
+        self.config(image_download_connection_retries=0)
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        file_mock = mock.Mock()
+        open_mock.return_value.__enter__.return_value = file_mock
+        file_mock.write.side_effect = [None, IOError('No space left')]
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'No space left',
+                               self.agent_extension
+                               ._stream_raw_image_onto_device,
+                               image_info, '/dev/foo')
+        md5_mock.return_value.update.assert_called_once_with(mock.ANY)
+
+    def test_write_stream_pipeline_write_error_while_receiving(self):
+        self.config(image_download_pipeline_buffers=2)
+        closed = threading.Event()
+
+        def _chunks():
+            yield b'some'
+            # Blocked in a socket read until the connection is closed.
+            if not closed.wait(5):
+                yield b'too late'
+
+        image_download = mock.Mock(spec=standby.ImageDownload,
+                                   _image_info=_build_fake_image_info(),
+                                   timings=standby._DownloadTimings(0))
+        image_download._iter_chunks.side_effect = _chunks
+        image_download.close.side_effect = closed.set
+        file_mock = mock.Mock()
+        file_mock.write.side_effect = IOError('No space left')
+
+        self.assertRaisesRegex(IOError, 'No space left',
+                               standby._write_stream, image_download,
+                               file_mock)
+        image_download.close.assert_called_once_with()
+        self.assertFalse(image_download._account.called)
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(image_writer, 'DirectIOWriter', autospec=True)
+    def test_open_device(self, writer_mock, open_mock):
+        image_info = _build_fake_image_info()
+        self.assertEqual(open_mock.return_value,
+                         standby._open_device(image_info, '/dev/foo'))
+        self.assertFalse(writer_mock.called)
+        open_mock.assert_called_once_with('/dev/foo', 'wb+')
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(image_writer, 'DirectIOWriter', autospec=True)
+    def test_open_device_direct_io(self, writer_mock, open_mock):
+        image_info = _build_fake_image_info()
+        image_info['direct_io'] = True
+        self.assertEqual(writer_mock.return_value,
+                         standby._open_device(image_info, '/dev/foo'))
+        writer_mock.assert_called_once_with('/dev/foo',
+                                            io_size=4 * 1024 * 1024,
+                                            queue_depth=4)
+        self.assertFalse(open_mock.called)
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    @mock.patch.object(image_writer, 'DirectIOWriter', autospec=True)
+    def test_open_device_direct_io_unsupported(self, writer_mock, open_mock):
+        self.config(image_direct_io=True)
+        writer_mock.side_effect = OSError(22, 'Invalid argument')
+        self.assertEqual(open_mock.return_value,
+                         standby._open_device(_build_fake_image_info(),
+                                              '/dev/foo'))
+        open_mock.assert_called_once_with('/dev/foo', 'wb+')
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_qcow2_image_onto_device(self, requests_mock, md5_mock,
+                                            converter_mock, wipe_mock):
+        self.config(image_spill_dir='/var/spill')
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+        converter = converter_mock.return_value
+        converter.bytes_written = 4096
+        converter.bytes_zeroed = 8192
+        converter.bytes_spilled = 0
+
+        self.assertTrue(self.agent_extension._stream_qcow2_image_onto_device(
+            image_info, '/dev/foo'))
+
+        wipe_mock.assert_called_once_with('/dev/foo')
+        converter_mock.assert_called_once_with('/dev/foo',
+                                               spill_dir='/var/spill')
+        converter.write.assert_has_calls([mock.call(b'some'),
+                                          mock.call(b'content')])
+        converter.finish.assert_called_once_with()
+        converter.close.assert_called_once_with()
+        self.assertEqual({'bytes_written': 4096, 'bytes_zeroed': 8192,
+                          'bytes_spilled': 0},
+                         self.agent_extension.write_stats)
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_qcow2_image_onto_partition(self, requests_mock, md5_mock,
+                                               converter_mock, wipe_mock):
+        image_info = _build_fake_partition_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+        converter = converter_mock.return_value
+        converter.bytes_written = converter.bytes_zeroed = 0
+        converter.bytes_spilled = 0
+
+        self.assertTrue(self.agent_extension._stream_qcow2_image_onto_device(
+            image_info, '/dev/foo1'))
+
+        # Partition tables of the whole disk have just been written.
+        self.assertFalse(wipe_mock.called)
+        converter_mock.assert_called_once_with('/dev/foo1', spill_dir=None)
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    def test_stream_qcow2_image_onto_device_wipe_error(self, converter_mock,
+                                                       wipe_mock):
+        wipe_mock.side_effect = OSError(errno.EIO, 'I/O error')
+
+        self.assertRaisesRegex(
+            errors.ImageWriteError, 'I/O error',
+            self.agent_extension._stream_qcow2_image_onto_device,
+            _build_fake_image_info(), '/dev/foo')
+        self.assertFalse(converter_mock.called)
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(standby, '_write_stream', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_qcow2_image_onto_device_timings(self, requests_mock,
+                                                    md5_mock, converter_mock,
+                                                    write_mock, wipe_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+        converter = converter_mock.return_value
+        converter.bytes_written = converter.bytes_zeroed = 0
+        converter.bytes_spilled = 0
+
+        def _write(image_download, f):
+            for chunk in image_download:
+                f.write(chunk)
+            image_download.timings.write = 5.0
+
+        write_mock.side_effect = _write
+
+        self.assertTrue(self.agent_extension._stream_qcow2_image_onto_device(
+            image_info, '/dev/foo'))
+        timings = self.agent_extension.timings.as_dict()
+        self.assertEqual(5.0, timings['phases']['write'])
+        self.assertEqual(5.0, timings['download']['write_seconds'])
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_qcow2_image_onto_device_restart(self, requests_mock,
+                                                    md5_mock, converter_mock,
+                                                    wipe_mock):
+        self.config(image_download_connection_retry_interval=0)
+        image_info = _build_fake_image_info()
+
+        def _broken():
+            yield b'some'
+            yield b'content'
+            raise requests.exceptions.ChunkedEncodingError('reset')
+
+        broken = mock.Mock(status_code=200, headers={})
+        broken.iter_content.return_value = _broken()
+        complete = mock.Mock(status_code=200, headers={})
+        complete.iter_content.return_value = [b'some', b'content', b'more']
+        requests_mock.side_effect = [broken, complete]
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+        first = mock.Mock()
+        second = mock.Mock(bytes_written=0, bytes_zeroed=0, bytes_spilled=0)
+        converter_mock.side_effect = [first, second]
+
+        self.assertTrue(self.agent_extension._stream_qcow2_image_onto_device(
+            image_info, '/dev/foo'))
+
+        # The server does not support ranges, the image is converted again
+        # from the beginning by a new converter.
+        self.assertEqual(2, converter_mock.call_count)
+        first.close.assert_called_once_with()
+        self.assertFalse(first.finish.called)
+        second.write.assert_has_calls([mock.call(b'some'),
+                                       mock.call(b'content'),
+                                       mock.call(b'more')])
+        second.finish.assert_called_once_with()
+        second.close.assert_called_once_with()
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_qcow2_image_onto_device_unsupported(self, requests_mock,
+                                                        converter_mock,
+                                                        wipe_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        converter = converter_mock.return_value
+        converter.write.side_effect = qcow2.UnsupportedImageError('backing')
+
+        self.assertFalse(
+            self.agent_extension._stream_qcow2_image_onto_device(
+                image_info, '/dev/foo'))
+        converter.write.assert_called_once_with(b'some')
+        self.assertFalse(converter.finish.called)
+        converter.close.assert_called_once_with()
+        response.close.assert_called_once_with()
+        self.assertIsNone(self.agent_extension.write_stats)
+
+    @mock.patch.object(standby, '_wipe_partition_tables', autospec=True)
+    @mock.patch.object(qcow2, 'StreamConverter', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_qcow2_image_onto_device_invalid(self, requests_mock,
+                                                    converter_mock, wipe_mock):
+        image_info = _build_fake_image_info()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {}
+        response.iter_content.return_value = [b'some', b'content']
+        converter = converter_mock.return_value
+        converter.finish.side_effect = qcow2.Qcow2Error('truncated')
 
-        self.assertRaises(errors.ImageDownloadError,
-                          self.agent_extension._stream_raw_image_onto_device,
-                          image_info, '/dev/foo')
-        calls = [mock.call('http://example.org', cert=None, proxies={},
-                           stream=True, timeout=1, verify=True),
-                 mock.call().iter_content(mock.ANY),
-                 mock.call('http://example.org', cert=None, proxies={},
-                           stream=True, timeout=1, verify=True),
-                 mock.call().iter_content(mock.ANY),
-                 mock.call('http://example.org', cert=None, proxies={},
-                           stream=True, timeout=1, verify=True),
-                 mock.call().iter_content(mock.ANY)]
-        requests_mock.assert_has_calls(calls)
-        write_calls = [mock.call('some'),
-                       mock.call('some'),
-                       mock.call('some')]
-        file_mock.write.assert_has_calls(write_calls)
+        self.assertRaisesRegex(
+            errors.ImageWriteError, 'truncated',
+            self.agent_extension._stream_qcow2_image_onto_device,
+            image_info, '/dev/foo')
+        self.assertEqual(1, requests_mock.call_count)
+        converter.close.assert_called_once_with()
+
+    @mock.patch('six.moves.builtins.open', autospec=True)
+    def test_open_device_sparse(self, open_mock):
+        image_info = _build_fake_image_info()
+        image_info['sparse_policy'] = 'skip'
+        writer = standby._open_device(image_info, '/dev/foo')
+        self.assertIsInstance(writer, image_writer.SparseWriter)
+        self.assertEqual('skip', writer.policy)
+        self.assertEqual(1024 * 1024, writer._block_size)
+        open_mock.assert_called_once_with('/dev/foo', 'wb+')
+
+    @mock.patch('time.sleep', autospec=True)
+    @mock.patch('hashlib.md5', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
+    def test_stream_raw_image_onto_device_sparse(self, requests_mock,
+                                                 md5_mock, sleep_mock):
+        self.config(image_sparse_policy='skip', image_sparse_block_size=4096)
+        device = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                              'device')
+        data = b'\x01' * 4096 + b'\x00' * 8192 + b'\x02' * 100
+        response = mock.Mock(status_code=200)
+        response.headers = {}
+        response.iter_content.return_value = [data[:5000], data[5000:]]
+        requests_mock.return_value = response
+        image_info = _build_fake_image_info()
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        self.agent_extension._stream_raw_image_onto_device(image_info,
+                                                           device)
+
+        md5_mock.return_value.update.assert_has_calls(
+            [mock.call(data[:5000]), mock.call(data[5000:])])
+        # The file is truncated on open, the skipped range is a hole.
+        with open(device, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual({'sparse_policy': 'skip', 'bytes_written': 4196,
+                          'bytes_skipped': 8192},
+                         self.agent_extension.write_stats)
 
     @mock.patch('ironic_lib.disk_utils.get_disk_identifier',
                 lambda dev: 'ROOT')
@@ -1126,17 +2543,22 @@ class TestStandbyExtension(base.IronicAgentTest):
     @mock.patch('ironic_lib.disk_utils.fix_gpt_partition', autospec=True)
     @mock.patch('hashlib.md5', autospec=True)
     @mock.patch('six.moves.builtins.open', autospec=True)
-    @mock.patch('requests.get', autospec=True)
+    @mock.patch.object(requests.Session, 'get', autospec=True)
     def test_stream_raw_image_onto_device_socket_read_timeout(
             self, requests_mock, open_mock, md5_mock, fix_gpt_mock):
 
         class create_timeout(object):
             status_code = 200
+            headers = {}
 
-            def __init__(self, url, stream, proxies, verify, cert, timeout):
+            def __init__(self, session, url, stream, proxies, verify, cert,
+                         timeout):
                 time.sleep(1)
                 self.count = 0
 
+            def close(self):
+                pass
+
             def __iter__(self):
                 return self
 
@@ -1174,12 +2596,12 @@ class TestStandbyExtension(base.IronicAgentTest):
             image_info,
             '/dev/foo')
 
-        calls = [mock.call(image_info['urls'][0], cert=None, verify=True,
-                           stream=True, proxies={}, timeout=1),
-                 mock.call(image_info['urls'][0], cert=None, verify=True,
-                           stream=True, proxies={}, timeout=1),
-                 mock.call(image_info['urls'][0], cert=None, verify=True,
-                           stream=True, proxies={}, timeout=1)]
+        calls = [mock.call(mock.ANY, image_info['urls'][0], cert=None,
+                           verify=True, stream=True, proxies={}, timeout=1),
+                 mock.call(mock.ANY, image_info['urls'][0], cert=None,
+                           verify=True, stream=True, proxies={}, timeout=1),
+                 mock.call(mock.ANY, image_info['urls'][0], cert=None,
+                           verify=True, stream=True, proxies={}, timeout=1)]
         requests_mock.assert_has_calls(calls)
 
         write_calls = [mock.call('meow'),
@@ -1246,7 +2668,7 @@ class TestStandbyExtension(base.IronicAgentTest):
 
 
 @mock.patch('hashlib.md5', autospec=True)
-@mock.patch('requests.get', autospec=True)
+@mock.patch.object(requests.Session, 'get', autospec=True)
 class TestImageDownload(base.IronicAgentTest):
 
     def test_download_image(self, requests_mock, md5_mock):
@@ -1260,7 +2682,7 @@ class TestImageDownload(base.IronicAgentTest):
         image_download = standby.ImageDownload(image_info)
 
         self.assertEqual(content, list(image_download))
-        requests_mock.assert_called_once_with(image_info['urls'][0],
+        requests_mock.assert_called_once_with(mock.ANY, image_info['urls'][0],
                                               cert=None, verify=True,
                                               stream=True, proxies={},
                                               timeout=60)
@@ -1280,7 +2702,7 @@ class TestImageDownload(base.IronicAgentTest):
                '200. Response body: Unauthorized')
         self.assertRaisesRegex(errors.ImageDownloadError, msg,
                                standby.ImageDownload, image_info)
-        requests_mock.assert_called_once_with(image_info['urls'][0],
+        requests_mock.assert_called_once_with(mock.ANY, image_info['urls'][0],
                                               cert=None, verify=True,
                                               stream=True, proxies={},
                                               timeout=60)
@@ -1301,7 +2723,7 @@ class TestImageDownload(base.IronicAgentTest):
                '200. Response body: Oops')
         self.assertRaisesRegex(errors.ImageDownloadError, msg,
                                standby.ImageDownload, image_info)
-        requests_mock.assert_called_with(image_info['urls'][0],
+        requests_mock.assert_called_with(mock.ANY, image_info['urls'][0],
                                          cert=None, verify=True,
                                          stream=True, proxies={},
                                          timeout=60)
@@ -1326,7 +2748,7 @@ class TestImageDownload(base.IronicAgentTest):
         image_download = standby.ImageDownload(image_info)
 
         self.assertEqual(content, list(image_download))
-        requests_mock.assert_called_with(image_info['urls'][0],
+        requests_mock.assert_called_with(mock.ANY, image_info['urls'][0],
                                          cert=None, verify=True,
                                          stream=True, proxies={},
                                          timeout=60)
@@ -1352,9 +2774,9 @@ class TestImageDownload(base.IronicAgentTest):
 
         self.assertEqual(content, list(image_download))
         requests_mock.assert_has_calls([
-            mock.call('http://example.com/checksum', cert=None, verify=True,
-                      stream=True, proxies={}, timeout=60),
-            mock.call(image_info['urls'][0], cert=None, verify=True,
+            mock.call(mock.ANY, 'http://example.com/checksum', cert=None,
+                      verify=True, stream=True, proxies={}, timeout=60),
+            mock.call(mock.ANY, image_info['urls'][0], cert=None, verify=True,
                       stream=True, proxies={}, timeout=60),
         ])
         self.assertEqual(fake_cs, image_download._hash_algo.hexdigest())
@@ -1382,9 +2804,9 @@ foobar  irrelevant file.img
 
         self.assertEqual(content, list(image_download))
         requests_mock.assert_has_calls([
-            mock.call('http://example.com/checksum', cert=None, verify=True,
-                      stream=True, proxies={}, timeout=60),
-            mock.call(image_info['urls'][0], cert=None, verify=True,
+            mock.call(mock.ANY, 'http://example.com/checksum', cert=None,
+                      verify=True, stream=True, proxies={}, timeout=60),
+            mock.call(mock.ANY, image_info['urls'][0], cert=None, verify=True,
                       stream=True, proxies={}, timeout=60),
         ])
         self.assertEqual(fake_cs, image_download._hash_algo.hexdigest())
@@ -1450,3 +2872,762 @@ foobar  irrelevant file.img
                                'Received status code 400 from '
                                'http://example.com/checksum',
                                standby.ImageDownload, image_info)
+
+    def test_download_image_ranges(self, requests_mock, md5_mock):
+        content = b'0123456789'
+        response = mock.Mock(status_code=200)
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(content))}
+        response.iter_content.return_value = [content[:3], content[3:]]
+
+        def _get(session, url, headers=None, **kwargs):
+            if headers is None:
+                return response
+            start, end = headers['Range'][len('bytes='):].split('-')
+            resp = mock.Mock(status_code=206)
+            resp.content = content[int(start):int(end) + 1]
+            return resp
+
+        requests_mock.side_effect = _get
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_info['download_range_size'] = 4
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content,
+                         b''.join(bytes(c) for c in image_download))
+        self.assertTrue(response.close.called)
+        requests_mock.assert_has_calls([
+            mock.call(mock.ANY, image_info['urls'][0], cert=None,
+                      verify=True, stream=True, proxies={}, timeout=60,
+                      headers={'Range': 'bytes=4-7'}),
+            mock.call(mock.ANY, image_info['urls'][0], cert=None,
+                      verify=True, stream=True, proxies={}, timeout=60,
+                      headers={'Range': 'bytes=8-9'}),
+        ], any_order=True)
+        # The ranges reuse the connections of the shared session.
+        sessions = set(id(c[0][0]) for c in requests_mock.call_args_list)
+        self.assertEqual(1, len(sessions))
+        hashed = b''.join(bytes(c[0][0]) for c in
+                          md5_mock.return_value.update.call_args_list)
+        self.assertEqual(content, hashed)
+
+    def test_download_image_ranges_not_supported(self, requests_mock,
+                                                 md5_mock):
+        content = ['SpongeBob', 'SquarePants']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Content-Length': '20'}
+        response.iter_content.return_value = content
+
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 4
+        image_info['download_range_size'] = 4
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        requests_mock.assert_called_once_with(
+            mock.ANY, image_info['urls'][0], cert=None, verify=True,
+            stream=True, proxies={}, timeout=60)
+
+    @mock.patch('time.sleep', autospec=True)
+    def test_download_image_ranges_short_read(self, sleep_mock,
+                                              requests_mock, md5_mock):
+        self.config(image_download_connection_retries=1)
+        content = b'0123456789'
+        response = mock.Mock(status_code=200)
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(content))}
+        response.iter_content.return_value = [content[:5]]
+        short = mock.Mock(status_code=206, content=b'45')
+        requests_mock.side_effect = [response, short, short]
+
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_info['download_range_size'] = 5
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Unable to download range 5-9',
+                               list, image_download)
+        self.assertEqual(3, requests_mock.call_count)
+
+    @mock.patch('time.sleep', autospec=True)
+    def test_download_image_ranges_retry_first_range(self, sleep_mock,
+                                                     requests_mock, md5_mock):
+        self.config(image_download_connection_retries=1)
+        content = b'0123456789'
+        response = mock.Mock(status_code=200)
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(content))}
+        response.iter_content.return_value = [content[:2]]
+
+        def _get(session, url, headers=None, **kwargs):
+            if headers is None:
+                return response
+            start, end = headers['Range'][len('bytes='):].split('-')
+            return mock.Mock(status_code=206,
+                             content=content[int(start):int(end) + 1])
+
+        requests_mock.side_effect = _get
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_info['download_range_size'] = 5
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content,
+                         b''.join(bytes(c) for c in image_download))
+        self.assertTrue(response.close.called)
+        requests_mock.assert_any_call(
+            mock.ANY, image_info['urls'][0], cert=None, verify=True,
+            stream=True, proxies={}, timeout=60,
+            headers={'Range': 'bytes=0-4'})
+        self.assertEqual(3, requests_mock.call_count)
+
+    @mock.patch('time.sleep', autospec=True)
+    def test_download_image_ranges_single_retry_layer(self, sleep_mock,
+                                                      requests_mock,
+                                                      md5_mock):
+        self.config(image_download_connection_retries=2)
+        content = b'0123456789'
+        response = mock.Mock(status_code=200)
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(content))}
+        response.iter_content.return_value = [content[:5]]
+        requests_mock.side_effect = [response] + [
+            requests.ConnectionError('boom')] * 9
+
+        image_info = _build_fake_image_info()
+        image_info['download_connections'] = 2
+        image_info['download_range_size'] = 5
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Unable to download range 5-9.*boom',
+                               list, image_download)
+        # One request per attempt of the range, not per attempt of every
+        # connection retry.
+        self.assertEqual(1 + 3, requests_mock.call_count)
+        self.assertEqual(2, sleep_mock.call_count)
+
+    @mock.patch.object(standby, '_probe_mirror', autospec=True)
+    def test_race_mirrors(self, probe_mock, requests_mock, md5_mock):
+        urls = ['http://slow', 'http://broken', 'http://fast']
+        probe_mock.side_effect = [
+            standby._MirrorProbe(urls[0], ttfb=0.1, throughput=100),
+            standby._MirrorProbe(urls[1], error='boom'),
+            standby._MirrorProbe(urls[2], ttfb=0.5, throughput=1000),
+        ]
+        image_info = _build_fake_image_info()
+
+        probes = standby._race_mirrors(image_info, urls, 42)
+
+        self.assertEqual(['http://fast', 'http://slow', 'http://broken'],
+                         [probe.url for probe in probes])
+        probe_mock.assert_has_calls([mock.call(image_info, url, 42)
+                                     for url in urls], any_order=True)
+
+    @mock.patch('time.time', autospec=True)
+    def test_probe_mirror(self, time_mock, requests_mock, md5_mock):
+        self.config(image_download_probe_size=4)
+        time_mock.side_effect = [0.0, 0.5, 2.5]
+        response = requests_mock.return_value
+        response.status_code = 206
+        response.iter_content.return_value = [b'01', b'23', b'45']
+        image_info = _build_fake_image_info()
+
+        probe = standby._probe_mirror(image_info, 'http://mirror', 10)
+
+        self.assertEqual(0.5, probe.ttfb)
+        self.assertEqual(2.0, probe.throughput)
+        self.assertTrue(response.close.called)
+        requests_mock.assert_called_once_with(
+            mock.ANY, 'http://mirror', cert=None, verify=True, stream=True,
+            proxies={}, timeout=10, headers={'Range': 'bytes=10-'})
+
+    @mock.patch.object(time, 'sleep', autospec=True)
+    def test_probe_mirror_fails(self, sleep_mock, requests_mock, md5_mock):
+        requests_mock.side_effect = requests.ConnectionError('boom')
+        image_info = _build_fake_image_info()
+
+        probe = standby._probe_mirror(image_info, 'http://mirror', 0)
+
+        self.assertIsNone(probe.throughput)
+        self.assertIn('boom', str(probe))
+        # Probes are not retried.
+        requests_mock.assert_called_once_with(
+            mock.ANY, 'http://mirror', cert=None, verify=True, stream=True,
+            proxies={}, timeout=10)
+        self.assertFalse(sleep_mock.called)
+
+    @mock.patch.object(standby, '_race_mirrors', autospec=True)
+    def test_download_image_mirror_racing(self, race_mock, requests_mock,
+                                          md5_mock):
+        content = ['SpongeBob', 'SquarePants']
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = content
+        image_info = _build_fake_image_info()
+        image_info['urls'].append('http://fast')
+        image_info['mirror_racing'] = True
+        race_mock.return_value = [
+            standby._MirrorProbe('http://fast', ttfb=0.1, throughput=1000),
+            standby._MirrorProbe('http://example.org', ttfb=0.1,
+                                 throughput=10)]
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content, list(image_download))
+        race_mock.assert_called_once_with(image_info, image_info['urls'], 0)
+        requests_mock.assert_called_once_with(
+            mock.ANY, 'http://fast', cert=None, verify=True, stream=True,
+            proxies={}, timeout=60)
+
+    @mock.patch.object(standby, '_race_mirrors', autospec=True)
+    def test_download_image_mirror_racing_single_url(self, race_mock,
+                                                     requests_mock,
+                                                     md5_mock):
+        self.config(image_download_mirror_racing=True)
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['SpongeBob']
+
+        image_download = standby.ImageDownload(_build_fake_image_info())
+
+        self.assertEqual(['SpongeBob'], list(image_download))
+        self.assertFalse(race_mock.called)
+
+    @mock.patch('time.time', autospec=True)
+    @mock.patch.object(standby, '_race_mirrors', autospec=True)
+    def _test_download_image_switch_mirror(self, race_mock, time_mock,
+                                           requests_mock, md5_mock,
+                                           new_throughput):
+        self.config(image_download_mirror_racing=True,
+                    image_download_min_throughput=1)
+        # Every chunk takes 20 seconds, i.e. 0.5 bytes per second.
+        time_mock.side_effect = (20.0 * i for i in range(1000))
+        slow = mock.Mock(status_code=200)
+        slow.headers = {'Accept-Ranges': 'bytes', 'Content-Length': '20'}
+        slow.iter_content.return_value = [b'0123456789', b'abcdefghij']
+        fast = mock.Mock(status_code=206)
+        fast.iter_content.return_value = [b'abcdefghij']
+        requests_mock.side_effect = [slow, fast]
+        race_mock.return_value = [
+            standby._MirrorProbe('http://fast', ttfb=0.1,
+                                 throughput=new_throughput)]
+        image_info = _build_fake_image_info()
+        image_info['urls'].append('http://fast')
+        # Rank the URLs in the given order initially.
+        image_info['mirror_racing'] = False
+        image_download = standby.ImageDownload(image_info)
+        image_download._mirror_racing = True
+
+        self.assertEqual(b'0123456789abcdefghij',
+                         b''.join(image_download))
+        race_mock.assert_called_once_with(image_info, ['http://fast'], 10)
+        return requests_mock, slow
+
+    def test_download_image_switch_mirror(self, requests_mock, md5_mock):
+        requests_mock, slow = self._test_download_image_switch_mirror(
+            requests_mock=requests_mock, md5_mock=md5_mock,
+            new_throughput=1000)
+
+        self.assertTrue(slow.close.called)
+        requests_mock.assert_called_with(
+            mock.ANY, 'http://fast', cert=None, verify=True, stream=True,
+            proxies={}, timeout=60, headers={'Range': 'bytes=10-'})
+
+    def test_download_image_switch_mirror_not_faster(self, requests_mock,
+                                                     md5_mock):
+        requests_mock, slow = self._test_download_image_switch_mirror(
+            requests_mock=requests_mock, md5_mock=md5_mock,
+            new_throughput=0.1)
+
+        self.assertFalse(slow.close.called)
+        self.assertEqual(1, requests_mock.call_count)
+
+    def _test_download_image_segments(self, requests_mock, image):
+        self.config(image_verify_workers=2)
+        content = b'0123456789abcdefghij'
+        checksums = ['{}  image.img'.format(
+            hashlib.sha256(content).hexdigest())]
+        checksums += ['{}  image.img@{}+8'.format(
+            hashlib.sha256(content[start:start + 8]).hexdigest(), start)
+            for start in (0, 8)]
+        checksums.append('{}  image.img@16+4'.format(
+            hashlib.sha256(content[16:]).hexdigest()))
+        image_info = _build_fake_image_info('http://example.org/image.img')
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = 'http://example.org/SHA256SUMS'
+
+        def _get(session, url, headers=None, **kwargs):
+            if url.endswith('SHA256SUMS'):
+                return mock.Mock(status_code=200, text='\n'.join(checksums))
+            if headers is not None:
+                start, end = headers['Range'][len('bytes='):].split('-')
+                return mock.Mock(status_code=206,
+                                 content=content[int(start):int(end) + 1])
+            resp = mock.Mock(status_code=200)
+            resp.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': str(len(content))}
+            resp.iter_content.return_value = [image[:5], image[5:]]
+            return resp
+
+        requests_mock.side_effect = _get
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content,
+                         b''.join(bytes(c) for c in image_download))
+        image_download.verify_image('/tmp/image')
+        return image_download
+
+    def test_download_image_segments(self, requests_mock, md5_mock):
+        content = b'0123456789abcdefghij'
+        image_download = self._test_download_image_segments(requests_mock,
+                                                            content)
+
+        self.assertEqual(0, image_download._verifier.refetched)
+        self.assertEqual(3, requests_mock.call_count)
+
+    def test_download_image_segments_refetch(self, requests_mock, md5_mock):
+        corrupted = b'0123456789Xbcdefghij'
+        image_download = self._test_download_image_segments(requests_mock,
+                                                            corrupted)
+
+        self.assertEqual(1, image_download._verifier.refetched)
+        requests_mock.assert_called_with(
+            mock.ANY, 'http://example.org/image.img', cert=None,
+            verify=True, stream=True, proxies={}, timeout=60,
+            headers={'Range': 'bytes=8-15'})
+
+    def test_download_image_segments_no_manifest(self, requests_mock,
+                                                 md5_mock):
+        self.config(image_verify_workers=2)
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = ['SpongeBob']
+        image_info = _build_fake_image_info()
+        md5_mock.return_value.hexdigest.return_value = image_info['checksum']
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertIsNone(image_download._verifier)
+        self.assertEqual(['SpongeBob'], list(image_download))
+        image_download.verify_image('/tmp/image')
+
+    def _test_download_image_compressed(self, requests_mock, checksum):
+        content = b'SpongeBob' * 1000
+        compressed = _gzip(content)
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = hashlib.sha256(checksum(
+            content, compressed)).hexdigest()
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [compressed[:10],
+                                              compressed[10:]]
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(content,
+                         b''.join(bytes(c) for c in image_download))
+        self.assertEqual(len(content), image_download.offset)
+        return image_download, image_info
+
+    def test_download_image_compressed(self, requests_mock, md5_mock):
+        image_download, image_info = self._test_download_image_compressed(
+            requests_mock, lambda content, compressed: compressed)
+
+        image_download.verify_image('/tmp/image')
+
+    def test_download_image_compressed_corrupted(self, requests_mock,
+                                                 md5_mock):
+        image_download, image_info = self._test_download_image_compressed(
+            requests_mock, lambda content, compressed: content)
+
+        self.assertRaises(errors.ImageChecksumError,
+                          image_download.verify_image, '/tmp/image')
+
+    def test_download_image_compressed_checksum_decompressed(
+            self, requests_mock, md5_mock):
+        self.config(image_compressed_checksum=False)
+        image_download, image_info = self._test_download_image_compressed(
+            requests_mock, lambda content, compressed: content)
+
+        image_download.verify_image('/tmp/image')
+
+    def test_download_image_compressed_invalid(self, requests_mock,
+                                               md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'SpongeBob']
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Invalid gzip stream', list, image_download)
+
+    def test_download_image_compressed_resume(self, requests_mock,
+                                              md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.headers = {'Accept-Ranges': 'bytes',
+                            'Content-Length': '100'}
+        image_download = standby.ImageDownload(image_info)
+        image_download._offset = 42
+
+        image_download.resume()
+
+        self.assertEqual(0, image_download.offset)
+        requests_mock.assert_called_with(
+            mock.ANY, 'http://example.org', cert=None, verify=True,
+            stream=True, proxies={}, timeout=60)
+
+    def test_download_image_compressed_no_peers(self, requests_mock,
+                                                md5_mock):
+        image_info = _build_fake_image_info()
+        image_info['compression'] = 'gzip'
+        image_info['peers'] = ['http://peer:9999']
+        requests_mock.return_value.status_code = 200
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(['http://example.org'], image_download._urls)
+
+    @mock.patch.object(standby._RATE_LIMITER, 'consume', autospec=True)
+    def test_download_image_rate_limit(self, consume_mock, requests_mock,
+                                       md5_mock):
+        self.addCleanup(standby._RATE_LIMITER.set_rate, 0)
+        image_info = _build_fake_image_info()
+        image_info['download_rate_limit'] = 100
+        response = requests_mock.return_value
+        response.status_code = 200
+        response.iter_content.return_value = [b'Sponge', b'Bob']
+
+        image_download = standby.ImageDownload(image_info)
+
+        self.assertEqual(0, standby._RATE_LIMITER.rate)
+        self.assertEqual(100 * 1024, image_download._rate_limiter.rate)
+        self.assertEqual([b'Sponge', b'Bob'], list(image_download))
+        consume_mock.assert_has_calls([mock.call(6), mock.call(3)])
+
+    def test_download_image_rate_limit_per_image(self, requests_mock,
+                                                 md5_mock):
+        self.addCleanup(standby._RATE_LIMITER.set_rate, 0)
+        self.config(image_download_rate_limit=1000)
+        requests_mock.return_value.status_code = 200
+        limited = _build_fake_image_info()
+        limited['download_rate_limit'] = 100
+
+        first = standby.ImageDownload(limited)
+        second = standby.ImageDownload(_build_fake_image_info())
+
+        # A later download does not change the limit of an earlier one,
+        # the limit of the agent applies to both.
+        self.assertEqual(100 * 1024, first._rate_limiter.rate)
+        self.assertEqual(0, second._rate_limiter.rate)
+        self.assertEqual(1000 * 1024, standby._RATE_LIMITER.rate)
+
+
+@mock.patch.object(time, 'sleep', autospec=True)
+@mock.patch.object(time, 'time', autospec=True)
+class TestTokenBucket(base.IronicAgentTest):
+
+    def test_unlimited(self, time_mock, sleep_mock):
+        time_mock.return_value = 0
+        bucket = standby._TokenBucket()
+
+        bucket.consume(1000)
+
+        self.assertFalse(sleep_mock.called)
+
+    def test_limited(self, time_mock, sleep_mock):
+        time_mock.return_value = 0
+        bucket = standby._TokenBucket(rate=100)
+
+        def _sleep(seconds):
+            time_mock.return_value += seconds
+
+        sleep_mock.side_effect = _sleep
+
+        bucket.consume(250)
+
+        sleep_mock.assert_has_calls([mock.call(1), mock.call(1),
+                                     mock.call(0.5)])
+        self.assertEqual(2.5, time_mock.return_value)
+
+    def test_burst(self, time_mock, sleep_mock):
+        time_mock.return_value = 0
+        bucket = standby._TokenBucket(rate=100)
+        # At most one second worth of tokens is accumulated.
+        time_mock.return_value = 10
+
+        def _sleep(seconds):
+            time_mock.return_value += seconds
+
+        sleep_mock.side_effect = _sleep
+
+        bucket.consume(100)
+        self.assertFalse(sleep_mock.called)
+        bucket.consume(50)
+        sleep_mock.assert_called_once_with(0.5)
+
+    def test_set_rate(self, time_mock, sleep_mock):
+        time_mock.return_value = 0
+        bucket = standby._TokenBucket(rate=100)
+
+        def _sleep(seconds):
+            # The limit is lifted while waiting.
+            bucket.set_rate(0)
+
+        sleep_mock.side_effect = _sleep
+
+        bucket.consume(1000)
+
+        sleep_mock.assert_called_once_with(1)
+        self.assertEqual(0, bucket.rate)
+
+
+@mock.patch.object(time, 'time', autospec=True)
+class TestTimings(base.IronicAgentTest):
+
+    def test_download_timings(self, time_mock):
+        time_mock.side_effect = [0.5, 1.0, 1.5, 2.5]
+        timings = standby._DownloadTimings(0.0)
+        timings.connect = 0.25
+        timings.retries = 1
+
+        for nbytes in (100, 100, 300, 100):
+            timings.received(nbytes)
+
+        self.assertEqual({'connect_seconds': 0.25,
+                          'first_byte_seconds': 0.5,
+                          'seconds': 2.5,
+                          'bytes': 600,
+                          'bytes_per_second': 240.0,
+                          'peak_bytes_per_second': 500.0,
+                          'hash_seconds': 0.0,
+                          'write_seconds': 0.0,
+                          'retries': 1}, timings.as_dict())
+
+    def test_phase_timer(self, time_mock):
+        time_mock.side_effect = [0.0, 1.0, 3.0, 4.0, 4.5, 10.0]
+        timer = standby._PhaseTimer()
+
+        with timer.phase('download'):
+            pass
+        self.assertRaises(
+            RuntimeError, self._fail_in_phase, timer, 'download')
+        timer.add('fsync', 0.5)
+
+        self.assertEqual({'total_seconds': 10.0,
+                          'phases': {'download': 2.5, 'fsync': 0.5},
+                          'download': None}, timer.as_dict())
+
+    def _fail_in_phase(self, timer, name):
+        with timer.phase(name):
+            raise RuntimeError('boom')
+
+
+def _qcow2_header(virtual_size):
+    return struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', 3, 0, 0, 16,
+                       virtual_size, 0, 1, 0x30000, 0x10000, 1, 0, 0)
+
+
+@mock.patch.object(requests.Session, 'get', autospec=True)
+@mock.patch.object(requests.Session, 'head', autospec=True)
+class TestPreflight(base.IronicAgentTest):
+
+    def _setup(self, head_mock, get_mock, header=b'\0' * 72, size=4096,
+               status_codes=None):
+        status_codes = list(status_codes or [200])
+
+        def _head(session, url, **kwargs):
+            resp = mock.Mock(status_code=status_codes.pop(0))
+            resp.headers = {'Content-Length': str(size),
+                            'Accept-Ranges': 'bytes', 'ETag': '"abc"'}
+            return resp
+
+        def _get(session, url, headers=None, **kwargs):
+            if url.endswith('SHA256SUMS'):
+                return mock.Mock(status_code=404, text='Not Found')
+            self.assertEqual({'Range': 'bytes=0-71'}, headers)
+            resp = mock.Mock(status_code=206)
+            resp.iter_content.return_value = [header[:10], header[10:]]
+            return resp
+
+        head_mock.side_effect = _head
+        get_mock.side_effect = _get
+
+    def test_raw(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+
+        result = standby._preflight_image(image_info)
+
+        self.assertEqual(4096, result['size'])
+        self.assertEqual('"abc"', result['etag'])
+        self.assertTrue(result['ranges'])
+        self.assertEqual(4096, result['virtual_size'])
+        self.assertEqual(['http://example.org'], result['reachable_urls'])
+        self.assertEqual((hashlib.md5, 'abc123'), result['expected_hash'])
+        head_mock.assert_called_once_with(
+            mock.ANY, 'http://example.org', proxies={}, verify=True,
+            cert=None, timeout=standby.PREFLIGHT_TIMEOUT,
+            allow_redirects=True)
+
+    def test_qcow2(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock, header=_qcow2_header(8 * 1024 ** 2))
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+
+        result = standby._preflight_image(image_info)
+
+        self.assertEqual(8 * 1024 ** 2, result['virtual_size'])
+
+    def test_qcow2_too_large(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock,
+                    header=_qcow2_header(11 * 1024 ** 2))
+        image_info = _build_fake_partition_image_info()
+        image_info['disk_format'] = 'qcow2'
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'Root partition is too small',
+                               standby._preflight_image, image_info)
+
+    def test_wrong_format(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock, header=_qcow2_header(4096))
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'is a qcow2 image',
+                               standby._preflight_image, image_info)
+
+    def test_not_qcow2(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'qcow2'
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'is not a qcow2 image',
+                               standby._preflight_image, image_info)
+
+    def test_compression_not_set(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock, header=b'\x1f\x8b' + b'\0' * 70)
+        image_info = _build_fake_image_info()
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'compressed with gzip',
+                               standby._preflight_image, image_info)
+
+    def test_virtual_size_mismatch(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+        image_info['virtual_size'] = 8192
+
+        self.assertRaisesRegex(errors.InvalidCommandParamsError,
+                               'not 8192 as declared',
+                               standby._preflight_image, image_info)
+
+    def test_one_url_unreachable(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock, status_codes=[404, 200])
+        image_info = _build_fake_image_info()
+        image_info['urls'] = ['http://example.com', 'http://example.org']
+
+        result = standby._preflight_image(image_info)
+
+        self.assertEqual(['http://example.org'], result['reachable_urls'])
+
+    def test_unreachable(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock, status_codes=[404])
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'None of the image URLs is reachable',
+                               standby._preflight_image,
+                               _build_fake_image_info())
+
+    def test_checksum_unreachable(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = 'http://example.org/SHA256SUMS'
+
+        self.assertRaisesRegex(errors.ImageDownloadError, '404',
+                               standby._preflight_image, image_info)
+
+    def test_checksum_connection_error(self, head_mock, get_mock):
+        self.config(image_download_connection_retries=0)
+        self._setup(head_mock, get_mock)
+        image_info = _build_fake_image_info()
+        image_info['os_hash_algo'] = 'sha256'
+        image_info['os_hash_value'] = 'http://example.org/SHA256SUMS'
+        get_image = get_mock.side_effect
+
+        def _get(session, url, **kwargs):
+            if url.endswith('SHA256SUMS'):
+                raise requests.ConnectionError('boom')
+            return get_image(session, url, **kwargs)
+
+        get_mock.side_effect = _get
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'http://example.org/SHA256SUMS: boom',
+                               standby._preflight_image, image_info)
+
+    @mock.patch.object(standby, '_get_expected_hash', autospec=True)
+    def test_checksum_timeout(self, hash_mock, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        self.useFixture(fixtures.MonkeyPatch(
+            'ironic_python_agent.extensions.standby.PREFLIGHT_TIMEOUT', 0.1))
+        finished = threading.Event()
+        self.addCleanup(finished.set)
+        hash_mock.side_effect = lambda image_info: finished.wait(5)
+
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Fetching the checksum from .* timed out',
+                               standby._preflight_image,
+                               _build_fake_image_info())
+
+    @mock.patch.object(standby, '_get_expected_hash', autospec=True)
+    def test_shared_deadline(self, hash_mock, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        self.useFixture(fixtures.MonkeyPatch(
+            'ironic_python_agent.extensions.standby.PREFLIGHT_TIMEOUT', 0.5))
+        finished = threading.Event()
+        self.addCleanup(finished.set)
+        head_image = head_mock.side_effect
+
+        def _head(session, url, **kwargs):
+            if url == 'http://example.com':
+                finished.wait(5)
+            return head_image(session, url, **kwargs)
+
+        head_mock.side_effect = _head
+        hash_mock.side_effect = lambda image_info: finished.wait(5)
+        image_info = _build_fake_image_info()
+        image_info['urls'] = ['http://example.com', 'http://example.org']
+
+        started = time.time()
+        self.assertRaisesRegex(errors.ImageDownloadError,
+                               'Fetching the checksum from .* timed out',
+                               standby._preflight_image, image_info)
+        # The checksum is not given a time of its own after the slow URL.
+        self.assertLess(time.time() - started, 0.9)
+
+    def test_header_unavailable(self, head_mock, get_mock):
+        self._setup(head_mock, get_mock)
+        get_mock.side_effect = requests.ConnectionError('boom')
+        image_info = _build_fake_image_info()
+        image_info['disk_format'] = 'raw'
+
+        result = standby._preflight_image(image_info)
+
+        self.assertIsNone(result['virtual_size'])
@@ -12,14 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import time
 
+import fixtures
 import mock
 import pecan
 import pecan.testing
 
 from ironic_python_agent import agent
 from ironic_python_agent.extensions import base
+from ironic_python_agent import image_cache
 from ironic_python_agent.tests.unit import base as ironic_agent_base
 
 
@@ -312,3 +315,53 @@ class TestIronicAPI(ironic_agent_base.IronicAgentTest):
         self.assertEqual(200, response.status_code)
         data = response.json
         self.assertEqual(serialized_cmd_result, data)
+
+    def _setup_image_cache(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        # self.config holds the pecan configuration in these tests.
+        self.cfg_fixture.config(image_cache_dir=path)
+        with open(os.path.join(path, 'sha256-abcdef'), 'wb') as f:
+            f.write(b'0123456789')
+        return path
+
+    def test_get_image(self):
+        self._setup_image_cache()
+
+        response = self.app.get(PATH_PREFIX + '/images/sha256-abcdef')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'0123456789', response.body)
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+
+    def test_get_image_range(self):
+        self._setup_image_cache()
+
+        response = self.app.get(PATH_PREFIX + '/images/sha256-abcdef',
+                                headers={'Range': 'bytes=4-'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(b'456789', response.body)
+
+    def test_get_image_not_cached(self):
+        self._setup_image_cache()
+
+        for key in ('sha256-012345', '..'):
+            response = self.app.get(PATH_PREFIX + '/images/' + key,
+                                    expect_errors=True)
+            self.assertEqual(404, response.status_code)
+
+    @mock.patch.object(image_cache, 'find_cache', autospec=True)
+    def test_get_image_cache_disabled(self, find_cache_mock):
+        find_cache_mock.return_value = None
+
+        response = self.app.get(PATH_PREFIX + '/images/sha256-abcdef',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_code)
+
+    @mock.patch('ironic_python_agent.utils.execute', autospec=True)
+    def test_get_image_cache_not_mounted(self, execute_mock):
+        self._setup_image_cache()
+        self.cfg_fixture.config(image_cache_device='/dev/sdb')
+
+        response = self.app.get(PATH_PREFIX + '/images/sha256-abcdef',
+                                expect_errors=True)
+        self.assertEqual(404, response.status_code)
+        self.assertFalse(execute_mock.called)
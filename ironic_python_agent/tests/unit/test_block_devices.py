@@ -0,0 +1,176 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import fixtures
+import mock
+import pyudev
+
+from ironic_python_agent import block_devices
+from ironic_python_agent.tests.unit import base
+
+
+class TestEnumerateBlockDevices(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestEnumerateBlockDevices, self).setUp()
+        self.root = self.useFixture(fixtures.TempDir()).path
+        self.sys_block = os.path.join(self.root, 'sys', 'block')
+        self.udev_data = os.path.join(self.root, 'udev', 'data')
+        os.makedirs(self.sys_block)
+        os.makedirs(self.udev_data)
+        self.useFixture(fixtures.MonkeyPatch(
+            'ironic_python_agent.block_devices.SYS_BLOCK', self.sys_block))
+        self.useFixture(fixtures.MonkeyPatch(
+            'ironic_python_agent.block_devices.UDEV_DATA', self.udev_data))
+        self.useFixture(fixtures.MonkeyPatch(
+            'ironic_python_agent.block_devices.UDEV_QUEUE',
+            os.path.join(self.root, 'udev', 'queue')))
+
+    def _write(self, path, content):
+        path = os.path.join(self.sys_block, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content + '\n')
+
+    def _device(self, kname, dev, size, rotational='0', scsi=None,
+                model=None, vendor=None):
+        self._write(os.path.join(kname, 'dev'), dev)
+        self._write(os.path.join(kname, 'size'), str(size))
+        self._write(os.path.join(kname, 'queue', 'rotational'), rotational)
+        if scsi is not None:
+            hctl, scsi_type = scsi
+            device = os.path.join(self.root, 'devices', hctl)
+            os.makedirs(device)
+            os.symlink(device, os.path.join(self.sys_block, kname, 'device'))
+            self._write(os.path.join(kname, 'device', 'type'), scsi_type)
+        if model is not None:
+            self._write(os.path.join(kname, 'device', 'model'), model)
+        if vendor is not None:
+            self._write(os.path.join(kname, 'device', 'vendor'), vendor)
+
+    def _partition(self, kname, part, dev, size):
+        self._write(os.path.join(kname, part, 'dev'), dev)
+        self._write(os.path.join(kname, part, 'size'), str(size))
+        self._write(os.path.join(kname, part, 'partition'), '1')
+
+    def test_enumerate(self):
+        self._device('sda', '8:0', 20, rotational='1', scsi=('0:0:0:0', '0'),
+                     model='Disk ', vendor='ATA')
+        self._partition('sda', 'sda10', '8:10', 4)
+        self._partition('sda', 'sda2', '8:2', 8)
+        self._device('sr0', '11:0', 2, scsi=('1:0:0:0', '5'))
+        self._device('dm-0', '253:0', 8)
+        self._write('dm-0/dm/uuid', 'LVM-abcdef')
+        self._device('md0', '9:0', 16)
+        self._write('md0/md/level', 'raid1')
+        self._partition('md0', 'md0p1', '259:0', 8)
+        self._device('loop0', '7:0', 0)
+        with open(os.path.join(self.udev_data, 'b8:0'), 'w') as f:
+            f.write('S:disk/by-path/pci-0000:00:1f.2-ata-1\n'
+                    'S:disk/by-id/wwn-0x5000\n'
+                    'E:ID_WWN=0x5000\n'
+                    'E:ID_SERIAL_SHORT=S123\n'
+                    'G:systemd\n')
+
+        devices = block_devices.enumerate_block_devices()
+
+        self.assertEqual(['dm-0', 'loop0', 'md0', 'md0p1', 'sda', 'sda2',
+                          'sda10', 'sr0'], list(devices))
+        self.assertEqual({'KNAME': 'sda', 'MODEL': 'Disk', 'SIZE': '10240',
+                          'ROTA': '1', 'TYPE': 'disk', 'dev': '8:0',
+                          'udev': {'ID_WWN': '0x5000',
+                                   'ID_SERIAL_SHORT': 'S123'},
+                          'by_path':
+                              '/dev/disk/by-path/pci-0000:00:1f.2-ata-1',
+                          'hctl': '0:0:0:0', 'vendor': 'ATA'},
+                         devices['sda'])
+        self.assertEqual({'KNAME': 'sda2', 'MODEL': '', 'SIZE': '4096',
+                          'ROTA': '1', 'TYPE': 'part', 'dev': '8:2',
+                          'udev': {}, 'by_path': None, 'hctl': None,
+                          'vendor': None}, devices['sda2'])
+        self.assertEqual(
+            {'dm-0': 'lvm', 'loop0': 'loop', 'md0': 'raid1', 'md0p1': 'part',
+             'sda10': 'part', 'sr0': 'rom'},
+            dict((kname, devices[kname]['TYPE'])
+                 for kname in ('dm-0', 'loop0', 'md0', 'md0p1', 'sda10',
+                               'sr0')))
+
+    def test_no_sysfs(self):
+        os.rmdir(self.sys_block)
+
+        self.assertEqual({}, block_devices.enumerate_block_devices())
+
+    def test_udev_queue_empty(self):
+        self.assertTrue(block_devices.udev_queue_empty())
+
+        with open(os.path.join(self.root, 'udev', 'queue'), 'w'):
+            pass
+
+        self.assertFalse(block_devices.udev_queue_empty())
+
+
+@mock.patch.object(pyudev, 'MonitorObserver', autospec=True)
+@mock.patch.object(pyudev.Monitor, 'from_netlink', autospec=True)
+class TestBlockDeviceMonitor(base.IronicAgentTest):
+
+    def test_start_stop(self, mocked_netlink, mocked_observer):
+        monitor = block_devices.BlockDeviceMonitor()
+        monitor.start()
+
+        mocked_netlink.return_value.filter_by.assert_called_once_with(
+            'block')
+        mocked_observer.assert_called_once_with(
+            mocked_netlink.return_value, callback=monitor._handle_event,
+            name='block-device-monitor')
+        mocked_observer.return_value.start.assert_called_once_with()
+
+        monitor.stop()
+        mocked_observer.return_value.stop.assert_called_once_with()
+
+    def test_event(self, mocked_netlink, mocked_observer):
+        monitor = block_devices.BlockDeviceMonitor()
+        device = mock.Mock(sys_name='sdb', action='add')
+
+        monitor._handle_event(device)
+        monitor.invalidate()
+
+        self.assertEqual(2, monitor.generation)
+
+    def test_listeners(self, mocked_netlink, mocked_observer):
+        monitor = block_devices.BlockDeviceMonitor()
+        device = mock.Mock(sys_name='sdb', action='add')
+        failing = mock.Mock(side_effect=RuntimeError('boom'))
+        listener = mock.Mock()
+        monitor.add_listener(failing)
+        monitor.add_listener(listener)
+
+        monitor._handle_event(device)
+        monitor.remove_listener(listener)
+        monitor._handle_event(device)
+
+        failing.assert_called_with(device)
+        listener.assert_called_once_with(device)
+        self.assertEqual(2, monitor.generation)
+
+    def test_invalidate_with_listener(self, mocked_netlink, mocked_observer):
+        monitor = block_devices.BlockDeviceMonitor()
+        listener = mock.Mock()
+        monitor.add_listener(listener)
+
+        monitor.invalidate()
+
+        self.assertEqual(1, monitor.generation)
+        self.assertFalse(listener.called)
@@ -0,0 +1,114 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+
+from ironic_python_agent import decompress
+from ironic_python_agent import errors
+from ironic_python_agent.tests.unit import base
+
+DATA = b'SpongeBob SquarePants' * 1000
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _chunks(data, size=100):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestDecompressionStage(base.IronicAgentTest):
+
+    def _decompress(self, chunks, fmt, size=1024):
+        pieces = list(decompress.DecompressionStage(chunks, fmt, size,
+                                                    queue_size=2))
+        for piece in pieces:
+            self.assertLessEqual(len(piece), size)
+        return b''.join(pieces)
+
+    def test_gzip(self):
+        self.assertEqual(DATA, self._decompress(_chunks(_gzip(DATA)),
+                                                'gzip'))
+
+    def test_gzip_multiple_members(self):
+        compressed = _gzip(DATA[:5000]) + _gzip(DATA[5000:])
+
+        self.assertEqual(DATA, self._decompress(_chunks(compressed), 'gzip'))
+
+    def test_gzip_invalid(self):
+        self.assertRaisesRegex(decompress.DecompressionError,
+                               'Invalid gzip stream', self._decompress,
+                               [b'SpongeBob'], 'gzip')
+
+    def test_gzip_truncated(self):
+        if not hasattr(zlib.decompressobj(), 'eof'):
+            self.skipTest('Truncation cannot be detected on Python 2')
+        compressed = _gzip(DATA)
+
+        self.assertRaisesRegex(decompress.DecompressionError, 'truncated',
+                               self._decompress, _chunks(compressed[:-20]),
+                               'gzip')
+
+    def test_xz(self):
+        if not decompress.is_supported('xz'):
+            self.skipTest('lzma is not available')
+        compressed = (decompress.lzma.compress(DATA[:5000])
+                      + decompress.lzma.compress(DATA[5000:]))
+
+        self.assertEqual(DATA, self._decompress(_chunks(compressed), 'xz'))
+
+    def test_xz_truncated(self):
+        if not decompress.is_supported('xz'):
+            self.skipTest('lzma is not available')
+        compressed = decompress.lzma.compress(DATA)
+
+        self.assertRaisesRegex(decompress.DecompressionError, 'truncated',
+                               self._decompress, _chunks(compressed[:-20]),
+                               'xz')
+
+    def test_zstd(self):
+        if not decompress.is_supported('zstd'):
+            self.skipTest('zstandard is not available')
+        compressed = decompress.zstandard.ZstdCompressor().compress(DATA)
+
+        self.assertEqual(DATA, self._decompress(_chunks(compressed), 'zstd'))
+
+    def test_input_error(self):
+        def _chunks():
+            yield _gzip(DATA)[:100]
+            raise errors.ImageDownloadError('fake_id', 'boom')
+
+        self.assertRaisesRegex(errors.ImageDownloadError, 'boom',
+                               self._decompress, _chunks(), 'gzip')
+
+    def test_stop_early(self):
+        stage = iter(decompress.DecompressionStage(_chunks(_gzip(DATA)),
+                                                   'gzip', 100,
+                                                   queue_size=1))
+
+        self.assertEqual(DATA[:100], next(stage))
+        # Closing the generator stops and joins the decompressing thread.
+        stage.close()
+
+    def test_is_supported(self):
+        self.assertTrue(decompress.is_supported('gzip'))
+        self.assertFalse(decompress.is_supported('bzip2'))
+
+    def test_detect(self):
+        self.assertEqual('gzip', decompress.detect(_gzip(DATA)[:16]))
+        self.assertEqual('xz', decompress.detect(b'\xfd7zXZ\x00\x00'))
+        self.assertEqual('zstd', decompress.detect(b'\x28\xb5\x2f\xfd'))
+        self.assertIsNone(decompress.detect(b'QFI\xfb'))
+        self.assertIsNone(decompress.detect(b''))
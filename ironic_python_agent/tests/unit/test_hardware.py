@@ -13,8 +13,10 @@
 # limitations under the License.
 
 import binascii
+import collections
 import multiprocessing
 import os
+import threading
 import time
 
 from ironic_lib import disk_utils
@@ -27,6 +29,7 @@ import pyudev
 import six
 from stevedore import extension
 
+from ironic_python_agent import block_devices
 from ironic_python_agent import errors
 from ironic_python_agent import hardware
 from ironic_python_agent import netutils
@@ -1427,6 +1430,45 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         mock_cached_node.assert_called_once_with()
         mock_dev.assert_called_once_with()
 
+    @mock.patch.object(hardware, 'list_all_block_devices', autospec=True)
+    @mock.patch.object(hardware, '_block_device_from_udev', autospec=True)
+    @mock.patch.object(hardware, 'get_cached_node', autospec=True)
+    def test__is_root_device(self, mock_cached_node, mock_from_udev,
+                             mock_list):
+        mock_cached_node.return_value = {
+            'properties': {'root_device': {'serial': 'fake-serial'}},
+            'uuid': 'node1'}
+        device = mock.Mock(sys_name='sdb', action='add')
+        mock_from_udev.return_value = hardware.BlockDevice(
+            name='/dev/sdb', model='model', size=10737418240,
+            rotational=False, serial='fake-serial')
+
+        self.assertTrue(self.hardware._is_root_device(device))
+
+        mock_from_udev.return_value.serial = 'other-serial'
+        self.assertFalse(self.hardware._is_root_device(device))
+        mock_from_udev.assert_called_with(device)
+        self.assertFalse(mock_list.called)
+
+    @mock.patch.object(hardware, '_block_device_from_udev', autospec=True)
+    def test__is_root_device_not_a_disk(self, mock_from_udev):
+        mock_from_udev.return_value = None
+
+        self.assertFalse(self.hardware._is_root_device(
+            mock.Mock(sys_name='sdb1', action='add')))
+
+    @mock.patch.object(hardware, '_block_device_from_udev', autospec=True)
+    def test__is_root_device_overridden(self, mock_from_udev):
+        class CustomHardwareManager(hardware.GenericHardwareManager):
+            def get_os_install_device(self):
+                return '/dev/custom'
+
+        manager = CustomHardwareManager()
+
+        self.assertTrue(manager._is_root_device(
+            mock.Mock(sys_name='sdb', action='add')))
+        self.assertFalse(mock_from_udev.called)
+
     def test__get_device_info(self):
         fileobj = mock.mock_open(read_data='fake-vendor')
         with mock.patch(
@@ -1603,6 +1645,47 @@ class TestGenericHardwareManager(base.IronicAgentTest):
         self.assertEqual(self.hardware.get_boot_info(),
                          hardware_info['boot'])
         self.assertEqual('mock_hostname', hardware_info['hostname'])
+        metadata = hardware_info['metadata']
+        self.assertEqual({}, metadata['errors'])
+        self.assertEqual({'interfaces', 'cpu', 'disks', 'memory',
+                          'bmc_address', 'bmc_v6address', 'system_vendor',
+                          'boot'}, set(metadata['sections']))
+        self.assertIsNotNone(metadata['sections']['cpu'])
+        self.assertIn('total_seconds', metadata)
+
+    @mock.patch('ironic_python_agent.netutils.get_hostname', autospec=True)
+    def test_list_hardware_info_partial(self, mocked_get_hostname):
+        self.config(inventory_workers=1)
+        for method in ('list_network_interfaces', 'get_cpus',
+                       'list_block_devices', 'get_memory', 'get_boot_info',
+                       'get_bmc_address', 'get_bmc_v6address',
+                       'get_system_vendor_info'):
+            setattr(self.hardware, method, mock.Mock(return_value=method))
+        self.hardware.get_bmc_address.side_effect = RuntimeError('boom')
+        mocked_get_hostname.return_value = 'mock_hostname'
+
+        hardware_info = self.hardware.list_hardware_info()
+
+        self.assertIsNone(hardware_info['bmc_address'])
+        self.assertEqual('get_bmc_v6address', hardware_info['bmc_v6address'])
+        self.assertEqual('get_cpus', hardware_info['cpu'])
+        self.assertEqual({'bmc_address': 'boom'},
+                         hardware_info['metadata']['errors'])
+
+    def test_collect_inventory_timeout(self):
+        self.config(inventory_section_timeout=1, inventory_workers=2)
+        event = threading.Event()
+        self.addCleanup(event.set)
+
+        inventory, metadata = hardware._collect_inventory(
+            [('slow', event.wait), ('fast', lambda: 42),
+             ('queued', lambda: 'value')])
+
+        self.assertEqual({'slow': None, 'fast': 42, 'queued': 'value'},
+                         inventory)
+        self.assertEqual(['slow'], list(metadata['errors']))
+        self.assertIsNone(metadata['sections']['slow'])
+        self.assertIsNotNone(metadata['sections']['fast'])
 
     @mock.patch.object(hardware, 'list_all_block_devices', autospec=True)
     def test_list_block_devices(self, list_mock):
@@ -3531,6 +3614,11 @@ class TestEvaluateHardwareSupport(base.IronicAgentTest):
     def setUp(self):
         super(TestEvaluateHardwareSupport, self).setUp()
         self.hardware = hardware.GenericHardwareManager()
+        self.monitor_patcher = mock.patch.object(
+            hardware, '_get_block_device_monitor', autospec=True,
+            return_value=None)
+        self.addCleanup(self.monitor_patcher.stop)
+        self.mocked_get_monitor = self.monitor_patcher.start()
 
     def test_evaluate_hw_waits_for_disks(
             self, mocked_sleep, mocked_check_for_iscsi,
@@ -3643,11 +3731,156 @@ class TestEvaluateHardwareSupport(base.IronicAgentTest):
                          mocked_get_inst_dev.call_count)
         mocked_sleep.assert_called_with(CONF.disk_wait_delay)
 
+    def _monitor(self, *devices):
+        monitor = mock.Mock(spec=block_devices.BlockDeviceMonitor)
+
+        def _add_listener(callback):
+            for device in devices:
+                callback(device)
+
+        monitor.add_listener.side_effect = _add_listener
+        self.mocked_get_monitor.return_value = monitor
+        return monitor
+
+    @mock.patch.object(hardware.GenericHardwareManager, '_is_root_device',
+                       autospec=True)
+    def test_evaluate_hw_waits_for_disk_event(
+            self, mocked_is_root, mocked_sleep, mocked_check_for_iscsi,
+            mocked_md_assemble, mocked_get_inst_dev):
+        removed = mock.Mock(sys_name='sda', action='remove')
+        other = mock.Mock(sys_name='sdb', action='add')
+        root = mock.Mock(sys_name='sdc', action='add')
+        monitor = self._monitor(removed, other, root)
+        mocked_get_inst_dev.side_effect = errors.DeviceNotFound('boom')
+        mocked_is_root.side_effect = [False, True]
+
+        self.hardware.evaluate_hardware_support()
+
+        self.assertEqual(2, mocked_get_inst_dev.call_count)
+        mocked_is_root.assert_has_calls([mock.call(self.hardware, other),
+                                         mock.call(self.hardware, root)])
+        self.assertFalse(mocked_sleep.called)
+        monitor.remove_listener.assert_called_once_with(
+            monitor.add_listener.call_args[0][0])
+
+    def test_evaluate_hw_disk_appeared_before_listening(
+            self, mocked_sleep, mocked_check_for_iscsi,
+            mocked_md_assemble, mocked_get_inst_dev):
+        monitor = self._monitor()
+        mocked_get_inst_dev.side_effect = [errors.DeviceNotFound('boom'),
+                                           None]
+
+        self.hardware.evaluate_hardware_support()
+
+        self.assertEqual(2, mocked_get_inst_dev.call_count)
+        self.assertTrue(monitor.remove_listener.called)
+        self.assertFalse(mocked_sleep.called)
+
+    @mock.patch.object(hardware, 'LOG', autospec=True)
+    @mock.patch.object(six.moves.queue.Queue, 'get', autospec=True)
+    def test_evaluate_hw_disk_event_timeout(
+            self, mocked_get, mocked_log, mocked_sleep,
+            mocked_check_for_iscsi, mocked_md_assemble, mocked_get_inst_dev):
+        monitor = self._monitor()
+        mocked_get_inst_dev.side_effect = errors.DeviceNotFound('boom')
+        mocked_get.side_effect = six.moves.queue.Empty
+
+        self.hardware.evaluate_hardware_support()
+
+        self.assertEqual(2, mocked_get_inst_dev.call_count)
+        self.assertTrue(monitor.remove_listener.called)
+        self.assertFalse(mocked_sleep.called)
+        mocked_log.warning.assert_called_once_with(
+            'The root device was not detected in %d seconds',
+            CONF.disk_wait_delay * 9)
+
 
 @mock.patch.object(os, 'listdir', lambda *_: [])
 @mock.patch.object(utils, 'execute', autospec=True)
 class TestModuleFunctions(base.IronicAgentTest):
 
+    @mock.patch.object(block_devices, 'read_block_device', autospec=True)
+    def test__block_device_from_udev(self, mocked_read, mocked_execute):
+        mocked_read.return_value = {
+            'KNAME': 'sdb', 'MODEL': 'model', 'SIZE': '10737418240',
+            'ROTA': '1', 'TYPE': 'disk', 'by_path': None,
+            'udev': {'ID_SERIAL_SHORT': 'serial'}, 'hctl': '1:0:0:0',
+            'vendor': 'vendor'}
+        device = mock.Mock(sys_name='sdb', sys_path='/sys/devices/sdb',
+                           device_type='disk')
+
+        block_device = hardware._block_device_from_udev(device)
+
+        mocked_read.assert_called_once_with('sdb', '/sys/devices/sdb')
+        self.assertEqual('/dev/sdb', block_device.name)
+        self.assertEqual(10737418240, block_device.size)
+        self.assertEqual('serial', block_device.serial)
+
+    @mock.patch.object(block_devices, 'read_block_device', autospec=True)
+    def test__block_device_from_udev_partition(self, mocked_read,
+                                               mocked_execute):
+        device = mock.Mock(sys_name='sdb1', device_type='partition')
+
+        self.assertIsNone(hardware._block_device_from_udev(device))
+        self.assertFalse(mocked_read.called)
+
+    @mock.patch.object(block_devices, 'udev_queue_empty', autospec=True)
+    @mock.patch.object(block_devices, 'enumerate_block_devices',
+                       autospec=True)
+    @mock.patch.object(hardware, '_udev_settle', autospec=True)
+    def test_list_all_block_devices_sysfs(self, mocked_udev, mocked_enumerate,
+                                          mocked_queue_empty, mocked_execute):
+        self.config(block_device_enumerator='sysfs')
+        mocked_queue_empty.return_value = True
+
+        def _device(kname, devtype, size='1073741824', **kwargs):
+            device = {'KNAME': kname, 'MODEL': 'model', 'SIZE': size,
+                      'ROTA': '1', 'TYPE': devtype, 'udev': {},
+                      'by_path': None, 'hctl': None, 'vendor': None}
+            device.update(kwargs)
+            return device
+
+        mocked_enumerate.return_value = collections.OrderedDict([
+            ('sda', _device('sda', 'disk', udev={'ID_WWN': 'wwn0',
+                                                 'ID_SERIAL_SHORT': 'S0'},
+                            by_path='/dev/disk/by-path/1', hctl='1:0:0:0',
+                            vendor='ATA')),
+            ('sda1', _device('sda1', 'part')),
+            ('sdb', _device('sdb', 'disk', size='0')),
+            ('fd0', _device('fd0', 'disk')),
+            ('ram0', _device('ram0', 'disk')),
+            ('md0', _device('md0', 'raid1')),
+        ])
+
+        result = hardware.list_all_block_devices()
+
+        self.assertEqual([
+            hardware.BlockDevice(name='/dev/sda', model='model',
+                                 size=1073741824, rotational=True,
+                                 wwn='wwn0', serial='S0', vendor='ATA',
+                                 hctl='1:0:0:0',
+                                 by_path='/dev/disk/by-path/1'),
+            hardware.BlockDevice(name='/dev/md0', model='model',
+                                 size=1073741824, rotational=True),
+        ], result)
+        self.assertFalse(mocked_udev.called)
+        self.assertFalse(mocked_execute.called)
+
+    @mock.patch.object(block_devices, 'udev_queue_empty', autospec=True)
+    @mock.patch.object(block_devices, 'enumerate_block_devices',
+                       autospec=True)
+    @mock.patch.object(hardware, '_udev_settle', autospec=True)
+    def test_list_all_block_devices_sysfs_settle(self, mocked_udev,
+                                                 mocked_enumerate,
+                                                 mocked_queue_empty,
+                                                 mocked_execute):
+        self.config(block_device_enumerator='sysfs')
+        mocked_queue_empty.return_value = False
+        mocked_enumerate.return_value = collections.OrderedDict()
+
+        self.assertEqual([], hardware.list_all_block_devices())
+        mocked_udev.assert_called_once_with()
+
     @mock.patch.object(os, 'readlink', autospec=True)
     @mock.patch.object(hardware, '_get_device_info',
                        lambda x, y, z: 'FooTastic')
@@ -3769,3 +4002,203 @@ class TestListHardwareInfo(base.IronicAgentTest):
         self.assertEqual(fake_info, hardware.list_hardware_info())
         mock_dispatch.assert_called_with('list_hardware_info')
         self.assertEqual(2, mock_dispatch.call_count)
+
+
+@mock.patch.object(utils, 'execute', autospec=True)
+class TestSystemLshwDict(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSystemLshwDict, self).setUp()
+        self.config(lshw_cache_ttl=300)
+
+    def test_cached(self, mocked_execute):
+        mocked_execute.return_value = LSHW_JSON_OUTPUT_V1
+
+        first = hardware.get_system_lshw_dict()
+        first['product'] = 'changed'
+        second = hardware.get_system_lshw_dict()
+
+        self.assertEqual('ABC123 (GENERIC_SERVER)', second['product'])
+        mocked_execute.assert_called_once_with('lshw', '-quiet', '-json',
+                                               log_stdout=False)
+
+    @mock.patch.object(time, 'time', autospec=True)
+    def test_expired(self, mocked_time, mocked_execute):
+        self.config(lshw_cache_ttl=10)
+        mocked_execute.return_value = LSHW_JSON_OUTPUT_V1
+        mocked_time.return_value = 100
+
+        hardware.get_system_lshw_dict()
+        mocked_time.return_value = 109
+        hardware.get_system_lshw_dict()
+        self.assertEqual(1, mocked_execute.call_count)
+
+        mocked_time.return_value = 110
+        hardware.get_system_lshw_dict()
+        self.assertEqual(2, mocked_execute.call_count)
+
+    def test_disabled_by_default(self, mocked_execute):
+        self.cfg_fixture.conf.clear_override('lshw_cache_ttl')
+        mocked_execute.return_value = LSHW_JSON_OUTPUT_V1
+
+        hardware.get_system_lshw_dict()
+        hardware.get_system_lshw_dict()
+
+        self.assertEqual(2, mocked_execute.call_count)
+
+    def test_invalidate(self, mocked_execute):
+        mocked_execute.return_value = LSHW_JSON_OUTPUT_V1
+
+        hardware.get_system_lshw_dict()
+        hardware.invalidate_system_lshw_dict()
+        hardware.get_system_lshw_dict()
+
+        self.assertEqual(2, mocked_execute.call_count)
+
+    def test_failure_not_cached(self, mocked_execute):
+        mocked_execute.side_effect = [processutils.ProcessExecutionError(),
+                                      LSHW_JSON_OUTPUT_V1]
+
+        self.assertRaises(processutils.ProcessExecutionError,
+                          hardware.get_system_lshw_dict)
+        self.assertEqual('GENERIC', hardware.get_system_lshw_dict()['vendor'])
+
+    def test_shared_by_collectors(self, mocked_execute):
+        mocked_execute.return_value = LSHW_JSON_OUTPUT_V1
+        manager = hardware.GenericHardwareManager()
+
+        manager.get_system_vendor_info()
+        manager.get_system_vendor_info()
+
+        mocked_execute.assert_called_once_with('lshw', '-quiet', '-json',
+                                               log_stdout=False)
+
+    @mock.patch.object(hardware, '_get_managers', autospec=True)
+    @mock.patch.object(hardware.threading, 'Thread', autospec=True)
+    def test_warmed_by_load_managers(self, mocked_thread, mocked_get_managers,
+                                     mocked_execute):
+        hardware.load_managers()
+
+        mocked_get_managers.assert_called_once_with()
+        mocked_thread.assert_called_once_with(
+            target=hardware._warm_lshw_cache, name='lshw')
+        mocked_thread.return_value.start.assert_called_once_with()
+
+    @mock.patch.object(hardware, '_get_managers', autospec=True)
+    @mock.patch.object(hardware.threading, 'Thread', autospec=True)
+    def test_not_warmed_if_disabled(self, mocked_thread, mocked_get_managers,
+                                    mocked_execute):
+        self.config(lshw_cache_ttl=0)
+
+        hardware.load_managers()
+
+        self.assertFalse(mocked_thread.called)
+
+
+@mock.patch.object(hardware, '_list_all_block_devices', autospec=True)
+@mock.patch.object(block_devices, 'BlockDeviceMonitor', autospec=True)
+class TestBlockDeviceCache(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestBlockDeviceCache, self).setUp()
+        self.config(block_device_cache=True)
+        self.devices = [hardware.BlockDevice('/dev/sda', 'model', 1024, True)]
+
+    def test_cached(self, mocked_monitor, mocked_list):
+        mocked_monitor.return_value.generation = 0
+        mocked_list.return_value = self.devices
+
+        first = hardware.list_all_block_devices()
+        first[0].name = '/dev/changed'
+        second = hardware.list_all_block_devices()
+
+        self.assertEqual(self.devices, second)
+        mocked_list.assert_called_once_with('disk', False, True, True)
+        mocked_monitor.return_value.start.assert_called_once_with()
+
+    def test_cached_per_arguments(self, mocked_monitor, mocked_list):
+        mocked_monitor.return_value.generation = 0
+        mocked_list.return_value = self.devices
+
+        hardware.list_all_block_devices()
+        hardware.list_all_block_devices(block_type='part')
+        hardware.list_all_block_devices(block_type='part')
+
+        mocked_list.assert_has_calls([
+            mock.call('disk', False, True, True),
+            mock.call('part', False, True, True)])
+        self.assertEqual(2, mocked_list.call_count)
+
+    def test_event(self, mocked_monitor, mocked_list):
+        mocked_monitor.return_value.generation = 0
+        mocked_list.return_value = self.devices
+
+        hardware.list_all_block_devices()
+        mocked_monitor.return_value.generation = 1
+        hardware.list_all_block_devices()
+        hardware.list_all_block_devices()
+
+        self.assertEqual(2, mocked_list.call_count)
+
+    def test_event_while_listing(self, mocked_monitor, mocked_list):
+        monitor = mocked_monitor.return_value
+        monitor.generation = 0
+
+        def _list(*args):
+            monitor.generation += 1
+            return self.devices
+
+        mocked_list.side_effect = _list
+
+        hardware.list_all_block_devices()
+        hardware.list_all_block_devices()
+        self.assertEqual(2, mocked_list.call_count)
+
+    def test_disabled(self, mocked_monitor, mocked_list):
+        self.config(block_device_cache=False)
+        mocked_list.return_value = self.devices
+
+        hardware.list_all_block_devices()
+        hardware.list_all_block_devices()
+
+        self.assertEqual(2, mocked_list.call_count)
+        self.assertFalse(mocked_monitor.called)
+
+    def test_monitor_unavailable(self, mocked_monitor, mocked_list):
+        mocked_monitor.return_value.start.side_effect = OSError('denied')
+        mocked_list.return_value = self.devices
+
+        hardware.list_all_block_devices()
+        hardware.list_all_block_devices()
+
+        self.assertEqual(2, mocked_list.call_count)
+        mocked_monitor.return_value.start.assert_called_once_with()
+
+    @mock.patch.object(hardware, '_udev_settle', autospec=True)
+    def test_refresh(self, mocked_settle, mocked_monitor, mocked_list):
+        mocked_monitor.return_value.generation = 0
+        mocked_list.return_value = self.devices
+
+        hardware.list_all_block_devices()
+        hardware.refresh_block_devices()
+        hardware.list_all_block_devices()
+
+        mocked_settle.assert_called_once_with()
+        mocked_monitor.return_value.invalidate.assert_called_once_with()
+        self.assertEqual(2, mocked_list.call_count)
+
+    @mock.patch.object(hardware, '_udev_settle', autospec=True)
+    def test_refresh_nothing_cached(self, mocked_settle, mocked_monitor,
+                                    mocked_list):
+        hardware.refresh_block_devices()
+
+        self.assertFalse(mocked_settle.called)
+
+    @mock.patch.object(hardware, 'invalidate_system_lshw_dict',
+                       autospec=True)
+    @mock.patch.object(hardware, '_udev_settle', autospec=True)
+    def test_refresh_lshw(self, mocked_settle, mocked_invalidate,
+                          mocked_monitor, mocked_list):
+        hardware.refresh_block_devices()
+
+        mocked_invalidate.assert_called_once_with()
@@ -0,0 +1,194 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+import fixtures
+import mock
+from oslo_concurrency import processutils
+
+from ironic_python_agent import image_cache
+from ironic_python_agent.tests.unit import base
+
+
+class TestImageCache(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.cache = image_cache.ImageCache(self.path, max_size=20)
+
+    def _add(self, data, mtime):
+        key = image_cache.cache_key('md5', hashlib.md5(data).hexdigest())
+        with open(self.cache.part_path(key), 'wb') as f:
+            f.write(data)
+        path = self.cache.add(key)
+        os.utime(path, (mtime, mtime))
+        return key
+
+    def test_cache_key(self):
+        self.assertEqual('sha256-abcdef',
+                         image_cache.cache_key('sha256', 'ABCDEF'))
+        self.assertIsNone(image_cache.cache_key('md5', '../../etc/passwd'))
+
+    def test_lookup(self):
+        key = self._add(b'image', 1000)
+
+        path = self.cache.lookup(key, hashlib.md5)
+
+        self.assertEqual(os.path.join(self.path, key), path)
+        self.assertGreater(os.stat(path).st_mtime, 1000)
+
+    def test_lookup_miss(self):
+        self.assertIsNone(self.cache.lookup('md5-abcdef', hashlib.md5))
+
+    def test_lookup_corrupted(self):
+        key = self._add(b'image', 1000)
+        with open(self.cache.entry_path(key), 'wb') as f:
+            f.write(b'imagf')
+
+        self.assertIsNone(self.cache.lookup(key, hashlib.md5))
+        self.assertFalse(self.cache.contains(key))
+
+    def test_evict_least_recently_used(self):
+        first = self._add(b'first', 1000)
+        second = self._add(b'second', 3000)
+        third = self._add(b'third', 2000)
+        self.assertTrue(self.cache.contains(first))
+        self.cache.max_size = 12
+
+        self.cache.evict(needed=5)
+
+        self.assertFalse(self.cache.contains(first))
+        self.assertFalse(self.cache.contains(third))
+        self.assertTrue(self.cache.contains(second))
+
+    def test_add_keeps_new_entry(self):
+        self._add(b'first', 1000)
+        key = self._add(b'the second image', 2000)
+
+        self.assertEqual([key], os.listdir(self.path))
+
+    def test_evict_no_limit(self):
+        self.cache.max_size = 0
+        key = self._add(b'the first image', 1000)
+
+        self.cache.evict(needed=100)
+
+        self.assertTrue(self.cache.contains(key))
+
+    def test_remove_part(self):
+        open(self.cache.part_path('md5-abcdef'), 'wb').close()
+
+        self.cache.remove_part('md5-abcdef')
+        self.cache.remove_part('md5-abcdef')
+
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_remove_parts(self):
+        key = self._add(b'image', 1000)
+        open(self.cache.part_path('md5-abcdef'), 'wb').close()
+
+        self.cache.remove_parts()
+
+        self.assertEqual([key], os.listdir(self.path))
+
+
+@mock.patch('ironic_python_agent.utils.execute', autospec=True)
+class TestGetCache(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestGetCache, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'cache')
+
+    def test_disabled(self, execute_mock):
+        self.assertIsNone(image_cache.get_cache())
+        self.assertFalse(execute_mock.called)
+
+    def test_directory(self, execute_mock):
+        self.config(image_cache_dir=self.path, image_cache_max_size=2)
+
+        cache = image_cache.get_cache()
+
+        self.assertEqual(self.path, cache.path)
+        self.assertEqual(2 * 1024 * 1024, cache.max_size)
+        self.assertTrue(os.path.isdir(self.path))
+        self.assertFalse(execute_mock.called)
+
+    def test_removes_parts(self, execute_mock):
+        self.config(image_cache_dir=self.path)
+        os.makedirs(self.path)
+        open(os.path.join(self.path, 'md5-abcdef.part'), 'wb').close()
+
+        self.assertIsNotNone(image_cache.get_cache())
+
+        self.assertEqual([], os.listdir(self.path))
+
+    def test_device(self, execute_mock):
+        self.config(image_cache_dir=self.path, image_cache_device='/dev/sdb')
+
+        self.assertIsNotNone(image_cache.get_cache())
+        execute_mock.assert_called_once_with('mount', '/dev/sdb', self.path)
+
+    def test_device_mount_fails(self, execute_mock):
+        self.config(image_cache_dir=self.path, image_cache_device='/dev/sdb')
+        execute_mock.side_effect = processutils.ProcessExecutionError()
+
+        self.assertIsNone(image_cache.get_cache())
+
+
+@mock.patch('ironic_python_agent.utils.execute', autospec=True)
+class TestFindCache(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestFindCache, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'cache')
+
+    def test_disabled(self, execute_mock):
+        self.assertIsNone(image_cache.find_cache())
+
+    def test_missing(self, execute_mock):
+        self.config(image_cache_dir=self.path)
+
+        self.assertIsNone(image_cache.find_cache())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_directory(self, execute_mock):
+        self.config(image_cache_dir=self.path, image_cache_max_size=2)
+        os.mkdir(self.path)
+
+        cache = image_cache.find_cache()
+
+        self.assertEqual(self.path, cache.path)
+        self.assertEqual(2 * 1024 * 1024, cache.max_size)
+
+    @mock.patch.object(os.path, 'ismount', autospec=True)
+    def test_device_not_mounted(self, ismount_mock, execute_mock):
+        self.config(image_cache_dir=self.path, image_cache_device='/dev/sdb')
+        os.mkdir(self.path)
+        ismount_mock.return_value = False
+
+        self.assertIsNone(image_cache.find_cache())
+        self.assertFalse(execute_mock.called)
+
+    @mock.patch.object(os.path, 'ismount', autospec=True)
+    def test_device_mounted(self, ismount_mock, execute_mock):
+        self.config(image_cache_dir=self.path, image_cache_device='/dev/sdb')
+        os.mkdir(self.path)
+        ismount_mock.return_value = True
+
+        self.assertEqual(self.path, image_cache.find_cache().path)
+        self.assertFalse(execute_mock.called)
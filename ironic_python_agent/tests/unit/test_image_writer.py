@@ -0,0 +1,231 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import mmap
+import os
+import struct
+
+import fixtures
+import mock
+
+from ironic_python_agent import errors
+from ironic_python_agent import image_writer
+from ironic_python_agent.tests.unit import base
+
+
+class TestDirectIOWriter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDirectIOWriter, self).setUp()
+        # tmpfs does not support O_DIRECT, the alignment logic is the same.
+        self.useFixture(fixtures.MonkeyPatch('os.O_DIRECT', 0))
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'device')
+        with open(self.path, 'wb') as f:
+            f.write(b'\xff' * 32768)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_write(self):
+        data = os.urandom(10000)
+        with image_writer.DirectIOWriter(self.path, io_size=4096,
+                                         queue_depth=2) as writer:
+            for start in range(0, len(data), 3000):
+                writer.write(data[start:start + 3000])
+
+        self.assertEqual(data + b'\xff' * (32768 - 10000), self._read())
+        self.assertEqual(10000, writer.bytes_written)
+
+    def test_io_size_rounded_up(self):
+        writer = image_writer.DirectIOWriter(self.path, io_size=5000)
+        self.addCleanup(writer.close)
+        self.assertEqual(8192, writer._io_size)
+
+    def test_seek_unaligned(self):
+        with image_writer.DirectIOWriter(self.path, io_size=4096) as writer:
+            writer.seek(5000)
+            writer.write(b'\x00' * 100)
+
+        expected = b'\xff' * 5000 + b'\x00' * 100 + b'\xff' * 27668
+        self.assertEqual(expected, self._read())
+
+    def test_seek_after_write(self):
+        with image_writer.DirectIOWriter(self.path) as writer:
+            writer.write(b'\x00')
+            self.assertRaises(ValueError, writer.seek, 4096)
+
+    def test_seek_aligned_after_write(self):
+        with image_writer.DirectIOWriter(self.path, io_size=16384) as writer:
+            writer.write(b'\x00' * 4096)
+            writer.seek(8192)
+            writer.write(b'\x01' * 10)
+
+        expected = (b'\x00' * 4096 + b'\xff' * 4096 + b'\x01' * 10
+                    + b'\xff' * 24566)
+        self.assertEqual(expected, self._read())
+
+    @mock.patch.object(image_writer, '_pwrite_all', autospec=True)
+    def test_write_failure(self, pwrite_mock):
+        pwrite_mock.side_effect = OSError(5, 'Input/output error')
+        writer = image_writer.DirectIOWriter(self.path, io_size=4096,
+                                             queue_depth=1)
+        writer.write(b'\x00' * 4096)
+        self.assertRaisesRegex(errors.ImageWriteError,
+                               'Input/output error',
+                               writer.write, b'\x00' * 4096)
+        self.assertRaises(errors.ImageWriteError, writer.close)
+
+    def test_sparse_writer_direct_io(self):
+        writer = image_writer.DirectIOWriter(self.path, io_size=16384)
+        data = b'\x01' * 4096 + b'\x00' * 8192 + b'\x02' * 8192
+        with image_writer.SparseWriter(writer, 'skip',
+                                       block_size=4096) as sparse:
+            sparse.write(data)
+
+        expected = b'\x01' * 4096 + b'\xff' * 8192 + b'\x02' * 8192
+        self.assertEqual(expected + b'\xff' * 12288, self._read())
+        self.assertEqual(8192, sparse.bytes_skipped)
+
+    @mock.patch('resource.getrusage', autospec=True)
+    def test_get_peak_rss(self, getrusage_mock):
+        getrusage_mock.return_value.ru_maxrss = 2048
+        self.assertEqual(2 * 1024 * 1024, image_writer.get_peak_rss())
+
+
+class TestSparseWriter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSparseWriter, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'device')
+        with open(self.path, 'wb') as f:
+            f.write(b'\xff' * 32768)
+        self.data = (b'\x01' * 5000 + b'\x00' * 11384 + b'\x02' * 100
+                     + b'\x00' * 100)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def _write(self, policy):
+        with image_writer.SparseWriter(open(self.path, 'rb+'), policy,
+                                       block_size=4096) as writer:
+            for start in range(0, len(self.data), 3000):
+                writer.write(self.data[start:start + 3000])
+        return writer
+
+    def test_skip(self):
+        writer = self._write('skip')
+
+        # Only the zeros in the two complete blocks are skipped.
+        expected = (b'\x01' * 5000 + b'\x00' * 3192 + b'\xff' * 8192
+                    + b'\x02' * 100 + b'\x00' * 100 + b'\xff' * 16184)
+        self.assertEqual(expected, self._read())
+        self.assertEqual(8392, writer.bytes_written)
+        self.assertEqual(8192, writer.bytes_skipped)
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_zeroout(self, ioctl_mock):
+        writer = self._write('zeroout')
+
+        ioctl_mock.assert_called_once_with(
+            mock.ANY, image_writer.BLKZEROOUT, struct.pack('QQ', 8192, 8192))
+        self.assertEqual(8192, writer.bytes_skipped)
+
+    def test_zeroout_unsupported(self):
+        # Regular files do not support BLKZEROOUT, zeros are written.
+        writer = self._write('zeroout')
+
+        self.assertEqual(self.data + b'\xff' * 16184, self._read())
+        self.assertEqual(len(self.data), writer.bytes_written)
+        self.assertEqual(0, writer.bytes_skipped)
+
+    def test_seek(self):
+        with image_writer.SparseWriter(open(self.path, 'rb+'), 'skip',
+                                       block_size=4096) as writer:
+            writer.seek(2000)
+            writer.write(b'\x00' * 10000)
+
+        expected = (b'\xff' * 2000 + b'\x00' * 2096 + b'\xff' * 4096
+                    + b'\x00' * 3808 + b'\xff' * 20768)
+        self.assertEqual(expected, self._read())
+
+    def test_invalid_policy(self):
+        for policy in ('none', 'discard'):
+            self.assertRaises(ValueError, image_writer.SparseWriter,
+                              mock.Mock(), policy)
+
+
+class TestDirectIOReader(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestDirectIOReader, self).setUp()
+        # tmpfs does not support O_DIRECT, the alignment logic is the same.
+        self.useFixture(fixtures.MonkeyPatch('os.O_DIRECT', 0))
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'device')
+        self.data = os.urandom(10000)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.buf = mmap.mmap(-1, 8192)
+        self.addCleanup(self.buf.close)
+
+    def test_read(self):
+        with image_writer.DirectIOReader(self.path) as reader:
+            self.assertEqual(self.data[4096:8192],
+                             bytes(reader.read(4096, 4096, self.buf)))
+            # The tail of the file is not aligned.
+            self.assertEqual(self.data[8192:],
+                             bytes(reader.read(8192, 1808, self.buf)))
+
+    def test_read_past_end(self):
+        with image_writer.DirectIOReader(self.path) as reader:
+            self.assertRaisesRegex(IOError, 'Unexpected end',
+                                   reader.read, 8192, 4096, self.buf)
+
+    def test_direct_io_unsupported(self):
+        self.useFixture(fixtures.MonkeyPatch('os.O_DIRECT', 0o40000))
+        real_open = os.open
+
+        def _open(path, flags):
+            if flags != os.O_RDONLY:
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return real_open(path, flags)
+
+        with mock.patch('os.open', autospec=True, side_effect=_open):
+            reader = image_writer.DirectIOReader(self.path)
+        self.addCleanup(reader.close)
+
+        self.assertFalse(reader.direct)
+        self.assertEqual(self.data[:100],
+                         bytes(reader.read(0, 100, self.buf)))
+
+
+class TestLogicalBlockSize(base.IronicAgentTest):
+
+    @mock.patch('fcntl.ioctl', autospec=True)
+    def test_block_device(self, ioctl_mock):
+        ioctl_mock.return_value = struct.pack('i', 4096)
+
+        self.assertEqual(4096, image_writer.get_logical_block_size(42))
+        ioctl_mock.assert_called_once_with(42, image_writer.BLKSSZGET,
+                                           struct.pack('i', 0))
+
+    def test_not_a_block_device(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path, 'file')
+        with open(path, 'wb') as f:
+            self.assertEqual(512,
+                             image_writer.get_logical_block_size(f.fileno()))
@@ -267,6 +267,16 @@ class TestCollectDefault(BaseDiscoverTest):
         mock_dispatch.assert_called_once_with('list_hardware_info')
         mock_wait_for_dhcp.assert_called_once_with()
 
+    def test_missing_sections(self, mock_dispatch, mock_wait_for_dhcp):
+        mock_dispatch.return_value = self.inventory
+        self.inventory['disks'] = None
+        self.inventory['boot'] = None
+
+        inspector.collect_default(self.data, self.failures)
+
+        self.assertIsNone(self.data['boot_interface'])
+        self.assertNotIn('root_disk', self.data)
+
 
 @mock.patch.object(utils, 'collect_system_logs', autospec=True)
 class TestCollectLogs(base.IronicAgentTest):
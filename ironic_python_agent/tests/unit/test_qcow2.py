@@ -0,0 +1,227 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import struct
+import zlib
+
+import fixtures
+
+from ironic_python_agent import qcow2
+from ironic_python_agent.tests.unit import base
+
+CLUSTER_BITS = 12
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+L2_ENTRIES = CLUSTER_SIZE // 8
+# Spans three L2 tables, the last cluster is incomplete.
+VIRTUAL_SIZE = 2 * L2_ENTRIES * CLUSTER_SIZE + 5 * CLUSTER_SIZE + 1000
+
+
+def _cluster(value):
+    return bytes(bytearray([value])) * CLUSTER_SIZE
+
+
+def _build_image(data, compressed=(), zero=(), data_first=False,
+                 version=3, backing_file=False):
+    """Build a qcow2 image the way qemu-img lays it out.
+
+    :param data: A dict mapping guest cluster numbers to their contents.
+    :param compressed: Guest cluster numbers to store compressed.
+    :param zero: Guest cluster numbers with the zero flag set.
+    :param data_first: Put the data clusters in front of the L2 tables.
+    :returns: The image as bytes.
+    """
+    l1_size = -(-VIRTUAL_SIZE // (L2_ENTRIES * CLUSTER_SIZE))
+    header = struct.pack('>4sIQIIQIIQQIIQ', b'QFI\xfb', version,
+                         512 if backing_file else 0, 0, CLUSTER_BITS,
+                         VIRTUAL_SIZE, 0, l1_size, 3 * CLUSTER_SIZE,
+                         CLUSTER_SIZE, 1, 0, 0)
+    if version == 3:
+        header += struct.pack('>QQQII', 0, 0, 0, 4, 104)
+    refcount_table = struct.pack('>Q', 2 * CLUSTER_SIZE)
+
+    # Only the L2 tables for clusters 0-511 and 1024-1535 are allocated.
+    l2_tables = {0: [0] * L2_ENTRIES, 2: [0] * L2_ENTRIES}
+    body = []
+    next_offset = 4 * CLUSTER_SIZE
+    table_offsets = {}
+    if not data_first:
+        for index in sorted(l2_tables):
+            table_offsets[index] = next_offset
+            next_offset += CLUSTER_SIZE
+    for guest in sorted(data):
+        if guest in compressed:
+            continue
+        l2_tables[guest // L2_ENTRIES][guest % L2_ENTRIES] = (
+            next_offset | 1 << 63)
+        body.append(data[guest])
+        next_offset += CLUSTER_SIZE
+    for guest in zero:
+        l2_tables[guest // L2_ENTRIES][guest % L2_ENTRIES] = 1
+    if data_first:
+        for index in sorted(l2_tables):
+            table_offsets[index] = next_offset + len(table_offsets) * (
+                CLUSTER_SIZE)
+
+    # Compressed clusters are packed at the end of the file.
+    packed = b''
+    compressed_offset = next_offset + len(
+        table_offsets if data_first else ()) * CLUSTER_SIZE
+    nb_bits = 62 - (CLUSTER_BITS - 8)
+    for guest in compressed:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+        blob = compressor.compress(data[guest]) + compressor.flush()
+        offset = compressed_offset + len(packed)
+        sectors = (offset + len(blob) - 1) // 512 - offset // 512
+        l2_tables[guest // L2_ENTRIES][guest % L2_ENTRIES] = (
+            offset | sectors << nb_bits | 1 << 62)
+        packed += blob
+
+    l1_table = [0] * l1_size
+    for index, offset in table_offsets.items():
+        l1_table[index] = offset | 1 << 63
+    tables = [struct.pack('>%dQ' % L2_ENTRIES, *l2_tables[index])
+              for index in sorted(l2_tables)]
+    if data_first:
+        body = body + tables
+    else:
+        body = tables + body
+
+    clusters = [header.ljust(CLUSTER_SIZE, b'\0'),
+                refcount_table.ljust(CLUSTER_SIZE, b'\0'),
+                b'\0' * CLUSTER_SIZE,
+                struct.pack('>%dQ' % l1_size, *l1_table).ljust(CLUSTER_SIZE,
+                                                               b'\0')]
+    return b''.join(clusters + body) + packed
+
+
+class TestStreamConverter(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestStreamConverter, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(self.tmpdir, 'device')
+        self.device_size = VIRTUAL_SIZE + CLUSTER_SIZE
+        with open(self.path, 'wb') as f:
+            f.write(b'\xff' * self.device_size)
+        self.data = {0: _cluster(1), 1: _cluster(2), 7: _cluster(3),
+                     L2_ENTRIES * 2: _cluster(4),
+                     L2_ENTRIES * 2 + 3: bytes(bytearray(range(256))) * 16,
+                     L2_ENTRIES * 2 + 5: _cluster(6)}
+        # The last cluster of the image is compressed and incomplete.
+        self.compressed = (L2_ENTRIES * 2 + 3, L2_ENTRIES * 2 + 5)
+        self.zero = (2,)
+
+    def _expected(self):
+        expected = bytearray(VIRTUAL_SIZE)
+        for guest, contents in self.data.items():
+            start = guest * CLUSTER_SIZE
+            length = min(CLUSTER_SIZE, VIRTUAL_SIZE - start)
+            expected[start:start + length] = contents[:length]
+        return bytes(expected) + b'\xff' * (self.device_size - VIRTUAL_SIZE)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def _convert(self, image, chunk_size=1000):
+        converter = qcow2.StreamConverter(self.path, spill_dir=self.tmpdir)
+        with converter:
+            for start in range(0, len(image), chunk_size):
+                converter.write(image[start:start + chunk_size])
+        return converter
+
+    def test_convert(self):
+        image = _build_image(self.data, compressed=self.compressed,
+                             zero=self.zero)
+        converter = self._convert(image)
+
+        self.assertEqual(self._expected(), self._read())
+        self.assertEqual(VIRTUAL_SIZE, converter.virtual_size)
+        self.assertEqual(0, converter.bytes_spilled)
+        self.assertEqual(5 * CLUSTER_SIZE + 1000, converter.bytes_written)
+        self.assertEqual(VIRTUAL_SIZE - converter.bytes_written,
+                         converter.bytes_zeroed)
+
+    def test_convert_large_chunks(self):
+        image = _build_image(self.data, compressed=self.compressed)
+        self._convert(image, chunk_size=3 * CLUSTER_SIZE + 17)
+
+        self.assertEqual(self._expected(), self._read())
+
+    def test_convert_version_2(self):
+        image = _build_image(self.data, version=2)
+        self._convert(image)
+
+        self.assertEqual(self._expected(), self._read())
+
+    def test_convert_out_of_order(self):
+        image = _build_image(self.data, compressed=self.compressed,
+                             zero=self.zero, data_first=True)
+        converter = self._convert(image)
+
+        self.assertEqual(self._expected(), self._read())
+        # The uncompressed data clusters arrive before their tables.
+        self.assertEqual(4 * CLUSTER_SIZE, converter.bytes_spilled)
+        self.assertEqual(['device'], os.listdir(self.tmpdir))
+
+    def test_backing_file(self):
+        image = _build_image(self.data, backing_file=True)
+        converter = qcow2.StreamConverter(self.path)
+        self.addCleanup(converter.close)
+
+        self.assertRaisesRegex(qcow2.UnsupportedImageError, 'backing file',
+                               converter.write, image[:CLUSTER_SIZE])
+        self.assertEqual(b'\xff' * self.device_size, self._read())
+
+    def test_not_qcow2(self):
+        converter = qcow2.StreamConverter(self.path)
+        self.addCleanup(converter.close)
+
+        self.assertRaisesRegex(qcow2.Qcow2Error, 'Not a qcow2 image',
+                               converter.write, b'\0' * CLUSTER_SIZE)
+
+    def test_truncated(self):
+        image = _build_image(self.data)
+        converter = qcow2.StreamConverter(self.path)
+        self.addCleanup(converter.close)
+        converter.write(image[:-CLUSTER_SIZE])
+
+        self.assertRaisesRegex(qcow2.Qcow2Error, 'truncated',
+                               converter.finish)
+
+    def test_too_short(self):
+        converter = qcow2.StreamConverter(self.path)
+        self.addCleanup(converter.close)
+        converter.write(b'QFI\xfb')
+
+        self.assertRaisesRegex(qcow2.Qcow2Error, 'too short',
+                               converter.finish)
+
+
+class TestReadVirtualSize(base.IronicAgentTest):
+
+    def test_read_virtual_size(self):
+        image = _build_image({})
+
+        self.assertEqual(VIRTUAL_SIZE,
+                         qcow2.read_virtual_size(image[:qcow2.HEADER_SIZE]))
+
+    def test_not_qcow2(self):
+        self.assertRaisesRegex(qcow2.Qcow2Error, 'Not a qcow2 image',
+                               qcow2.read_virtual_size,
+                               b'\0' * qcow2.HEADER_SIZE)
+
+    def test_truncated(self):
+        self.assertRaisesRegex(qcow2.Qcow2Error, 'truncated',
+                               qcow2.read_virtual_size, b'QFI\xfb')
@@ -0,0 +1,170 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+
+import fixtures
+import mock
+
+from ironic_python_agent import errors
+from ironic_python_agent import segment_hash
+from ironic_python_agent.tests.unit import base
+
+DATA = b'0123456789abcdefghij'
+
+
+def _segments(data, length):
+    return [segment_hash.Segment(start, len(data[start:start + length]),
+                                 hashlib.sha256(
+                                     data[start:start + length]).hexdigest())
+            for start in range(0, len(data), length)]
+
+
+class TestParseManifest(base.IronicAgentTest):
+
+    def test_parse(self):
+        lines = ['abc  image.img',
+                 'CCC  *image.img@8+4',
+                 'aaa  image.img@0+8',
+                 'ddd  other.img@0+8',
+                 'bbb  image.img@12+8']
+
+        self.assertEqual([segment_hash.Segment(0, 8, 'aaa'),
+                          segment_hash.Segment(8, 4, 'ccc'),
+                          segment_hash.Segment(12, 8, 'bbb')],
+                         segment_hash.parse_manifest(lines, 'image.img'))
+
+    def test_no_segments(self):
+        self.assertEqual([], segment_hash.parse_manifest(['abc  image.img'],
+                                                         'image.img'))
+
+    def test_gap(self):
+        lines = ['aaa  image.img@0+8', 'bbb  image.img@10+8']
+
+        self.assertRaisesRegex(ValueError, 'at byte 8',
+                               segment_hash.parse_manifest, lines,
+                               'image.img')
+
+    def test_invalid(self):
+        self.assertRaisesRegex(ValueError, 'Invalid segment 0-8',
+                               segment_hash.parse_manifest,
+                               ['aaa  image.img@0-8'], 'image.img')
+
+
+class TestSegmentVerifier(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestSegmentVerifier, self).setUp()
+        self.refetch = mock.Mock(return_value=None)
+        self.verifier = segment_hash.SegmentVerifier(
+            'fake_id', hashlib.sha256, _segments(DATA, 6), 2, self.refetch)
+
+    def _verify(self, data, offset=0, chunk_size=4):
+        chunks = [data[i:i + chunk_size]
+                  for i in range(0, len(data), chunk_size)]
+        return b''.join(bytes(chunk) for chunk in
+                        self.verifier.verify(chunks, offset))
+
+    def test_verify(self):
+        self.assertEqual(DATA, self._verify(DATA))
+        self.assertEqual(20, self.verifier.size)
+        self.assertFalse(self.refetch.called)
+
+    def test_verify_offset(self):
+        self.assertEqual(6, self.verifier.segment_start(9))
+
+        self.assertEqual(DATA[9:], self._verify(DATA[6:], offset=9))
+
+    def test_refetch(self):
+        self.refetch.return_value = DATA[6:12]
+        corrupted = DATA[:7] + b'X' + DATA[8:]
+
+        self.assertEqual(DATA, self._verify(corrupted))
+        self.refetch.assert_called_once_with(6, 11)
+        self.assertEqual(1, self.verifier.refetched)
+
+    def test_refetch_corrupted(self):
+        self.refetch.return_value = b'XXXXXX'
+
+        self.assertRaisesRegex(errors.ImageChecksumError, 'bytes 12-17',
+                               self._verify, DATA[:12] + b'X' + DATA[13:])
+
+    def test_refetch_not_possible(self):
+        self.assertRaises(errors.ImageChecksumError, self._verify,
+                          b'X' + DATA[1:])
+
+    def test_too_long(self):
+        self.assertRaisesRegex(errors.ImageChecksumError, 'bytes 20-',
+                               self._verify, DATA + b'X')
+
+    def test_too_short(self):
+        self.assertRaisesRegex(errors.ImageChecksumError, 'bytes 19-',
+                               self._verify, DATA[:-1])
+
+
+class TestReadBack(base.IronicAgentTest):
+
+    def setUp(self):
+        super(TestReadBack, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch('os.O_DIRECT', 0))
+        self.data = os.urandom(5 * 4096 + 100)
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'device')
+        with open(self.path, 'wb') as f:
+            f.write(self.data + b'\xff' * 4096)
+
+    def _corrupt(self, offset):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(b'X')
+
+    def test_segments(self):
+        stats = segment_hash.read_back(
+            self.path, len(self.data), hashlib.sha256, None,
+            segments=_segments(self.data, 8192), readers=2,
+            block_size=4096)
+
+        self.assertEqual(len(self.data), stats['bytes_read'])
+
+    def test_segments_corrupted(self):
+        self._corrupt(9000)
+
+        self.assertRaisesRegex(
+            errors.ImageChecksumError, 'bytes 8192-16383',
+            segment_hash.read_back, self.path, len(self.data),
+            hashlib.sha256, None, segments=_segments(self.data, 8192),
+            readers=2, block_size=4096)
+
+    def test_whole_image(self):
+        stats = segment_hash.read_back(
+            self.path, len(self.data), hashlib.sha256,
+            hashlib.sha256(self.data).hexdigest(), readers=3,
+            block_size=4096)
+
+        self.assertEqual(len(self.data), stats['bytes_read'])
+
+    def test_whole_image_corrupted(self):
+        self._corrupt(len(self.data) - 1)
+
+        self.assertRaises(
+            errors.ImageChecksumError, segment_hash.read_back, self.path,
+            len(self.data), hashlib.sha256,
+            hashlib.sha256(self.data).hexdigest(), readers=3,
+            block_size=4096)
+
+    def test_device_too_small(self):
+        self.assertRaisesRegex(
+            errors.ImageWriteError, 'Unexpected end',
+            segment_hash.read_back, self.path, len(self.data) + 8192,
+            hashlib.sha256, 'abc', readers=3, block_size=4096)
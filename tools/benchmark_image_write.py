@@ -0,0 +1,453 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark downloading and writing images with the standby extension.
+
+Synthetic images are served from a local HTTP server with a configurable
+latency and bandwidth, and written by ``prepare_image`` to a file or a
+block device, e.g. a loop device, once per mode. Every run happens in a
+process of its own, so that its CPU usage and peak RSS can be measured.
+The results are written as JSON, to be compared between releases.
+
+Example::
+
+    truncate -s 4G /tmp/bench.img
+    sudo losetup --show -f /tmp/bench.img
+    sudo python tools/benchmark_image_write.py --target /dev/loop0 \\
+        --size 2048 --latency 20 --bandwidth 1000 --output results.json
+
+The agent requires ``parted`` to validate the partition table written,
+``qemu-img`` is required by the modes writing a local copy of the image
+or a qcow2 image and these modes are skipped without it.
+"""
+
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from oslo_config import cfg
+from oslo_log import log
+from oslo_utils import units
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+
+from ironic_python_agent import config  # noqa: registers the options
+from ironic_python_agent.extensions import standby
+from ironic_python_agent import hardware
+from ironic_python_agent import version
+
+CONF = cfg.CONF
+LOG = log.getLogger('ironic_python_agent.benchmark')
+
+CHUNK_SIZE = 64 * units.Ki
+
+_RANGE_RE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+# Mode name -> (image, whether qemu-img is needed, image_info overrides).
+MODES = collections.OrderedDict([
+    ('cached', ('random', True, {})),
+    ('stream', ('random', False, {'stream_raw_images': True})),
+    ('stream_direct_io', ('random', False, {'stream_raw_images': True,
+                                            'direct_io': True})),
+    ('stream_sparse', ('sparse', False, {'stream_raw_images': True,
+                                         'sparse_policy': 'skip'})),
+    ('stream_gzip', ('compressible', False, {'stream_raw_images': True,
+                                             'compression': 'gzip'})),
+    ('stream_qcow2', ('qcow2', True, {'stream_qcow2': True})),
+])
+
+IMAGES = {'random': 'random.img', 'sparse': 'sparse.img',
+          'compressible': 'compressible.img.gz', 'qcow2': 'qcow2.img'}
+
+
+class _Link(object):
+    """A link of a fixed bandwidth shared by all connections."""
+
+    def __init__(self, bandwidth):
+        """Create the link.
+
+        :param bandwidth: The bandwidth in bytes per second, 0 for no limit.
+        """
+        self._seconds_per_byte = 1.0 / bandwidth if bandwidth else 0
+        self._free_at = 0
+        self._lock = threading.Lock()
+        self.sent = 0
+
+    def send(self, nbytes):
+        """Wait until the link can send a number of bytes."""
+        with self._lock:
+            self.sent += nbytes
+            now = time.time()
+            self._free_at = (max(self._free_at, now)
+                             + nbytes * self._seconds_per_byte)
+            delay = self._free_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _ImageServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, latency, bandwidth):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           _ImageRequestHandler)
+        self.root = root
+        self.latency = latency
+        self.link = _Link(bandwidth)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+
+class _ImageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves files with byte range support, like a typical web server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def _serve(self, send_body):
+        time.sleep(self.server.latency)
+        path = os.path.join(self.server.root,
+                            os.path.basename(self.path.split('?')[0]))
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            self.send_error(404)
+            return
+
+        start, end = 0, size - 1
+        match = _RANGE_RE.match(self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                self.server.link.send(len(data))
+                try:
+                    self.wfile.write(data)
+                except socket.error:
+                    # The agent dropped the connection, e.g. to resume it
+                    # or to switch to another mirror.
+                    return
+                remaining -= len(data)
+
+    def log_message(self, format, *args):
+        LOG.debug('%s - %s', self.address_string(), format % args)
+
+
+class _TargetHardwareManager(hardware.HardwareManager):
+    """Installs the image onto the benchmark target."""
+
+    def __init__(self, target):
+        self.target = target
+
+    def evaluate_hardware_support(self):
+        return hardware.HardwareSupport.SERVICE_PROVIDER
+
+    def get_os_install_device(self):
+        return self.target
+
+
+def _mbr(size):
+    # A single Linux partition from 1 MiB to the end of the image, so that
+    # the agent finds a valid partition table after writing it.
+    entry = struct.pack('<B3sB3sII', 0, b'\0' * 3, 0x83, b'\0' * 3, 2048,
+                        size // 512 - 2048)
+    return b'\0' * 446 + entry + b'\0' * 48 + b'\x55\xaa'
+
+
+def _random_blocks(size, data_size):
+    yield _mbr(size) + os.urandom(units.Mi - 512)
+    for _ in range(units.Mi, data_size, units.Mi):
+        yield os.urandom(units.Mi)
+
+
+def _compressible_blocks(size):
+    text = b''.join(b'%08d The quick brown fox jumps over the lazy dog\n' % i
+                    for i in range(units.Mi // 56))
+    text += b'\n' * (units.Mi - len(text))
+    yield _mbr(size) + text[512:]
+    for offset in range(units.Mi, size, units.Mi):
+        yield b'%016x' % offset + text[16:]
+
+
+def _sha256(path):
+    hash_obj = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(units.Mi), b''):
+            hash_obj.update(chunk)
+    return hash_obj.hexdigest()
+
+
+def _has_qemu_img():
+    try:
+        subprocess.check_output(['qemu-img', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def create_images(root, size, names):
+    """Create the synthetic images.
+
+    :param root: The directory to create the images in.
+    :param size: The virtual size of the images in bytes, a multiple of
+                 1 MiB.
+    :param names: The images to create, keys of IMAGES.
+    :returns: A dictionary mapping the image names to their SHA256 hex
+              digests.
+    """
+    random_path = os.path.join(root, IMAGES['random'])
+    if 'random' in names or 'qcow2' in names:
+        with open(random_path, 'wb') as f:
+            for block in _random_blocks(size, size):
+                f.write(block)
+    if 'sparse' in names:
+        # Only the first tenth of the image holds data.
+        with open(os.path.join(root, IMAGES['sparse']), 'wb') as f:
+            for block in _random_blocks(size, max(size // 10, units.Mi)):
+                f.write(block)
+            f.truncate(size)
+    if 'compressible' in names:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        with open(os.path.join(root, IMAGES['compressible']), 'wb') as f:
+            for block in _compressible_blocks(size):
+                f.write(compressor.compress(block))
+            f.write(compressor.flush())
+    if 'qcow2' in names:
+        subprocess.check_call(['qemu-img', 'convert', '-O', 'qcow2',
+                               random_path,
+                               os.path.join(root, IMAGES['qcow2'])])
+    return {name: _sha256(os.path.join(root, IMAGES[name]))
+            for name in names}
+
+
+def _prepare_image(image_info, target, conn):
+    try:
+        conn.send(_measure(image_info, target))
+    except Exception as e:
+        LOG.exception('Benchmark run failed')
+        conn.send({'seconds': None, 'cpu_percent': None,
+                   'peak_rss_kib': None, 'timings': None,
+                   'write_stats': None, 'error': str(e)})
+
+
+def _measure(image_info, target):
+    hardware._global_managers = [_TargetHardwareManager(target)]
+    usage = [resource.getrusage(resource.RUSAGE_SELF),
+             resource.getrusage(resource.RUSAGE_CHILDREN)]
+    started = time.time()
+    command = standby.StandbyExtension().prepare_image(
+        image_info=image_info).join()
+    elapsed = time.time() - started
+    cpu = sum(after.ru_utime + after.ru_stime
+              - before.ru_utime - before.ru_stime
+              for before, after in zip(usage, [
+                  resource.getrusage(resource.RUSAGE_SELF),
+                  resource.getrusage(resource.RUSAGE_CHILDREN)]))
+    result = command.command_result or {}
+    return {'seconds': elapsed,
+            # Above 100 when using more than one CPU.
+            'cpu_percent': 100 * cpu / elapsed if elapsed else None,
+            'peak_rss_kib': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss,
+            'timings': result.get('timings'),
+            'write_stats': result.get('write_stats'),
+            'error': (str(command.command_error)
+                      if command.command_error else None)}
+
+
+def _reset_target(target, size):
+    if os.path.isfile(target) or not os.path.exists(target):
+        with open(target, 'wb') as f:
+            f.truncate(size)
+
+
+def run_mode(server, mode, digest, size, target, connections=None):
+    """Write an image with a mode in a new process.
+
+    :returns: A dictionary with the results.
+    """
+    image, _qemu_img, overrides = MODES[mode]
+    image_info = {'id': 'benchmark-{}'.format(mode),
+                  'urls': ['{}/{}'.format(server.url, IMAGES[image])],
+                  'disk_format': 'qcow2' if image == 'qcow2' else 'raw',
+                  'os_hash_algo': 'sha256', 'os_hash_value': digest}
+    if connections:
+        image_info['download_connections'] = connections
+    image_info.update(overrides)
+
+    _reset_target(target, size)
+    sent = server.link.sent
+    parent_conn, child_conn = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_prepare_image,
+                                      args=(image_info, target, child_conn))
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+
+    result.update({'mode': mode, 'image': image, 'image_size': size,
+                   'served_bytes': server.link.sent - sent,
+                   'mib_per_second': (size / result['seconds'] / units.Mi
+                                      if result['seconds'] else None)})
+    if result['error']:
+        LOG.error('Mode %(mode)s failed: %(error)s', result)
+    else:
+        LOG.info('Mode %(mode)s: %(mib_per_second).2f MiB/s, CPU '
+                 '%(cpu_percent).0f%%, peak RSS %(peak_rss_kib)d KiB',
+                 result)
+    return result
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark downloading and writing images.')
+    parser.add_argument('--target',
+                        help='The file or block device to write the images '
+                             'to. A file in the work directory by default.')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='The virtual size of the images in MiB.')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help='Comma separated list of modes, out of '
+                             '{}.'.format(', '.join(MODES)))
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='The number of runs of every mode.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='The latency of every request in milliseconds.')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='The bandwidth shared by all connections in '
+                             'Mbit/s, 0 for no limit.')
+    parser.add_argument('--connections', type=int,
+                        help='The number of connections of every download.')
+    parser.add_argument('--work-dir',
+                        help='The directory to create the images in. A '
+                             'temporary directory removed afterwards by '
+                             'default.')
+    parser.add_argument('--output', default='-',
+                        help='The file to write the JSON results to.')
+    parser.add_argument('--debug', action='store_true')
+    # The remaining arguments, e.g. --config-file, go to the agent.
+    return parser.parse_known_args(argv)
+
+
+def main(argv=None):
+    args, agent_args = parse_args(sys.argv[1:] if argv is None else argv)
+    log.register_options(CONF)
+    CONF(args=agent_args, project='ironic-python-agent')
+    CONF.set_override('debug', args.debug)
+    log.setup(CONF, 'ironic-python-agent-benchmark')
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        sys.exit('Unknown modes: {}'.format(', '.join(sorted(unknown))))
+    if not _has_qemu_img():
+        skipped = [mode for mode in modes if MODES[mode][1]]
+        if skipped:
+            LOG.warning('qemu-img is not available, skipping modes %s',
+                        ', '.join(skipped))
+        modes = [mode for mode in modes if mode not in skipped]
+
+    size = args.size * units.Mi
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='ipa-benchmark-')
+    target = args.target or os.path.join(work_dir, 'target')
+    try:
+        LOG.info('Creating %(size)d MiB images in %(dir)s',
+                 {'size': args.size, 'dir': work_dir})
+        digests = create_images(work_dir, size,
+                                set(MODES[mode][0] for mode in modes))
+
+        server = _ImageServer(work_dir, args.latency / 1000.0,
+                              args.bandwidth * units.M / 8)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='benchmark-http')
+        thread.daemon = True
+        thread.start()
+        try:
+            results = []
+            for run in range(args.repeat):
+                for mode in modes:
+                    result = run_mode(server, mode,
+                                      digests[MODES[mode][0]], size, target,
+                                      connections=args.connections)
+                    result['run'] = run
+                    results.append(result)
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'date': datetime.datetime.utcnow().isoformat(),
+              'version': version.version_info.version_string(),
+              'python': platform.python_version(),
+              'target': args.target, 'size_mib': args.size,
+              'latency_ms': args.latency, 'bandwidth_mbit': args.bandwidth,
+              'connections': args.connections, 'results': results}
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 1 if any(result['error'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())